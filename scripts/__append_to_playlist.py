@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 import argparse
+import json
 import logging
 import os
+import re
 import subprocess
 import tempfile
+import threading
 import time
 import pathlib
 from logging.handlers import TimedRotatingFileHandler
@@ -27,9 +30,45 @@ logging.basicConfig(
 # Claude CLI path - read from environment or use default
 CLAUDE_BIN = os.environ.get('CLAUDE_BIN', '/home/decoder/.local/bin/claude')
 
+# A healthy Claude CLI check is remembered on disk for this many seconds, so
+# back-to-back runs skip `claude --version`; 0 disables the disk cache
+CLAUDE_HEALTH_TTL = int(os.environ.get('CLAUDE_HEALTH_TTL', '300'))
+CLAUDE_HEALTH_CACHE = pathlib.Path(
+    os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache')
+) / 'append_to_playlist' / 'claude_health.json'
+
 # Maximum number of lines in a playlist before warning about token limits
 MAX_PLAYLIST_LINES = 2000
 
+# Untagged entries are sent to Claude this many titles per prompt, with this
+# many prompts in flight at once - read from environment or use default
+TAG_BATCH_SIZE = int(os.environ.get('PLAYLIST_TAG_BATCH_SIZE', '10'))
+TAG_BATCH_PARALLEL = int(os.environ.get('PLAYLIST_TAG_PARALLEL', '2'))
+
+# Seconds a single-entry Claude call may take, and the extra allowed per title in a batch
+CLAUDE_TIMEOUT = 30
+CLAUDE_BATCH_TIMEOUT_PER_TITLE = 5
+
+# The GENRE/MOOD categories Claude may assign, one group per line of the prompt
+TAG_CATEGORIES = [
+    ['AMBIENT/CALM', 'AMBIENT/DARK', 'AMBIENT/DREAMY', 'AMBIENT/ETHEREAL', 'AMBIENT/NATURE'],
+    ['ELECTRONIC/UPBEAT', 'ELECTRONIC/CHILL', 'ELECTRONIC/EXPERIMENTAL'],
+    ['FOCUS/DEEP', 'FOCUS/LIGHT', 'FOCUS/CODING'],
+    ['INSTRUMENTAL/PIANO', 'INSTRUMENTAL/GUITAR', 'INSTRUMENTAL/ORCHESTRAL'],
+    ['LOFI/JAZZ', 'LOFI/HIPHOP', 'LOFI/CHILL'],
+    ['SOUNDTRACK/AMBIENT', 'SOUNDTRACK/EPIC', 'SOUNDTRACK/CINEMATIC'],
+    ['CLASSICAL/PIANO', 'CLASSICAL/ORCHESTRAL', 'CLASSICAL/FOCUS'],
+    ['TECHNO/CYBERPUNK', 'TECHNO/DARK', 'TECHNO/EXPERIMENTAL'],
+    ['TUTORIAL/DEV', 'TALK/TECH', 'TALK/PHILOSOPHY'],
+]
+VALID_CATEGORIES = frozenset(category for group in TAG_CATEGORIES for category in group)
+
+# Genre prefixes that mark a playlist title as already tagged
+TAGGED_PREFIXES = ['AMBIENT/', 'ELECTRONIC/', 'FOCUS/', 'LOFI/', 'INSTRUMENTAL/', 'SOUNDTRACK/', 'CLASSICAL/', 'TUTORIAL/', 'TALK/', 'TECHNO/']
+
+# One line of a batch response: "<number> | # GENRE/MOOD [ARTIST]: Title"
+BATCH_LINE = re.compile(r'^\s*(\d+)\s*\|\s*(#\s*([A-Z]+/[A-Z]+)\s*(\[[^\]]*\])?\s*:\s*(.*\S))\s*$')
+
 # Try to load prompt from an external file if it exists, otherwise use built-in prompt
 PROMPT_FILE = pathlib.Path(__file__).parent / 'playlist_prompt.md'
 
@@ -126,9 +165,76 @@ def load_prompt_template():
     # Fall back to built-in template
     return CLAUDE_PROMPT
 
+# Per-process Claude CLI state: the memoized health check, and the reason the
+# circuit breaker tripped, after which every entry is auto-tagged
+_claude_state = {'health': None, 'tripped': None}
+_claude_lock = threading.Lock()
+
 def check_claude_cli():
     """
-    Check if the Claude CLI is installed and working correctly.
+    Check if the Claude CLI is installed and working correctly, once per process.
+    A healthy result is also reused from CLAUDE_HEALTH_CACHE for CLAUDE_HEALTH_TTL
+    seconds, and a tripped circuit breaker reports Claude as unavailable.
+    Returns a tuple of (success, message)
+    """
+    with _claude_lock:
+        if _claude_state['tripped']:
+            return False, f"Claude circuit breaker is open: {_claude_state['tripped']}"
+        if _claude_state['health'] is None:
+            health = read_claude_health_cache()
+            if health is None:
+                health = probe_claude_cli()
+                if health[0]:
+                    write_claude_health_cache(health[1])
+            _claude_state['health'] = health
+        return _claude_state['health']
+
+def trip_claude_breaker(reason):
+    """
+    Stop calling Claude for the rest of this process after a timeout or failure,
+    so the remaining entries go straight to auto_tag_entry instead of each
+    waiting out its own timeout.
+    """
+    with _claude_lock:
+        if not _claude_state['tripped']:
+            logging.warning(f"Claude circuit breaker tripped: {reason}")
+            _claude_state['tripped'] = reason
+
+def claude_health_key():
+    """Identify the Claude binary a cached health check was made against."""
+    stat = os.stat(CLAUDE_BIN)
+    return [CLAUDE_BIN, stat.st_mtime_ns, stat.st_size]
+
+def read_claude_health_cache():
+    """
+    Return a cached healthy (True, message) check that is still within
+    CLAUDE_HEALTH_TTL and was made against the current binary, else None.
+    """
+    if CLAUDE_HEALTH_TTL <= 0:
+        return None
+    try:
+        cached = json.loads(CLAUDE_HEALTH_CACHE.read_text())
+        if cached['key'] == claude_health_key() and 0 <= time.time() - cached['checked'] < CLAUDE_HEALTH_TTL:
+            logging.debug(f"Using cached Claude CLI health check from {CLAUDE_HEALTH_CACHE}")
+            return True, cached['message']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def write_claude_health_cache(message):
+    """Remember a healthy check on disk for the next runs within the TTL."""
+    if CLAUDE_HEALTH_TTL <= 0:
+        return
+    try:
+        CLAUDE_HEALTH_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        cached = {'key': claude_health_key(), 'checked': time.time(), 'message': message}
+        atomic_write(CLAUDE_HEALTH_CACHE, json.dumps(cached))
+    except OSError as e:
+        logging.warning(f"Failed to cache Claude CLI health check: {e}")
+
+def probe_claude_cli():
+    """
+    Run `claude --version` to see whether the Claude CLI works.
     Returns a tuple of (success, message)
     """
     try:
@@ -250,6 +356,154 @@ def auto_tag_entry(title, _):
     else:
         return f"# {genre_mood_tag}: {title}"
 
+def format_categories():
+    """Render TAG_CATEGORIES as the bulleted list the tagging prompts show Claude."""
+    return '\n'.join(f"- {', '.join(group)}" for group in TAG_CATEGORIES)
+
+def is_tagged(title):
+    """Check whether a playlist title already carries a GENRE/MOOD tag."""
+    title_upper = title.upper()
+    return any(category in title_upper for category in TAGGED_PREFIXES)
+
+def same_title(returned, original):
+    """Check whether Claude gave a title back as it was sent, ignoring case and spacing."""
+    return ' '.join(returned.split()).casefold() == ' '.join(original.split()).casefold()
+
+def parse_batch_response(response, titles):
+    """
+    Parse Claude's answer to a batch tagging prompt.
+    
+    Args:
+        response: Claude's raw output, one "<number> | # GENRE/MOOD [ARTIST]: Title" line per title
+        titles: The titles the prompt numbered, in order
+        
+    Returns:
+        A dict mapping each zero-based title position to its tagged title, holding only
+        the lines that parsed, named a listed category, numbered a title of the batch and
+        carried that title back, so a misnumbered line cannot tag the wrong entry
+    """
+    tagged = {}
+    for line in response.splitlines():
+        match = BATCH_LINE.match(line)
+        if not match:
+            if line.strip():
+                logging.debug(f"Ignoring unparseable batch line: {line}")
+            continue
+        number, tagged_title, category = int(match.group(1)), match.group(2), match.group(3)
+        if category not in VALID_CATEGORIES:
+            logging.debug(f"Ignoring batch line with unknown category {category}: {line}")
+            continue
+        if not 1 <= number <= len(titles) or number - 1 in tagged:
+            logging.debug(f"Ignoring batch line with unexpected number {number}: {line}")
+            continue
+        if not same_title(match.group(5), titles[number - 1]):
+            logging.debug(f"Ignoring batch line whose title is not entry {number}'s: {line}")
+            continue
+        tagged[number - 1] = tagged_title
+    return tagged
+
+def tag_batch_with_claude(titles):
+    """
+    Use Claude to tag several playlist entries with a single prompt.
+    
+    Args:
+        titles: The titles to tag, without their leading #
+        
+    Returns:
+        A dict mapping title positions to tagged titles, as parse_batch_response;
+        empty when Claude times out or fails
+    """
+    if _claude_state['tripped']:
+        return {}
+    logging.debug(f'Asking Claude to tag a batch of {len(titles)} entries')
+    numbered = '\n'.join(f"{number}. {title}" for number, title in enumerate(titles, 1))
+    
+    # Prompt asking for exactly one numbered line per title, so each can be checked on its own
+    prompt = f"""
+You're a music categorizer that adds genre tags to playlist tracks.
+
+Titles:
+{numbered}
+
+Task: Format every title with the pattern: # GENRE/MOOD [ARTIST]: Title
+
+Available categories (use EXACTLY as shown with the slash):
+{format_categories()}
+
+Rules:
+1. Reply with exactly one line per title: <number> | # GENRE/MOOD [ARTIST]: Title
+2. <number> is the title's number from the list above
+3. Always use ALL CAPS for GENRE/MOOD and [ARTIST]
+4. If no artist is identifiable, omit [ARTIST] part
+5. Keep existing star emoji (⭐) if present
+6. Reply ONLY with these lines, nothing else
+
+Examples:
+1 | # AMBIENT/DARK: Dark ambient drones
+2 | # CLASSICAL/PIANO [CHOPIN]: Chopin Nocturne
+3 | # FOCUS/CODING: ⭐ Coding beats
+"""
+    
+    try:
+        start_time = time.time()
+        result = subprocess.run(
+            [CLAUDE_BIN, '-p', prompt],
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=CLAUDE_TIMEOUT + CLAUDE_BATCH_TIMEOUT_PER_TITLE * len(titles)
+        )
+        elapsed_time = time.time() - start_time
+        logging.debug(f'Claude tagged a batch of {len(titles)} in {elapsed_time:.2f} seconds')
+        return parse_batch_response(result.stdout, titles)
+    except subprocess.TimeoutExpired:
+        logging.warning(f"Claude timed out while tagging a batch of {len(titles)}")
+        trip_claude_breaker("batch timed out")
+        return {}
+    except Exception as e:
+        logging.error(f'Error tagging batch with Claude: {str(e)}')
+        trip_claude_breaker(f"batch failed: {e}")
+        return {}
+
+def tag_entries_with_claude(entries, batch_size=TAG_BATCH_SIZE, parallel=TAG_BATCH_PARALLEL):
+    """
+    Tag many playlist entries with Claude, batch_size titles per prompt and up to
+    parallel prompts at once. Entries whose line in a batch response is missing or
+    invalid are retried one by one with tag_entry_with_claude.
+    
+    Args:
+        entries: (title, url) pairs, titles without their leading #
+        batch_size: How many titles to send in one prompt
+        parallel: How many batch prompts may run at the same time
+        
+    Returns:
+        The tagged titles, in the order of entries
+    """
+    if not entries:
+        return []
+    
+    claude_ok, message = check_claude_cli()
+    if not claude_ok:
+        logging.warning(f"Claude not available: {message}")
+        return [auto_tag_entry(title, url) for title, url in entries]
+    
+    from concurrent.futures import ThreadPoolExecutor
+    
+    batch_size = max(1, batch_size)
+    batches = [entries[start:start + batch_size] for start in range(0, len(entries), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        responses = list(executor.map(lambda batch: tag_batch_with_claude([title for title, _ in batch]), batches))
+    
+    tagged = []
+    for batch, response in zip(batches, responses):
+        for position, (title, url) in enumerate(batch):
+            if position in response:
+                tagged.append(response[position])
+            else:
+                logging.debug(f"No valid batch tag for '{title}', retrying individually")
+                tagged.append(tag_entry_with_claude(title, url))
+    return tagged
+
 def tag_entry_with_claude(title, url):
     """
     Use Claude to tag a single playlist entry with proper genre/mood and artist information.
@@ -279,15 +533,7 @@ Title: {title}
 Task: Format this single title with the pattern: # GENRE/MOOD [ARTIST]: Title
 
 Available categories (use EXACTLY as shown with the slash):
-- AMBIENT/CALM, AMBIENT/DARK, AMBIENT/DREAMY, AMBIENT/ETHEREAL, AMBIENT/NATURE
-- ELECTRONIC/UPBEAT, ELECTRONIC/CHILL, ELECTRONIC/EXPERIMENTAL
-- FOCUS/DEEP, FOCUS/LIGHT, FOCUS/CODING
-- INSTRUMENTAL/PIANO, INSTRUMENTAL/GUITAR, INSTRUMENTAL/ORCHESTRAL
-- LOFI/JAZZ, LOFI/HIPHOP, LOFI/CHILL
-- SOUNDTRACK/AMBIENT, SOUNDTRACK/EPIC, SOUNDTRACK/CINEMATIC
-- CLASSICAL/PIANO, CLASSICAL/ORCHESTRAL, CLASSICAL/FOCUS
-- TECHNO/CYBERPUNK, TECHNO/DARK, TECHNO/EXPERIMENTAL
-- TUTORIAL/DEV, TALK/TECH, TALK/PHILOSOPHY
+{format_categories()}
 
 Rules:
 1. Format MUST be: # GENRE/MOOD [ARTIST]: Title
@@ -310,7 +556,7 @@ For "⭐ Coding beats" → # FOCUS/CODING: ⭐ Coding beats
             capture_output=True,
             text=True,
             check=True,
-            timeout=30  # Longer timeout to account for Claude CLI
+            timeout=CLAUDE_TIMEOUT  # Longer timeout to account for Claude CLI
         )
         elapsed_time = time.time() - start_time
         logging.debug(f'Claude responded in {elapsed_time:.2f} seconds')
@@ -334,15 +580,18 @@ For "⭐ Coding beats" → # FOCUS/CODING: ⭐ Coding beats
             
     except subprocess.TimeoutExpired:
         logging.warning(f"Claude timed out while tagging '{title}', using auto-tagging")
+        trip_claude_breaker(f"timed out tagging '{title}'")
         return auto_tag_entry(title, url)
     except Exception as e:
         logging.error(f'Error tagging entry with Claude: {str(e)}')
+        trip_claude_breaker(f"failed tagging '{title}': {e}")
         return auto_tag_entry(title, url)
         
-def organize_playlist(playlist_file_path, dry_run=False):
+def organize_playlist(playlist_file_path, dry_run=False, batch_size=TAG_BATCH_SIZE, parallel=TAG_BATCH_PARALLEL):
     """
     Reorganize a playlist file using Python code for sorting and structure.
-    Only uses Claude for tagging new entries that aren't properly formatted yet.
+    Only uses Claude for tagging new entries that aren't properly formatted yet,
+    batch_size titles per prompt with up to parallel prompts at once.
     """
     logging.debug(f'Organizing playlist: {playlist_file_path}')
     
@@ -354,6 +603,8 @@ def organize_playlist(playlist_file_path, dry_run=False):
         entries = []
         lines = playlist_content.strip().split('\n')
         
+        untagged = []
+        
         i = 0
         while i < len(lines):
             if lines[i].strip().startswith('#'):
@@ -361,11 +612,9 @@ def organize_playlist(playlist_file_path, dry_run=False):
                 url = lines[i+1].strip() if i+1 < len(lines) else ""
                 
                 # Check if the title is properly formatted (has GENRE/MOOD tag)
-                title_upper = title.upper()
-                if not any(category in title_upper for category in ['AMBIENT/', 'ELECTRONIC/', 'FOCUS/', 'LOFI/', 'INSTRUMENTAL/', 'SOUNDTRACK/', 'CLASSICAL/', 'TUTORIAL/', 'TALK/', 'TECHNO/']):
+                if not is_tagged(title):
                     logging.debug(f"Found untagged entry: {title}")
-                    # Title is not properly formatted, get proper tagging from Claude
-                    title = tag_entry_with_claude(title.replace('#', '').strip(), url)
+                    untagged.append(len(entries))
                 
                 entries.append((title, url))
                 i += 2
@@ -373,6 +622,15 @@ def organize_playlist(playlist_file_path, dry_run=False):
                 # Skip malformed lines
                 i += 1
         
+        # Titles that are not properly formatted get their tagging from Claude, in batches
+        tagged = tag_entries_with_claude(
+            [(entries[index][0].replace('#', '').strip(), entries[index][1]) for index in untagged],
+            batch_size,
+            parallel
+        )
+        for index, title in zip(untagged, tagged):
+            entries[index] = (title, entries[index][1])
+        
         # Function to extract genre/mood and artist for sorting
         def get_sort_keys(entry):
             title = entry[0]
@@ -578,12 +836,20 @@ def main():
     add_parser.add_argument('--dry-run', action='store_true', 
                            help='Show what would be done without making changes to the playlist file')
     add_parser.add_argument('--no-organize', action='store_true', help='Skip organizing the playlist after adding')
+    add_parser.add_argument('--batch-size', type=int, default=TAG_BATCH_SIZE,
+                           help='Untagged titles sent to Claude per prompt (default: %(default)s)')
+    add_parser.add_argument('--parallel', type=int, default=TAG_BATCH_PARALLEL,
+                           help='Claude prompts run at the same time (default: %(default)s)')
     
     # Reorganize command
     reorg_parser = subparsers.add_parser('reorg', help='Reorganize a playlist using Claude AI')
     reorg_parser.add_argument('playlist', help='Path to the playlist file')
     reorg_parser.add_argument('--dry-run', action='store_true', 
                              help='Preview Claude\'s organization without writing changes to the playlist file')
+    reorg_parser.add_argument('--batch-size', type=int, default=TAG_BATCH_SIZE,
+                             help='Untagged titles sent to Claude per prompt (default: %(default)s)')
+    reorg_parser.add_argument('--parallel', type=int, default=TAG_BATCH_PARALLEL,
+                             help='Claude prompts run at the same time (default: %(default)s)')
     
     # Export prompt template command
     export_parser = subparsers.add_parser('export-prompt', 
@@ -625,10 +891,10 @@ def main():
         
         # Organize the playlist after adding unless --no-organize is specified
         if success and not args.no_organize:
-            success = organize_playlist(args.playlist, args.dry_run)
+            success = organize_playlist(args.playlist, args.dry_run, args.batch_size, args.parallel)
     
     elif args.command == 'reorg':
-        success = organize_playlist(args.playlist, args.dry_run)
+        success = organize_playlist(args.playlist, args.dry_run, args.batch_size, args.parallel)
     
     logging.debug('Operation completed successfully.')
     
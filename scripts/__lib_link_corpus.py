@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""The link picker's search corpus, as one file read through mmap.
+
+__link_candidates.py kept the corpus as tab separated text, and every
+keystroke split all seventy thousand lines of it into tuples and converted
+every timestamp before the ranking could throw most of them away. This is the
+same rows laid out so that nothing is built for a row until it has matched:
+
+  header    magic, format version, row count, the byte lengths of meta,
+            blob and features and the entry counts of the index, packed as
+            HEADER
+  meta      json: the tag names the rows refer to by index, and whatever the
+            builder records about the profiles it read
+  columns   the record table, one fixed width array per field, row i at index
+            i in each: start (u32, where the row begins in the blob, counted in
+            bytes, with one extra entry closing the last row), char start (the
+            same counted in characters), url length (u32, bytes), visit time
+            (f64, unix seconds, 0 for a bookmark), tag id (u16), kind (u8, "h"
+            or "b"), flags (u8, the builder's own bits) and where the row's
+            features begin (u32, in bytes, one extra entry closing the last
+            row)
+  index     a trigram inverted index over each row's lowercased url and
+            title: the sorted trigram keys (u64, three code points of 21 bits
+            each), where each key's postings start (u32, one extra entry
+            closing the last), the postings themselves (u32 row ids, ascending
+            within a key), and the loose rows (u32), see below
+  blob      utf-8, each row as its url, a newline and its title, the rows
+            themselves joined by newlines
+  features  utf-8, per row whatever the builder derived from it once so a
+            search does not derive it per keystroke: the FEATURES fields, each
+            followed by a newline
+
+A query term of three or more characters that smart case matches as all
+lowercase can only be in a row holding every one of its trigrams, so the rows
+worth looking at are the intersection of those posting lists, rarest first,
+and the search is sublinear in the corpus. Every candidate is still checked by
+the ranker itself, so the index only ever narrows.
+
+Lowercasing agrees with the ranker's case insensitive regex only for ascii and
+for characters with no case at all. A row carrying any other character (an
+umlaut, cyrillic) is a loose row instead: it is in no posting list and is a
+candidate for every query. A term that is short, carries a capital or carries
+such a character takes the slow path: the rows searched are decoded together,
+once, and the ranker's anchor term runs across them in a single pass; only a
+row the anchor lands in is sliced out and checked against the other terms.
+Everywhere else a row is decoded on its own, out of its byte offsets, so a
+search that the index narrowed never decodes more than its candidates.
+
+Every section up to the blob starts on an eight byte boundary so it can be
+cast in place.
+
+A file whose magic or version is not this one raises CorpusError, which the
+picker takes as a rebuild, so changing the layout means bumping VERSION.
+"""
+
+import bisect
+import json
+import mmap
+import struct
+from array import array
+from collections import defaultdict
+
+MAGIC = b"LNKC"
+VERSION = 4
+
+# magic, version, row count, meta bytes, blob bytes, feature bytes, trigram
+# keys, postings, loose rows
+HEADER = struct.Struct("<4sIIIIIIII")
+
+# (name, array typecode, entries beyond one per row)
+COLUMNS = (
+    ("start", "I", 1),
+    ("char_start", "I", 1),
+    ("url_len", "I", 0),
+    ("when", "d", 0),
+    ("tag", "H", 0),
+    ("kind", "B", 0),
+    ("flags", "B", 0),
+    ("feature_start", "I", 1),
+)
+
+# What Corpus.features hands back after the flags, in order: the url as the
+# ranker sees it, the title as the picker shows it, the lowercase host, the
+# key rows are deduplicated on and the casefolded title.
+FEATURES = ("short", "title", "host", "key", "fold")
+
+ALIGN = 8
+
+GRAM = 3
+GRAM_BITS = 21
+
+
+class CorpusError(ValueError):
+    """The file is not a corpus this version can read."""
+
+
+def _padding(size):
+    return b"\0" * (-size % ALIGN)
+
+
+# The newline is the separator, so it cannot survive inside a field.
+def _flat(value):
+    return value.replace("\r", " ").replace("\n", " ")
+
+
+# True when lowercasing the text matches it exactly the way the ranker's
+# case insensitive regex would, character for character.
+def _plain_case(text):
+    return text.isascii() or all(char.isascii() or char.lower() == char.upper() for char in text)
+
+
+def _gram_key(gram):
+    key = 0
+    for char in gram:
+        key = key << GRAM_BITS | ord(char)
+    return key
+
+
+def _grams(text):
+    return {text[index : index + GRAM] for index in range(len(text) - GRAM + 1)}
+
+
+# The trigrams a term needs, or None for a term the index cannot answer.
+def term_grams(term):
+    if len(term) < GRAM or term.lower() != term or not _plain_case(term):
+        return None
+    return _grams(term)
+
+
+# rows are (kind, tag, when, url, title), in the order the search should meet
+# them, followed by anything else the builder wants to hand derive. derive(row)
+# returns a row's flags and its FEATURES fields, and sees the row as it is
+# stored, newlines flattened. Returns the file's bytes; writing them somewhere
+# atomic is the caller's business.
+def encode(meta, rows, derive):
+    tags = []
+    tag_ids = {}
+    columns = {name: array(code) for name, code, _ in COLUMNS}
+    parts = []
+    postings = defaultdict(list)
+    loose = array("I")
+    features = []
+    offset = 0
+    char_offset = 0
+    feature_offset = 0
+    for index, row in enumerate(rows):
+        kind, tag, when, url, title = row[:5]
+        url, title = _flat(url), _flat(title)
+        if tag not in tag_ids:
+            tag_ids[tag] = len(tags)
+            tags.append(tag)
+        part = (url + "\n" + title).encode()
+        columns["start"].append(offset)
+        columns["char_start"].append(char_offset)
+        columns["url_len"].append(len(url.encode()))
+        columns["when"].append(when or 0)
+        columns["tag"].append(tag_ids[tag])
+        columns["kind"].append(ord(kind))
+        parts.append(part)
+        offset += len(part) + 1
+        char_offset += len(url) + len(title) + 2
+        flags, fields = derive((kind, tag, when, url, title, *row[5:]))
+        encoded = "".join(_flat(field) + "\n" for field in fields).encode()
+        columns["flags"].append(flags)
+        columns["feature_start"].append(feature_offset)
+        features.append(encoded)
+        feature_offset += len(encoded)
+        if not (_plain_case(url) and _plain_case(title)):
+            loose.append(index)
+            continue
+        # Indexed separately, so no trigram straddles the newline between
+        # them; a term never carries one.
+        for gram in _grams(url.lower()) | _grams(title.lower()):
+            postings[gram].append(index)
+    columns["start"].append(offset)
+    columns["char_start"].append(char_offset)
+    columns["feature_start"].append(feature_offset)
+
+    keys = array("Q")
+    starts = array("I", [0])
+    posted = array("I")
+    for key, gram in sorted((_gram_key(gram), gram) for gram in postings):
+        keys.append(key)
+        posted.extend(postings[gram])
+        starts.append(len(posted))
+
+    meta = dict(meta, tags=tags)
+    meta_bytes = json.dumps(meta).encode()
+    blob = b"\n".join(parts)
+    out = [
+        HEADER.pack(
+            MAGIC, VERSION, len(rows), len(meta_bytes), len(blob), feature_offset,
+            len(keys), len(posted), len(loose),
+        )
+    ]
+    out.append(_padding(HEADER.size))
+    chunks = [meta_bytes] + [columns[name].tobytes() for name, _, _ in COLUMNS]
+    for chunk in chunks + [keys.tobytes(), starts.tobytes(), posted.tobytes(), loose.tobytes()]:
+        out.append(chunk)
+        out.append(_padding(len(chunk)))
+    out.append(blob)
+    out.extend(features)
+    return b"".join(out)
+
+
+class Corpus:
+    """A read only view over an encoded corpus, in memory or mapped."""
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        if len(view) < HEADER.size:
+            raise CorpusError("short header")
+        (
+            magic, version, rows, meta_size, blob_size, feature_size,
+            grams, posted, loose,
+        ) = HEADER.unpack_from(view)
+        if magic != MAGIC or version != VERSION:
+            raise CorpusError("format %r version %d" % (magic, version))
+
+        offset = HEADER.size + -HEADER.size % ALIGN
+        try:
+            self.meta = json.loads(bytes(view[offset : offset + meta_size]))
+        except ValueError as err:
+            raise CorpusError("meta: %s" % err) from None
+        offset += meta_size + -meta_size % ALIGN
+        sections = [(name, code, rows + extra) for name, code, extra in COLUMNS] + [
+            ("gram", "Q", grams),
+            ("gram_start", "I", grams + 1),
+            ("posting", "I", posted),
+            ("loose", "I", loose),
+        ]
+        for name, code, count in sections:
+            size = count * array(code).itemsize
+            if offset + size > len(view):
+                raise CorpusError("truncated at %s" % name)
+            setattr(self, "_" + name, view[offset : offset + size].cast(code))
+            offset += size + -size % ALIGN
+        if offset + blob_size + feature_size != len(view):
+            raise CorpusError(
+                "blob and features are %d bytes, file holds %d"
+                % (blob_size + feature_size, len(view) - offset)
+            )
+        self._blob = view[offset : offset + blob_size]
+        self._features = view[offset + blob_size :]
+        self._whole = None
+        self._rows = rows
+        self.tags = self.meta.get("tags", [])
+
+    def __len__(self):
+        return self._rows
+
+    # One row's url and title, decoded from its own bytes and nothing else.
+    def _text(self, index):
+        return str(self._blob[self._start[index] : self._start[index + 1] - 1], "utf-8")
+
+    def row(self, index):
+        start = self._start[index]
+        split = start + self._url_len[index]
+        blob = self._blob
+        return (
+            chr(self._kind[index]),
+            self.tags[self._tag[index]],
+            self._when[index],
+            str(blob[start:split], "utf-8"),
+            str(blob[split + 1 : self._start[index + 1] - 1], "utf-8"),
+        )
+
+    # (flags, *FEATURES) for one row. Offsets here are bytes, so a row is
+    # decoded on its own and the section never is as a whole.
+    def features(self, index):
+        starts = self._feature_start
+        fields = str(self._features[starts[index] : starts[index + 1]], "utf-8")
+        return (self._flags[index], *fields.split("\n")[:-1])
+
+    def rows(self):
+        for index in range(self._rows):
+            yield self.row(index)
+
+    # Row ids whose url and title carry every term, in corpus order. within,
+    # when given, is a superset of the answer known from elsewhere, ascending:
+    # only those rows are looked at. rows, when given, is a (first, end) range
+    # the answer is confined to, which is how one search is split into shards.
+    def matching(self, ranker, within=None, rows=None):
+        first, end = rows or (0, self._rows)
+        grams = set()
+        for term in ranker.terms:
+            grams |= term_grams(term) or set()
+        if grams:
+            candidates = self._candidates(grams)
+            if rows is not None:
+                candidates = candidates[
+                    bisect.bisect_left(candidates, first) : bisect.bisect_left(candidates, end)
+                ]
+            if within is not None:
+                allowed = set(within)
+                candidates = [index for index in candidates if index in allowed]
+        elif within is not None:
+            candidates = within
+            if rows is not None:
+                candidates = candidates[
+                    bisect.bisect_left(within, first) : bisect.bisect_left(within, end)
+                ]
+        else:
+            return self._scan(ranker, first, end)
+        return [index for index in candidates if ranker.matches_in(self._text(index))]
+
+    # The rows holding every one of the trigrams, plus the loose rows. Posting
+    # lists are walked rarest first, and once the survivors are few each later
+    # list is probed by binary search rather than read whole.
+    def _candidates(self, grams):
+        keys, bounds, posting = self._gram, self._gram_start, self._posting
+        ranges = []
+        for gram in grams:
+            key = _gram_key(gram)
+            slot = bisect.bisect_left(keys, key)
+            if slot == len(keys) or keys[slot] != key:
+                ranges = []
+                break
+            ranges.append((bounds[slot + 1] - bounds[slot], bounds[slot]))
+        found = []
+        if ranges:
+            ranges.sort()
+            count, low = ranges[0]
+            found = posting[low : low + count].tolist()
+            for count, low in ranges[1:]:
+                if not found:
+                    break
+                high = low + count
+                if len(found) * 16 < count:
+                    kept = []
+                    for index in found:
+                        low = bisect.bisect_left(posting, index, low, high)
+                        if low < high and posting[low] == index:
+                            kept.append(index)
+                    found = kept
+                else:
+                    members = set(posting[low:high].tolist())
+                    found = [index for index in found if index in members]
+        if len(self._loose):
+            found = sorted(set(found).union(self._loose.tolist()))
+        return found
+
+    # The slow path: rows first to end are decoded together and the anchor is
+    # searched across them, and a hit jumps the search to the next row, so a
+    # term a row repeats twenty times costs one search, not twenty. Positions
+    # in the decoded text are characters, so rows are found by char_start,
+    # less where the text begins. A scan of every row keeps what it decoded,
+    # for the next one in a process that lives past this search.
+    def _scan(self, ranker, first, end):
+        anchor = ranker.anchor()
+        if anchor is None:
+            return list(range(first, end))
+        if first == 0 and end == self._rows:
+            if self._whole is None:
+                self._whole = str(self._blob, "utf-8")
+            text = self._whole
+        else:
+            text = str(self._blob[self._start[first] : self._start[end]], "utf-8")
+        starts = self._char_start
+        base = starts[first]
+        found = []
+        position = 0
+        stop = starts[end] - base
+        while True:
+            hit = anchor.search(text, position, stop)
+            if hit is None:
+                return found
+            index = bisect.bisect_right(starts, hit.start() + base, first, end) - 1
+            row_end = starts[index + 1] - 1 - base
+            if ranker.matches_in(text[starts[index] - base : row_end]):
+                found.append(index)
+            position = row_end + 1
+
+
+def open_corpus(path):
+    with open(path, "rb") as handle:
+        try:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap refuses an empty file, which is no corpus either.
+            raise CorpusError("empty file") from None
+    return Corpus(mapped)
@@ -34,6 +34,7 @@ which is what the extension does: a bookmark has no visit time to be recent
 about.
 """
 
+import heapq
 import re
 
 # Three is the largest boost a single term can earn, so 3 * term count
@@ -45,6 +46,10 @@ EMPTY_QUERY_BOOST = 0.01
 # 18144e5 milliseconds, the window ComputeRecency scores within.
 RECENCY_WINDOW_MS = 1814400000
 
+# Below this many rows score_batch() scores row by row: NumPy's per call
+# overhead, and importing it at all, outweigh what the columns save.
+BATCH_MIN = 256
+
 # The two constants ComputeRecency multiplies and clamps by.
 RECENCY_PEAK = 0.666667
 RECENCY_CLAMP = 0.666446
@@ -81,14 +86,68 @@ def coverage(matched, length):
     return matched / length if matched < length else length / matched
 
 
+# coverage() over two columns. Both quotients are taken only where they are
+# the one coverage() would pick, so no row divides by zero.
+def _coverage_column(np, matched, length):
+    covered = np.zeros_like(matched)
+    hit = (matched > 0) & (length > 0)
+    np.divide(matched, length, out=covered, where=hit & (matched < length))
+    np.divide(length, matched, out=covered, where=hit & (matched >= length))
+    return covered
+
+
+# NumPy when it is installed, imported on the first batch big enough to want
+# it, so a narrow query never pays for loading it.
+_np = []
+
+
+def _numpy():
+    if not _np:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _np.append(numpy)
+    return _np[0]
+
+
+# What `\b` counts as a word character in a str pattern.
+def _word(char):
+    return char.isalnum() or char == "_"
+
+
+# Whether a `\b` holds at this position: a word character on exactly one side,
+# with the ends of the string counting as non-word.
+def _boundary(text, position):
+    before = position > 0 and _word(text[position - 1])
+    after = position < len(text) and _word(text[position])
+    return before != after
+
+
+# The only characters a case insensitive regex matches against an ascii letter
+# that lowercasing does not turn into that letter, or that lowercase to
+# something longer: dotted and dotless I, the long s, the Kelvin sign. Found by
+# running every code point through both.
+FOLD_TRAPS = re.compile("[\u0130\u0131\u017f\u212a]")
+
+
+# The string lowercased, for finding ascii terms the way the case insensitive
+# regex would, or None when it carries a character where the two disagree.
+def _fold(text):
+    if text.isascii() or not FOLD_TRAPS.search(text):
+        return text.lower()
+    return None
+
+
 class Ranker:
     """One query's compiled terms. Reused across every row being scored."""
 
     def __init__(self, terms, now_ms):
         self.terms = [term for term in terms if term]
         self._plain = []
-        self._prefix = []
-        self._whole = []
+        self._ahead = []
+        self._insensitive = []
+        self._ascii = []
         for term in self.terms:
             # `term !== term.toUpperCase() && term.toLowerCase() === term`:
             # a term carrying a capital is matched case sensitively, which is
@@ -97,8 +156,11 @@ class Ranker:
             flags = re.IGNORECASE if smart_case else 0
             escaped = re.escape(term)
             self._plain.append(re.compile(escaped, flags))
-            self._prefix.append(re.compile(r"\b" + escaped, flags))
-            self._whole.append(re.compile(r"\b" + escaped + r"\b", flags))
+            # A lookahead matches empty, so finditer steps one character at a
+            # time and reports overlapping occurrences too.
+            self._ahead.append(re.compile("(?=" + escaped + ")", flags))
+            self._insensitive.append(smart_case)
+            self._ascii.append(term.isascii())
         self._max_boost = MAX_TERM_BOOST * len(self.terms) or EMPTY_QUERY_BOOST
         self._recency_base = now_ms - RECENCY_WINDOW_MS
 
@@ -120,33 +182,123 @@ class Ranker:
                 return False
         return True
 
+    # True when every string matching this query is sure to have matched the
+    # previous one too, which is what lets a caller rank only the previous
+    # query's survivors: each earlier term has to sit inside some term of this
+    # one. An earlier term smart case matched insensitively may sit inside a
+    # later one carrying a capital ("kube" inside "Kuber"), which lowercasing
+    # settles for ascii; any other case falls back to a full scan.
+    def narrows(self, previous):
+        for earlier in previous:
+            insensitive = earlier != earlier.upper() and earlier.lower() == earlier
+            if not any(
+                earlier in term
+                or (insensitive and term.isascii() and earlier in term.lower())
+                for term in self.terms
+            ):
+                return False
+        return True
+
+    # The pattern of the longest term, which is the likeliest to be rare. For
+    # callers holding a whole corpus as one string: they find where this lands
+    # and check only the row it landed in against matches_in, instead of
+    # running every term over every row.
+    def anchor(self):
+        if not self.terms:
+            return None
+        longest = max(range(len(self.terms)), key=lambda index: len(self.terms[index]))
+        return self._plain[longest]
+
     # Returns the term's boost and how many characters of the string it covers.
     # The boost floor of 1 is the extension's: a term that never appears still
     # contributes, which keeps a two term query from collapsing to the score of
     # whichever term happened to hit.
-    def _term_stats(self, index, text):
-        occurrences = len(self._plain[index].split(text)) - 1
+    #
+    # One pass over where the term lands gives all three things the extension
+    # finds with a split and two more searches: occurrences counted the way
+    # split counts them, left to right without overlap, +1 for an occurrence
+    # on a `\b`, +1 more for one with a `\b` at its end as well.
+    #
+    # folded is the string from _fold, or None where lowercasing it could not
+    # stand in for the regex. A term matched case sensitively, or an ascii term
+    # matched insensitively against a folded string, is found with str.find;
+    # anything else takes the lookahead.
+    def _term_stats(self, index, text, folded):
+        term = self.terms[index]
+        size = len(term)
+        haystack = self._haystack(index, text, folded)
+        if haystack is None:
+            positions = [found.start() for found in self._ahead[index].finditer(text)]
+        else:
+            positions = []
+            position = haystack.find(term)
+            while position >= 0:
+                positions.append(position)
+                position = haystack.find(term, position + 1)
+        occurrences = 0
+        free = 0
         boost = 1
-        if self._prefix[index].search(text):
-            boost = 2
-            if self._whole[index].search(text):
-                boost = 3
-        return boost, occurrences * len(self.terms[index])
+        for position in positions:
+            if position >= free:
+                occurrences += 1
+                free = position + size
+            if boost < 3 and _boundary(text, position):
+                boost = 3 if _boundary(text, position + size) else 2
+        return boost, occurrences * size
 
-    def word_relevancy(self, text, title):
+    # The string str.find can search for the term, or None for the regex.
+    def _haystack(self, index, text, folded):
+        if not self._insensitive[index]:
+            return text
+        return folded if self._ascii[index] else None
+
+    # What _term_stats covers, without finding a single position: split's
+    # count is str.count's, both left to right without overlap.
+    def _term_chars(self, index, text, folded):
+        haystack = self._haystack(index, text, folded)
+        if haystack is None:
+            return len(self._plain[index].findall(text)) * len(self.terms[index])
+        return haystack.count(self.terms[index]) * len(self.terms[index])
+
+    # Summed boosts and covered characters, url then title. The title's stay 0
+    # when there is no title, which is also how the combine step tells.
+    def _word_stats(self, text, title):
         url_boost = url_chars = title_boost = title_chars = 0
+        text_folded = _fold(text)
+        title_folded = _fold(title)
         for index in range(len(self.terms)):
-            boost, chars = self._term_stats(index, text)
+            boost, chars = self._term_stats(index, text, text_folded)
             url_boost += boost
             url_chars += chars
             if title:
-                boost, chars = self._term_stats(index, title)
+                boost, chars = self._term_stats(index, title, title_folded)
                 title_boost += boost
                 title_chars += chars
-        url_score = url_boost / self._max_boost * coverage(url_chars, len(text))
+        return url_boost, url_chars, title_boost, title_chars
+
+    # _word_stats with every term given the top boost, and so a score no lower
+    # than the row's own: the coverage is exact, and both combine steps only
+    # ever grow with the boosts. Costs a str.count per term per string.
+    def _bound_stats(self, text, title):
+        url_chars = title_chars = 0
+        text_folded = _fold(text)
+        title_folded = _fold(title) if title else None
+        for index in range(len(self.terms)):
+            url_chars += self._term_chars(index, text, text_folded)
+            if title:
+                title_chars += self._term_chars(index, title, title_folded)
+        top = MAX_TERM_BOOST * len(self.terms)
+        return top, url_chars, top if title else 0, title_chars
+
+    def word_relevancy(self, text, title):
+        return self._word_score(self._word_stats(text, title), len(text), len(title))
+
+    def _word_score(self, stats, text_len, title_len):
+        url_boost, url_chars, title_boost, title_chars = stats
+        url_score = url_boost / self._max_boost * coverage(url_chars, text_len)
         if title_chars == 0:
-            return url_score / 2 if title else url_score
-        title_score = title_boost / self._max_boost * coverage(title_chars, len(title))
+            return url_score / 2 if title_len else url_score
+        title_score = title_boost / self._max_boost * coverage(title_chars, title_len)
         if url_score < title_score:
             return title_score
         return (url_score + title_score) / 2
@@ -162,6 +314,110 @@ class Ranker:
         return 0.0
 
     def relevancy(self, text, title, when_ms):
+        return self._blend(self.word_relevancy(text, title), when_ms)
+
+    def _blend(self, relevant, when_ms):
         recent = self.recency(when_ms)
-        relevant = self.word_relevancy(text, title)
         return relevant if recent <= relevant else (relevant + recent) / 2
+
+    # relevancy() for a whole column of rows at once: texts, titles and visit
+    # times in milliseconds, 0 for a row with none, which scores exactly what
+    # word_relevancy() does since recency is then 0. Returns a list of floats.
+    #
+    # The term stats are string work and stay a Python loop. Everything after
+    # them, coverage, the url and title combine, recency and the final blend,
+    # is arithmetic on columns, which NumPy does in a few passes once a query
+    # is broad enough to match thousands of rows. Without NumPy, or below
+    # BATCH_MIN rows where importing it would cost more than it saves, each
+    # row goes through the same steps as relevancy(). Both give identical
+    # floats: the operations are the same IEEE doubles in the same order.
+    def score_batch(self, texts, titles, when_ms):
+        stats = [self._word_stats(text, title) for text, title in zip(texts, titles)]
+        return self._combine(stats, texts, titles, when_ms)
+
+    # The best score each row could reach, never below what score_batch gives
+    # it, for far less than scoring it: see _bound_stats.
+    def bound_batch(self, texts, titles, when_ms):
+        stats = [self._bound_stats(text, title) for text, title in zip(texts, titles)]
+        return self._combine(stats, texts, titles, when_ms)
+
+    # The best limit rows, as (row, score) pairs in rank order: lowest group
+    # first, then highest score, then earliest row, which is what sorting
+    # every row would give. groups is a column of small ints, whatever the
+    # caller needs kept above the ranking.
+    #
+    # Rows are scored in order of their bounds, a batch at a time, into a heap
+    # holding the limit best so far. Once the next row's bound cannot beat the
+    # worst row held, no later row can either, and the rest are never scored.
+    # A broad query keeping thousands of rows scores a few hundred of them.
+    #
+    # stop, when given, is asked before every batch, and a true answer gives
+    # up on the ranking: nothing comes back.
+    def top(self, texts, titles, when_ms, groups, limit, stop=None):
+        if limit <= 0:
+            return []
+        bounds = self.bound_batch(texts, titles, when_ms)
+        order = sorted(range(len(texts)), key=lambda row: (groups[row], -bounds[row]))
+        # Keyed (-group, score, -row), so the worst row held is the smallest.
+        held = []
+        step = max(limit, BATCH_MIN)
+        start = 0
+        while start < len(order):
+            if len(held) == limit:
+                group, score, _ = held[0]
+                row = order[start]
+                # Equal is not enough to stop: a tie goes to the earlier row.
+                if (groups[row], -bounds[row]) > (-group, -score):
+                    break
+            if stop is not None and stop():
+                return []
+            batch = order[start : start + step]
+            start += len(batch)
+            scores = self.score_batch(
+                [texts[row] for row in batch],
+                [titles[row] for row in batch],
+                [when_ms[row] for row in batch],
+            )
+            for row, score in zip(batch, scores):
+                item = (-groups[row], score, -row)
+                if len(held) < limit:
+                    heapq.heappush(held, item)
+                elif item > held[0]:
+                    heapq.heapreplace(held, item)
+        return [(-row, score) for _, score, row in sorted(held, reverse=True)]
+
+    # The word scores of rows already reduced to their stats, blended with
+    # recency.
+    def _combine(self, stats, texts, titles, when_ms):
+        np = _numpy() if len(stats) >= BATCH_MIN else None
+        if np is None:
+            return [
+                self._blend(self._word_score(row, len(text), len(title)), when)
+                for row, text, title, when in zip(stats, texts, titles, when_ms)
+            ]
+        stats = np.array(stats, dtype=np.float64).reshape(-1, 4)
+        url_boost, url_chars, title_boost, title_chars = stats.T
+        url_len = np.fromiter(map(len, texts), np.float64, len(texts))
+        title_len = np.fromiter(map(len, titles), np.float64, len(titles))
+
+        url_score = url_boost / self._max_boost * _coverage_column(np, url_chars, url_len)
+        title_score = (
+            title_boost / self._max_boost * _coverage_column(np, title_chars, title_len)
+        )
+        relevant = np.where(
+            title_chars == 0,
+            np.where(title_len > 0, url_score / 2, url_score),
+            np.where(url_score < title_score, title_score, (url_score + title_score) / 2),
+        )
+
+        age = (np.asarray(when_ms, dtype=np.float64) - self._recency_base) / RECENCY_WINDOW_MS
+        recent = np.where(
+            age < 0,
+            0.0,
+            np.where(
+                age < 1,
+                age * age * RECENCY_PEAK,
+                np.where(age < RECENCY_SLACK, RECENCY_CLAMP, 0.0),
+            ),
+        )
+        return np.where(recent <= relevant, relevant, (relevant + recent) / 2).tolist()
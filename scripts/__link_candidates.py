@@ -17,10 +17,19 @@ corpus far wider than the list above: every history row in every profile, plus
 the browser's own bookmarks, not the recent few hundred. Vimium C's omnibox
 found pages this picker could not, and this is why.
 
-The corpus is cached, because rebuilding it per keystroke means copying a
-hundred megabytes of locked sqlite. The cache is rebuilt when a source database
-has moved on and the cache is older than the ttl. Pins and snippets are always
-read live, so a ctrl-f pin shows up on the next keystroke.
+The corpus is cached, because rebuilding it per keystroke means reading a
+hundred megabytes of locked sqlite. A database is read in place when its
+browser's lock allows it and copied only when it does not, and what each path
+needed is remembered beside the corpus. The cache is refreshed when a source
+database has moved on and the cache is older than the ttl, and a refresh asks
+each profile only for the visits after the newest one it already holds. With
+the link-picker-watch unit running, inotify refreshes it instead, seconds
+after a visit, and a keystroke reads the watcher's generation rather than
+statting every profile. Pins and snippets are always read live, so a ctrl-f
+pin shows up on the next keystroke; live meaning their stat, since the parsed
+snippets toml, like Chrome's Bookmarks json, is kept beside the corpus until
+the file moves. The cache is a binary file searched through mmap, laid out in
+__lib_link_corpus.py.
 
 Settings live in __link_picker.conf, because the picker runs from a global
 hotkey and that process carries none of the shell environment. The variables
@@ -36,33 +45,60 @@ Environment:
   LINK_PINS_FILE         pinned rows (default ~/.local/state/link-picker/pins)
   LINK_CORPUS_FILE       search corpus cache (default ~/.local/state/link-picker/corpus)
   LINK_CORPUS_TTL        seconds before the cache may be rebuilt (default 300)
+  LINK_CORPUS_REFRESH    inline or background, who waits for a rebuild (default inline)
   LINK_SEARCH_LIMIT      how many ranked rows to return (default 200)
+  LINK_RESULT_CACHE      how many answered searches to keep for a repeat, 0 for none (default 256)
+  LINK_SHARD_ROWS        corpus rows from which a search is split across processes (default 250000)
+  LINK_SHARD_WORKERS     how many processes a split search uses (default one per cpu)
   LINK_BOOKMARKS         set to 0 to drop browser bookmarks from the corpus
+  LINK_PICKER_SOCKET     where --serve listens (default server.sock beside the corpus)
+  LINK_SERVER_IDLE       seconds without a request before --serve exits (default 900)
+  LINK_WATCH_QUIET       seconds a profile stays quiet before --watch rebuilds (default 2)
+  LINK_WATCH_LATEST      seconds of constant writes after which it rebuilds anyway (default 15)
+  LINK_PICKER_TRACE      append per phase timings of every request to this file, as json lines
 
 Subcommands:
   --toggle-pin <line>    pin or unpin the row, called from the ctrl-f binding
   --query <string>       ranked search; an empty string gives the default list
+  --serve                stay resident and answer the two above over a unix socket
+  --export-corpus        print the cached corpus as tab separated text, for debugging
+  --rebuild              refresh the corpus if it is stale; what background refresh runs
+  --prewarm              --rebuild, then parse the snippets and cache the default list
+  --watch                keep the corpus fresh from inotify, as the link-picker-watch unit
+  --trace-summary [file] p50/p95/p99 per phase of a LINK_PICKER_TRACE file
+
+Every keystroke used to start this script afresh, and interpreter startup, the
+conf, the snippets toml and a seventy thousand line corpus were paid for before
+the ranking saw a row. --serve keeps all of that parsed in one long lived
+process, and __link_client.py is the tiny thing the runner calls instead: it
+hands the request over the socket, or starts the server and runs this script
+directly when nothing is listening yet.
 """
 
+# Only what a warm --query needs is imported here: this runs once per
+# keystroke, and reading databases, parsing toml and serving a socket import
+# what they need where they need it. test_link_candidates.py holds the warm
+# path to an import budget.
+import fcntl
 import glob
 import json
+import marshal
 import os
 import re
 import shlex
-import shutil
 import signal
-import sqlite3
 import sys
-import tempfile
+import threading
 import time
-import tomllib
-from collections import Counter
-from urllib.parse import urlsplit
+import zlib
+from array import array
+from urllib.parse import quote, urlsplit
 
 # Run as a script, so sys.path already carries this directory; the insert is
 # for the case where something imports this file by path instead.
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+import __lib_link_corpus as linkcorpus  # noqa: E402
 import __lib_vimium_rank as vimium  # noqa: E402
 
 SNIPPET_FILE = os.environ.get(
@@ -82,11 +118,63 @@ DEFAULT_PINS_FILE = "~/.local/state/link-picker/pins"
 # in the repo, for the same reason.
 DEFAULT_CORPUS_FILE = "~/.local/state/link-picker/corpus"
 
+# The resident server lives beside the corpus by default, so a test run that
+# points LINK_CORPUS_FILE at a scratch directory gets a server of its own.
+# __link_client.py derives the same path without reading the conf, which is why
+# only the environment can move it.
+DEFAULT_STATE_DIR = "~/.local/state/link-picker"
+SOCKET_NAME = "server.sock"
+# Beside the socket: the generation of the newest --query, see superseded_by.
+GENERATION_NAME = "query.generation"
+GENERATION_ENV = "LINK_QUERY_GENERATION"
+# Seconds between two looks at the generation file while a search runs.
+GENERATION_POLL = 0.01
+# Corpus rows matched between two of those looks, at most.
+GENERATION_ROWS = 2048
+
+# Long enough to span a working session of picker use, short enough that a
+# server started by a one-off run does not sit in memory for the rest of the day.
+DEFAULT_SERVER_IDLE = "900"
+
 # A running browser touches its history write ahead log constantly, so mtime
 # alone would rebuild the corpus on every keystroke. This is the floor between
 # rebuilds; within it the picker searches whatever it already has.
 DEFAULT_CORPUS_TTL = "300"
 
+# How many answered searches are kept on disk for a repeat of the same query.
+DEFAULT_RESULT_CACHE = "256"
+# Seconds an answer stays good for. History is ranked with its visit time
+# against now, over a 21 day window, so ten minutes move no score far, but an
+# answer kept all day would rank the morning's visits as if they were fresh.
+RESULT_BUCKET = 600
+
+# A corpus of at least this many rows is searched in contiguous shards, one per
+# worker process. Below it one core answers faster than workers can be handed
+# the work; 0 never shards.
+DEFAULT_SHARD_ROWS = "250000"
+
+# --watch rebuilds once a profile has been quiet this many seconds after a
+# write, or this many after the first write of a burst that never goes quiet,
+# which is a browser in use: its log is written on every page load.
+DEFAULT_WATCH_QUIET = "2"
+DEFAULT_WATCH_LATEST = "15"
+# Seconds between two looks at whether the conf or this script has changed.
+WATCH_CHECK = 5.0
+# inotify(7): the directory events that can mean a database, its log or the
+# Bookmarks file moved on. sqlite writes in place, a browser writes Bookmarks
+# aside and renames it over, and a log comes and goes with checkpoints.
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# "inline": the process that wins the rebuild lock rebuilds before it answers.
+# "background": every process answers out of the corpus it has and a detached
+# rebuild replaces it, so no keystroke waits once any corpus exists.
+DEFAULT_CORPUS_REFRESH = "inline"
+
 # Used when the conf file names no profiles: every profile on the machine,
 # under one tag, which is the behaviour before the work/home split existed.
 DEFAULT_DB_GLOBS = [
@@ -120,6 +208,29 @@ CHROME_QUERY = """
 FIREFOX_ALL_QUERY = FIREFOX_QUERY.replace("order by last_visit_date desc limit ?", "")
 CHROME_ALL_QUERY = CHROME_QUERY.replace("order by last_visit_time desc limit ?", "")
 
+# A refresh asks only for what was visited after the newest visit the corpus
+# already holds. The mark is read in the raw column units, so no float ever
+# stands between one refresh and the next.
+FIREFOX_SINCE_QUERY = FIREFOX_ALL_QUERY + "      and last_visit_date > ?\n"
+CHROME_SINCE_QUERY = CHROME_ALL_QUERY + "      and last_visit_time > ?\n"
+FIREFOX_MARK_QUERY = FIREFOX_ALL_QUERY.replace(
+    "url, title, last_visit_date / 1000000.0", "max(last_visit_date)"
+)
+CHROME_MARK_QUERY = CHROME_ALL_QUERY.replace(
+    "url, title, last_visit_time / 1000000.0 - 11644473600", "max(last_visit_time)"
+)
+
+# Expiry and "forget this page" delete rows, which no visit mark can see. A
+# new page only ever lands past the largest rowid, so a table still holding
+# every row the corpus knows counts what it counted then plus what lies past
+# that rowid; fewer, and some are gone. The url at that rowid has to be the
+# one it was, too, or the file is another database, or a new page took the
+# rowid of a deleted one. Filled in with the table, moz_places or urls.
+ID_MARK_QUERY = (
+    "select count(*), max(rowid), count(case when rowid > ? then 1 end) from %s"
+)
+ID_URL_QUERY = "select url from %s where rowid = ?"
+
 # A bookmark's own title is what was typed when it was saved, so it beats the
 # page title; the page title is the fallback for a bookmark saved unnamed.
 FIREFOX_BOOKMARK_QUERY = """
@@ -128,6 +239,14 @@ FIREFOX_BOOKMARK_QUERY = """
     where mark.type = 1 and place.url like 'http%'
 """
 
+# Bookmarks are few, so they are reread whole whenever this moves, rather than
+# merged. A new bookmark moves the largest rowid, a deleted one the count, and
+# a renamed one, or one pointed at another url, only its lastModified, which
+# Firefox stamps on every edit.
+FIREFOX_BOOKMARK_MARK_QUERY = (
+    "select max(rowid), count(*), max(lastModified) from moz_bookmarks"
+)
+
 TITLE_WIDTH = 68
 URL_WIDTH = 95
 
@@ -154,6 +273,90 @@ UNREAD_BADGE = re.compile(r"^\(\d+\)\s*")
 XDG_OPEN_URL = re.compile(r'\s*xdg-open\s+"?([^"\s]+)')
 
 
+# Parsed files, keyed by what stat says about them. A one-shot run reads each
+# file once either way; the resident server answers every keystroke out of here
+# until one of them actually changes on disk.
+_parsed = {}
+
+
+def stat_key(path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size, info.st_ino)
+
+
+# The key is taken before the parse, so a file rewritten mid-read is read again
+# next time rather than cached under its new stat.
+def parsed(path, parse):
+    key = stat_key(path)
+    hit = _parsed.get(path)
+    if key is not None and hit is not None and hit[0] == key:
+        return hit[1]
+    value = parse()
+    _parsed[path] = (key, value)
+    return value
+
+
+def remember(path, value):
+    _parsed[path] = (stat_key(path), value)
+
+
+# The same memo, kept on disk for a one-shot run, which starts with it empty:
+# one marshal file of {path: (stat key, value)} under the stat of this script,
+# so an edit to a parser starts it over. store is that file. A source only
+# costs its stat while it has not moved; one that is gone is never stored.
+# Profiles are read on threads, hence the lock around the read and rewrite.
+_store_lock = threading.Lock()
+
+
+def stored(store, path, parse):
+    def load():
+        key = stat_key(path)
+        with _store_lock:
+            hit = load_store(store).get(path)
+        if key is not None and hit is not None and tuple(hit[0]) == key:
+            return hit[1]
+        value = parse()
+        if key is not None:
+            with _store_lock:
+                entries = dict(load_store(store))
+                entries[path] = (key, value)
+                save_store(store, entries)
+        return value
+
+    return parsed(path, load)
+
+
+def load_store(store):
+    return parsed(store, lambda: read_store(store))
+
+
+def read_store(store):
+    try:
+        with open(store, "rb") as handle:
+            script, entries = marshal.load(handle)
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+    if script != stat_key(os.path.abspath(__file__)) or not isinstance(entries, dict):
+        return {}
+    return entries
+
+
+def save_store(store, entries):
+    scratch = "%s.%d" % (store, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(store) or ".", exist_ok=True)
+        with open(scratch, "wb") as handle:
+            marshal.dump((stat_key(os.path.abspath(__file__)), entries), handle)
+        os.replace(scratch, store)
+    except OSError as err:
+        print("link candidates: %s: %s" % (store, err), file=sys.stderr)
+        return
+    remember(store, entries)
+
+
 # Strip the noise a browser tab title carries: the unread counter Notion and
 # Gmail prepend, and the trailing app name.
 def clean_title(title):
@@ -179,6 +382,76 @@ def dedupe_key(url):
     return key.lower()
 
 
+# Flag bits a corpus row carries beside its features. ROW_MARK is a history
+# row of a page the same profile also has a bookmark of.
+ROW_NOISE = 1
+ROW_MARK = 2
+
+
+# What the search needs from a corpus row besides matching it, worked out once
+# when the corpus is built instead of for every hit on every keystroke. The
+# fields are linkcorpus.FEATURES, in order.
+# The row may carry flags of its own as a sixth field, which build_corpus sets
+# for a history row that is also bookmarked.
+def row_features(row):
+    kind, _, _, url, title = row[:5]
+    host = urlsplit(url).netloc.lower()
+    title = clean_title(title)
+    flags = row[5] if len(row) > 5 else 0
+    if host in NOISE_HOSTS:
+        flags |= ROW_NOISE
+    return flags, (vimium.shorten_url(url), title, host, dedupe_key(url), title.casefold())
+
+
+# Bumped whenever sift_history keeps a row it used to drop. A corpus built
+# under another version no longer holds those rows, so a refresh cannot merge
+# into it and reads its profiles whole instead.
+SIFT_VERSION = 2
+
+
+# The history rows a search would only ever throw away, dropped once at build
+# time: search engines and login hosts, pages with no title worth showing, and
+# every copy of a page but the newest. The same Notion doc under five query
+# strings is one row, carrying the latest visit, instead of five the search
+# matches and scores before its dedupe discards four. The kept rows stay in
+# the order they came in.
+#
+# Only the page itself, dedupe_key, collapses here. Two dashboards both titled
+# "Grafana" share a title key but not a url, and a query for what sets their
+# urls apart has to find either; the title key is left to the search, which
+# only ever drops a row on it when both rows matched.
+#
+# A dropped url visited again comes back through a refresh like any other and
+# is sifted again, so it costs that refresh nothing more.
+def sift_history(rows):
+    newest = sorted(range(len(rows)), key=lambda index: rows[index][2] or 0, reverse=True)
+    seen = set()
+    kept = []
+    for index in newest:
+        url, title = rows[index][0], rows[index][1] or ""
+        cleaned = clean_title(title)
+        if not cleaned or cleaned == url or urlsplit(url).netloc.lower() in NOISE_HOSTS:
+            continue
+        key = dedupe_key(url)
+        if key in seen:
+            continue
+        seen.add(key)
+        kept.append(index)
+    kept.sort()
+    return [rows[index] for index in kept]
+
+
+# A history row of a page the profile also has a bookmark of is flagged
+# ROW_MARK, so #mark finds the page by its page title too. The bookmark stays a
+# row of its own: its title is what was typed when it was saved, and a query
+# for that has to reach it. When both match, the search's dedupe keeps the
+# history row, which comes first. Only the page itself, dedupe_key, links the
+# two. Returns the flags for each history row.
+def bookmarked_flags(history, marks):
+    marked = {dedupe_key(url) for url, _ in marks}
+    return [ROW_MARK if dedupe_key(url) in marked else 0 for url, _, _ in history]
+
+
 # Snippet commands carry shell escapes (\# and \~ in anchors); undo them for
 # display only. The command itself is passed through untouched.
 def url_from_command(command):
@@ -217,6 +490,10 @@ def pins_path(conf):
 # into history. A page pinned today drops out of the history window within the
 # week, and a pin that quietly stops appearing is worse than no pin.
 def load_pins(path):
+    return parsed(path, lambda: read_pins(path))
+
+
+def read_pins(path):
     pins = []
     try:
         with open(path) as handle:
@@ -254,7 +531,14 @@ def toggle_pin(path, line):
     save_pins(path, kept)
 
 
-def load_snippets():
+# Parsed and sorted once per edit of the toml, not once per keystroke.
+def load_snippets(conf):
+    return stored(store_path(conf), SNIPPET_FILE, read_snippets)
+
+
+def read_snippets():
+    import tomllib
+
     try:
         with open(SNIPPET_FILE, "rb") as handle:
             data = tomllib.load(handle)
@@ -279,6 +563,10 @@ def load_snippets():
 # "key = value", full line comments only. A repeated "profile" key accumulates,
 # which is how one tag can cover several browser profiles.
 def load_conf():
+    return parsed(CONF_FILE, read_conf)
+
+
+def read_conf():
     settings = {}
     profiles = []
     try:
@@ -324,19 +612,176 @@ def history_dbs(profiles):
 
 
 # The live databases are locked while the browser runs, so work on a copy.
-# The write ahead log holds the newest visits, so it has to come along.
+# The write ahead log holds the newest visits, so it has to come along, and a
+# rollback journal lets sqlite undo a write the copy caught halfway.
 def copy_db(path, workdir, index):
+    import shutil
+
     copy = os.path.join(workdir, "%d.db" % index)
     shutil.copy(path, copy)
-    for suffix in ("-wal", "-shm"):
+    for suffix in ("-wal", "-shm", "-journal"):
         if os.path.exists(path + suffix):
             shutil.copy(path + suffix, copy + suffix)
     return copy
 
 
-def db_flavour(conn):
+# The live file opened read only, so sqlite reads only the pages a query
+# touches. With neither a write ahead log nor a rollback journal beside it the
+# file is all there is, and immutable=1 reads it without taking the lock the
+# browser holds. With either, the browser may be writing it: immutable would
+# miss the log's newest visits, or read pages a journaled write is halfway
+# through, so the lock has to be had. timeout=0 because a browser holds its
+# lock for as long as it runs: waiting on it only delays the fallback.
+def open_in_place(path, workdir, index):
+    import sqlite3
+
+    uri = "file:%s?mode=ro" % quote(os.path.abspath(path))
+    if not any(os.path.exists(path + suffix) for suffix in ("-wal", "-journal")):
+        uri += "&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, timeout=0)
+    try:
+        # A locked or unreadable file only says so on the first read.
+        conn.execute("select count(*) from sqlite_master").fetchone()
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return conn
+
+
+# The online backup API, into memory: every page is read, but nothing is
+# written to disk, and the log's visits come with it. backup() retries a busy
+# or locked source forever, so the progress callback, which sees every step's
+# status, gives up on the first one.
+def open_backup(path, workdir, index):
+    import sqlite3
+
+    def give_up_when_locked(status, remaining, total):
+        if status in (SQLITE_BUSY, SQLITE_LOCKED):
+            raise sqlite3.OperationalError("database is locked")
+
+    source = sqlite3.connect(
+        "file:%s?mode=ro" % quote(os.path.abspath(path)), uri=True, timeout=0
+    )
+    conn = sqlite3.connect(":memory:")
+    try:
+        source.backup(conn, progress=give_up_when_locked)
+    except sqlite3.Error:
+        conn.close()
+        raise
+    finally:
+        source.close()
+    return conn
+
+
+def open_copy(path, workdir, index):
+    import sqlite3
+
+    return sqlite3.connect(copy_db(path, workdir, index))
+
+
+# Result codes a backup step reports while the source is held elsewhere.
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+
+
+# Cheapest first. A database that needed a copy last time would fail the same
+# way again while its browser runs, so readers, which remembers per path what
+# worked and since when, makes the next run start there instead of failing its
+# way down. Only for READER_RETRY seconds, though: the browser may have closed
+# since, or the lock been a passing one, and then in place is worth another try.
+DB_READERS = (("uri", open_in_place), ("backup", open_backup), ("copy", open_copy))
+READER_RETRY = 900
+
+
+# The reader the memo says to start at, if it has not run out.
+def remembered_reader(readers, path):
+    try:
+        name, since = readers[path]
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not isinstance(since, (int, float)) or time.time() - since >= READER_RETRY:
+        return None
+    return name
+
+
+# Opens path with the first reader that works and runs read(conn) on it. The
+# reads are inside the fallback, not after it: a lock or a torn page can as
+# well surface on the history query as on opening, and either way the next
+# reader is tried rather than the profile lost. Returns what read returned and
+# the name of the reader that gave it.
+def query_db(path, workdir, index, readers, read):
+    import sqlite3
+
+    names = [name for name, _ in DB_READERS]
+    memo = remembered_reader(readers, path)
+    start = names.index(memo) if memo in names else 0
+    for name, opener in DB_READERS[start:]:
+        try:
+            conn = opener(path, workdir, index)
+            try:
+                found = read(conn)
+            finally:
+                conn.close()
+        except (OSError, sqlite3.Error):
+            if name == names[-1]:
+                raise
+            continue
+        # Kept as it was when the memo held: its age is what runs it out.
+        if name != memo:
+            readers[path] = [name, time.time()]
+        return found, name
+
+
+# Where query_db's choices are kept between runs: beside the corpus.
+def readers_path(conf):
+    return corpus_path(conf) + ".readers"
+
+
+# A copy, so a run's choices only reach the memo through save_readers.
+def load_readers(path):
+    return dict(parsed(path, lambda: read_readers(path)))
+
+
+def read_readers(path):
+    try:
+        with open(path) as handle:
+            readers = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+    return readers if isinstance(readers, dict) else {}
+
+
+def save_readers(path, readers):
+    if readers == load_readers(path):
+        return
+    scratch = "%s.%d" % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(scratch, "w") as handle:
+            json.dump(readers, handle, indent=1, sort_keys=True)
+        os.replace(scratch, path)
+    except OSError as err:
+        print("link candidates: %s: %s" % (path, err), file=sys.stderr)
+        return
+    remember(path, readers)
+
+
+def db_tables(conn):
     tables = conn.execute("select name from sqlite_master where type = 'table'")
-    names = {row[0] for row in tables}
+    return {row[0] for row in tables}
+
+
+def has_table(conn, name):
+    return name in db_tables(conn)
+
+
+def row_url(conn, table, rowid):
+    found = conn.execute(ID_URL_QUERY % table, (rowid,)).fetchone()
+    return found and found[0]
+
+
+def db_flavour(conn):
+    names = db_tables(conn)
     if "moz_places" in names:
         return "firefox"
     if "urls" in names:
@@ -344,44 +789,147 @@ def db_flavour(conn):
     return ""
 
 
-def read_db(path, workdir, index, limit):
-    conn = sqlite3.connect(copy_db(path, workdir, index))
-    try:
+def read_db(path, workdir, index, limit, readers):
+    def read(conn):
         flavour = db_flavour(conn)
         if not flavour:
             return []
         query = FIREFOX_QUERY if flavour == "firefox" else CHROME_QUERY
         return conn.execute(query, (limit,)).fetchall()
-    finally:
-        conn.close()
+
+    return query_db(path, workdir, index, readers, read)[0]
+
+
+# The schema a profile was read under. Firefox keeps it in user_version,
+# Chrome in its meta table; a browser update that moves it is a full reread.
+def db_schema(conn, flavour):
+    import sqlite3
+
+    if flavour == "chrome":
+        try:
+            found = conn.execute("select value from meta where key = 'version'").fetchone()
+        except sqlite3.Error:
+            found = None
+        if found:
+            return str(found[0])
+    return str(conn.execute("pragma user_version").fetchone()[0])
+
+
+# A url visited again replaces its old row in place, so its visit time moves
+# forward without the row moving in the corpus order.
+def merge_history(known, fresh):
+    merged = list(known)
+    where = {row[0]: index for index, row in enumerate(merged)}
+    for row in fresh:
+        if row[0] in where:
+            merged[where[row[0]]] = row
+        else:
+            where[row[0]] = len(merged)
+            merged.append(row)
+    return merged
 
 
 # Every history row, and every bookmark the same profile holds. Chrome keeps
 # its bookmarks in a json file beside the history database rather than in it.
-def read_db_corpus(path, workdir, index, bookmarks_on):
-    conn = sqlite3.connect(copy_db(path, workdir, index))
-    try:
+#
+# known is what the corpus already holds for this profile. When its schema still
+# matches and no row it holds has left the table, only visits past its
+# high-water mark are read and merged in, and the bookmarks are kept unless
+# their own mark moved. Returns the profile's new
+# state alongside its rows, or None for a file that is not a history database.
+def read_db_corpus(path, workdir, index, bookmarks_on, readers, store, known=None):
+    def read(conn):
         flavour = db_flavour(conn)
         if not flavour:
-            return [], []
-        query = FIREFOX_ALL_QUERY if flavour == "firefox" else CHROME_ALL_QUERY
-        history = conn.execute(query).fetchall()
+            return None, [], []
+        firefox = flavour == "firefox"
+        state = {
+            "flavour": flavour,
+            "schema": db_schema(conn, flavour),
+            "sift": SIFT_VERSION,
+        }
+        (state["visit"],) = conn.execute(
+            FIREFOX_MARK_QUERY if firefox else CHROME_MARK_QUERY
+        ).fetchone()
+        since = known and {
+            key: known["state"].get(key) for key in ("flavour", "schema", "sift")
+        } == {key: state[key] for key in ("flavour", "schema", "sift")}
+        table = "moz_places" if firefox else "urls"
+        ids = since and known["state"].get("ids")
+        count, top, added = conn.execute(
+            ID_MARK_QUERY % table, ((ids[1] or 0) if ids else 0,)
+        ).fetchone()
+        state["ids"] = [count, top, row_url(conn, table, top)]
+        # Only a table that lost nothing the corpus holds can be merged into
+        # it; anything else is read whole, bookmarks included.
+        since = bool(ids) and count == ids[0] + added and row_url(conn, table, ids[1]) == ids[2]
+        if since:
+            fresh = conn.execute(
+                FIREFOX_SINCE_QUERY if firefox else CHROME_SINCE_QUERY,
+                (known["state"]["visit"] or 0,),
+            ).fetchall()
+            history = sift_history(merge_history(known["history"], fresh))
+        else:
+            history = sift_history(
+                conn.execute(FIREFOX_ALL_QUERY if firefox else CHROME_ALL_QUERY).fetchall()
+            )
+
         marks = []
         if not bookmarks_on:
-            return history, marks
-        if flavour == "chrome":
-            return history, read_chrome_bookmarks(
-                os.path.join(os.path.dirname(path), "Bookmarks")
+            return state, history, marks
+        if not firefox:
+            bookmarks = os.path.join(os.path.dirname(path), "Bookmarks")
+            state["mark"] = list(stat_key(bookmarks) or ())
+            if since and known["state"].get("mark") == state["mark"]:
+                return state, history, known["marks"]
+            return state, history, stored(
+                store, bookmarks, lambda: read_chrome_bookmarks(bookmarks)
             )
+        # A places file without the bookmark tables still has history worth
+        # having, so their absence cannot take the profile with it. Any other
+        # error is a read gone wrong, and query_db tries the next reader.
+        if not has_table(conn, "moz_bookmarks"):
+            return state, history, marks
+        state["mark"] = list(conn.execute(FIREFOX_BOOKMARK_MARK_QUERY).fetchone())
+        if since and known["state"].get("mark") == state["mark"]:
+            return state, history, known["marks"]
+        marks = conn.execute(FIREFOX_BOOKMARK_QUERY).fetchall()
+        return state, history, marks
+
+    (state, history, marks), reader = query_db(path, workdir, index, readers, read)
+    if state is not None:
+        state["reader"] = reader
+    return state, history, marks
+
+
+# Every profile at once, one thread each: a read is mostly copying a database
+# and sqlite running a query, and both let go of the GIL, so four profiles cost
+# about what the slowest of them does. read(index, tag, path) does one profile;
+# what comes back is its result per profile in conf order, whatever order they
+# finished in, so the rows line up exactly as a serial read would put them. A
+# profile that failed is None, and its error is reported here, in order too.
+def read_profiles(sources, read):
+    import sqlite3
+    from concurrent.futures import ThreadPoolExecutor
+
+    def attempt(job):
+        index, (tag, path) = job
         try:
-            marks = conn.execute(FIREFOX_BOOKMARK_QUERY).fetchall()
-        except sqlite3.Error:
-            # A places file without the bookmark tables still has history worth
-            # having, so this cannot be allowed to take the profile with it.
-            pass
-        return history, marks
-    finally:
-        conn.close()
+            return read(index, tag, path), None
+        except (OSError, sqlite3.Error) as err:
+            return None, err
+
+    if len(sources) > 1:
+        with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+            results = list(pool.map(attempt, enumerate(sources)))
+    else:
+        results = [attempt(job) for job in enumerate(sources)]
+    found = []
+    for (_, path), (result, err) in zip(sources, results):
+        if err is not None:
+            print("link candidates: %s: %s" % (path, err), file=sys.stderr)
+        found.append(result)
+    return found
 
 
 def read_chrome_bookmarks(path):
@@ -401,7 +949,10 @@ def read_chrome_bookmarks(path):
     return rows
 
 
-def load_history(seen, profiles, limit, per_host_limit):
+def load_history(seen, profiles, limit, per_host_limit, readers_file):
+    import tempfile
+    from collections import Counter
+
     sources = history_dbs(profiles)
     # The order profiles are listed in the conf is the order their rows appear
     # in, so work sits above home. Ranking the tag rather than hardcoding
@@ -411,13 +962,15 @@ def load_history(seen, profiles, limit, per_host_limit):
         tag_order.setdefault(tag, len(tag_order))
 
     rows = []
+    readers = load_readers(readers_file)
     with tempfile.TemporaryDirectory(prefix="link-history-") as workdir:
-        for index, (tag, path) in enumerate(sources):
-            try:
-                for url, title, when in read_db(path, workdir, index, limit * 4):
-                    rows.append((url, title, when, tag))
-            except (OSError, sqlite3.Error) as err:
-                print("link candidates: %s: %s" % (path, err), file=sys.stderr)
+        def read(index, tag, path):
+            return read_db(path, workdir, index, limit * 4, readers)
+
+        for (tag, _), found in zip(sources, read_profiles(sources, read)):
+            for url, title, when in found or ():
+                rows.append((url, title, when, tag))
+    save_readers(readers_file, readers)
 
     rows.sort(key=lambda row: row[2], reverse=True)
     hits = []
@@ -489,25 +1042,56 @@ def corpus_stale(path, sources, ttl):
     return False
 
 
-# Tabs and newlines are the row format, so they cannot survive in a field.
+# Tabs and newlines are the export format, so they cannot survive in a field.
 def flatten(value):
     return value.replace("\t", " ").replace("\r", " ").replace("\n", " ")
 
 
 def build_corpus(path, sources, bookmarks_on):
+    import tempfile
+
+    known = known_profiles(path, bookmarks_on)
+    # readers_path, for the corpus at path.
+    readers_file = path + ".readers"
+    readers = load_readers(readers_file)
+    # store_path, likewise.
+    store = path + ".parsed"
+    profiles = []
     rows = []
     with tempfile.TemporaryDirectory(prefix="link-corpus-") as workdir:
-        for index, (tag, source) in enumerate(sources):
-            try:
-                history, marks = read_db_corpus(source, workdir, index, bookmarks_on)
-            except (OSError, sqlite3.Error) as err:
-                print("link candidates: %s: %s" % (source, err), file=sys.stderr)
+        def read(index, tag, source):
+            return read_db_corpus(
+                source, workdir, index, bookmarks_on, readers, store, known.get((tag, source))
+            )
+
+        for (tag, source), found in zip(sources, read_profiles(sources, read)):
+            if found is None:
+                continue
+            state, history, marks = found
+            if state is None:
                 continue
-            for url, title, when in history:
-                rows.append(("h", tag, when or 0, url, title or ""))
+            state.update(tag=tag, path=source, history=len(history), marks=len(marks))
+            profiles.append(state)
+            history_flags = bookmarked_flags(history, marks)
+            for (url, title, when), flags in zip(history, history_flags):
+                rows.append(("h", tag, when or 0, url, title or "", flags))
             for url, title in marks:
                 rows.append(("b", tag, 0, url, title or ""))
-
+    save_readers(readers_file, readers)
+    lap("build_read")
+
+    # The meta records the bookmarks setting the corpus was built under and,
+    # per profile in corpus order, the state read_db_corpus returned plus how
+    # many history and bookmark rows follow for it. That is what lets a refresh
+    # hand each profile back its own rows.
+    # The generation tells every cache derived from one corpus apart from
+    # those derived from the next, so it only has to differ between builds.
+    data = linkcorpus.encode(
+        {"bookmarks": bookmarks_on, "profiles": profiles, "generation": time.time_ns()},
+        rows,
+        row_features,
+    )
+    lap("build_encode")
     parent = os.path.dirname(path)
     if parent:
         os.makedirs(parent, exist_ok=True)
@@ -515,40 +1099,431 @@ def build_corpus(path, sources, bookmarks_on):
     # rebuilds it never reads half a file.
     scratch = "%s.%d" % (path, os.getpid())
     try:
-        with open(scratch, "w") as handle:
-            for kind, tag, when, url, title in rows:
-                handle.write(
-                    "%s\t%s\t%.0f\t%s\t%s\n"
-                    % (kind, tag, when, flatten(url), flatten(title))
-                )
+        with open(scratch, "wb") as handle:
+            handle.write(data)
         os.replace(scratch, path)
     except OSError as err:
         print("link candidates: %s: %s" % (path, err), file=sys.stderr)
-    return rows
-
-
-def load_corpus(conf, profiles):
-    path = corpus_path(conf)
-    sources = history_dbs(profiles)
+    lap("build_write")
+    trace_note("rebuilt", True)
+    tally("built", len(rows))
+    return linkcorpus.Corpus(data)
+
+
+# What the corpus on disk holds per (tag, path), split back out of the rows by
+# the counts in its meta. Anything that does not add up, a corpus in an older
+# format or one built under the other bookmarks setting, gives nothing back,
+# and every profile is then read in full.
+def known_profiles(path, bookmarks_on):
+    corpus = read_corpus(path)
+    if corpus is None or corpus.meta.get("bookmarks") != bookmarks_on:
+        return {}
+
+    rows = list(corpus.rows())
+    known = {}
+    start = 0
+    try:
+        for state in corpus.meta["profiles"]:
+            end = start + state["history"]
+            history = [(url, title, when) for _, _, when, url, title in rows[start:end]]
+            start, end = end, end + state["marks"]
+            marks = [(url, title) for _, _, _, url, title in rows[start:end]]
+            start = end
+            known[(state["tag"], state["path"])] = {
+                "state": state,
+                "history": history,
+                "marks": marks,
+            }
+    except (KeyError, TypeError):
+        return {}
+    if start != len(rows):
+        return {}
+    return known
+
+
+def corpus_settings(conf, profiles):
     ttl = float(setting("LINK_CORPUS_TTL", "corpus_ttl", DEFAULT_CORPUS_TTL, conf))
     bookmarks_on = (
         setting("LINK_BOOKMARKS", "bookmarks", "on", conf).lower() not in OFF_VALUES
     )
-    if corpus_stale(path, sources, ttl):
-        return build_corpus(path, sources, bookmarks_on)
+    return corpus_path(conf), history_dbs(profiles), ttl, bookmarks_on
 
-    rows = []
+
+# Every keystroke process that finds the corpus stale would otherwise run its
+# own rebuild, all of them copying the same databases at once. Rebuilds take
+# an flock beside the corpus instead. A process that loses the race searches
+# the corpus that exists, and the winner's os.replace swaps the new one in
+# underneath. With corpus_refresh = background nobody waits at all: the stale
+# corpus is searched and a detached --rebuild does the work. Only a process
+# with no corpus whatsoever ever blocks, on whoever is building the first one.
+def load_corpus(conf, profiles):
+    watched = watched_generation(corpus_path(conf))
+    if watched is not None:
+        corpus = watched_corpus(corpus_path(conf), watched)
+        lap("stale")
+        if corpus is not None:
+            return corpus
+    path, sources, ttl, bookmarks_on = corpus_settings(conf, profiles)
+    corpus = parsed(path, lambda: read_corpus(path))
+    stale = corpus is None or corpus_stale(path, sources, ttl)
+    lap("stale")
+    if not stale:
+        return corpus
+    background = (
+        setting("LINK_CORPUS_REFRESH", "corpus_refresh", DEFAULT_CORPUS_REFRESH, conf)
+        == "background"
+    )
+
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        if corpus is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return corpus
+            if background:
+                lock.close()
+                spawn_rebuild()
+                trace_note("rebuilt", "background")
+                return corpus
+            # The lock may have been free because a rebuild just finished.
+            if not corpus_stale(path, sources, ttl):
+                return parsed(path, lambda: read_corpus(path)) or corpus
+        else:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Whoever held the lock may have just written the corpus this
+            # process was waiting for.
+            corpus = parsed(path, lambda: read_corpus(path))
+            if corpus is not None and not corpus_stale(path, sources, ttl):
+                return corpus
+        lap("lock")
+        corpus = build_corpus(path, sources, bookmarks_on)
+        remember(path, corpus)
+        return corpus
+
+
+# Detached from the picker's session, because fzf kills the reload that
+# started it as soon as the next keystroke arrives.
+def spawn_rebuild():
+    import subprocess
+
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--rebuild"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+# The other end of spawn_rebuild. The lock is taken without waiting: if someone
+# already holds it, a rebuild is under way and this one has nothing to add.
+def rebuild(conf, profiles):
+    path, sources, ttl, bookmarks_on = corpus_settings(conf, profiles)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        if corpus_stale(path, sources, ttl) or read_corpus(path) is None:
+            build_corpus(path, sources, bookmarks_on)
+
+
+# Fired by the runner in the background as the popup opens, so the terminal
+# and fzf starting up cover the work the first keystroke would otherwise wait
+# on: a corpus that went stale while the picker was closed is rebuilt here,
+# and the snippets and the default list are parsed and cached on disk. The
+# runner starts this script itself rather than going through the client: the
+# server answers one request at a time, and a rebuild inside it would hold up
+# the opening list and the first keystrokes behind it. Run apart, it holds
+# only the rebuild lock, and they search the corpus already there meanwhile.
+def prewarm(conf, profiles):
+    load_snippets(conf)
+    rebuild(conf, profiles)
+    default_lines(conf, profiles)
+
+
+# --watch keeps the corpus fresh from inotify rather than from keystrokes, as
+# the link-picker-watch user unit. While it runs it holds an exclusive flock on
+# corpus.watch, which holds the generation of the corpus it last wrote, and a
+# keystroke that finds the lock held trusts that generation instead of
+# statting every profile: see watched_generation. Writes are coalesced, so a
+# browser rewriting its log every second costs one rebuild per burst, and each
+# rebuild is the incremental one a refresh always is. The watcher leaves when
+# the conf or this script changes, and the unit starts it again.
+def watch():
+    import ctypes
+    import select
+    import struct
+
+    conf, profiles = load_conf()
+    path, sources, _, bookmarks_on = corpus_settings(conf, profiles)
+    quiet = float(setting("LINK_WATCH_QUIET", "watch_quiet", DEFAULT_WATCH_QUIET, conf))
+    latest = float(setting("LINK_WATCH_LATEST", "watch_latest", DEFAULT_WATCH_LATEST, conf))
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    beacon = os.open(path + ".watch", os.O_RDWR | os.O_CREAT, 0o644)
     try:
-        with open(path) as handle:
-            for line in handle:
-                fields = line.rstrip("\n").split("\t")
-                if len(fields) == 5:
-                    rows.append(
-                        (fields[0], fields[1], float(fields[2]), fields[3], fields[4])
-                    )
-    except (OSError, ValueError):
-        return build_corpus(path, sources, bookmarks_on)
-    return rows
+        fcntl.flock(beacon, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        # Another watcher has it.
+        return
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    inotify = libc.inotify_init1(os.O_CLOEXEC)
+    if inotify < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1")
+    watched = {candidate for _, source in sources for candidate in corpus_sources(source)}
+    directories = {}
+    for directory in sorted({os.path.dirname(candidate) for candidate in watched}):
+        handle = libc.inotify_add_watch(inotify, os.fsencode(directory), WATCH_MASK)
+        if handle < 0:
+            err = OSError(ctypes.get_errno(), "inotify_add_watch")
+            print("link candidates: %s: %s" % (directory, err), file=sys.stderr)
+            continue
+        directories[handle] = directory
+    event = struct.Struct("iIII")
+
+    def publish(generation):
+        data = str(generation).encode()
+        os.pwrite(beacon, data, 0)
+        os.ftruncate(beacon, len(data))
+
+    def refresh():
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            corpus = build_corpus(path, sources, bookmarks_on)
+        publish(corpus.meta["generation"])
+
+    # Whatever moved while nothing was watching. The watches are already in
+    # place, so a write during this build is a second one, not a lost one.
+    corpus = read_corpus(path)
+    if corpus is None or corpus_stale(path, sources, 0):
+        refresh()
+    else:
+        publish(corpus.meta.get("generation"))
+
+    started = (stat_key(CONF_FILE), stat_key(os.path.abspath(__file__)))
+    first = last = None
+    while True:
+        if first is None:
+            timeout = WATCH_CHECK
+        else:
+            timeout = max(0.0, min(last + quiet, first + latest) - time.monotonic())
+        if select.select([inotify], [], [], timeout)[0]:
+            data = os.read(inotify, 65536)
+            offset = 0
+            while offset < len(data):
+                handle, _, _, size = event.unpack_from(data, offset)
+                name = data[offset + event.size : offset + event.size + size].rstrip(b"\0")
+                offset += event.size + size
+                if os.path.join(directories.get(handle, ""), os.fsdecode(name)) in watched:
+                    last = time.monotonic()
+                    first = last if first is None else first
+        if first is not None and time.monotonic() >= min(last + quiet, first + latest):
+            first = last = None
+            refresh()
+        if (stat_key(CONF_FILE), stat_key(os.path.abspath(__file__))) != started:
+            return
+
+
+# The generation a running watcher last published for the corpus at path, or
+# None when no watcher holds corpus.watch. A shared lock that can be had means
+# nobody holds the exclusive one; closing the file lets it go again.
+def watched_generation(path):
+    try:
+        beacon = os.open(path + ".watch", os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(beacon, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        try:
+            return int(os.read(beacon, 32))
+        except ValueError:
+            return None
+    finally:
+        os.close(beacon)
+    return None
+
+
+# The corpus the watcher published, out of memory while it still is the one,
+# which costs a search not even the stat parsed() would take.
+def watched_corpus(path, generation):
+    hit = _parsed.get(path)
+    if hit is not None and hit[1] is not None and hit[1].meta.get("generation") == generation:
+        return hit[1]
+    corpus = read_corpus(path)
+    remember(path, corpus)
+    return corpus
+
+
+# None for a missing file and for one this version cannot read, the text
+# corpus of earlier versions included: both mean a rebuild.
+def read_corpus(path):
+    try:
+        return linkcorpus.open_corpus(path)
+    except (OSError, linkcorpus.CorpusError):
+        return None
+
+
+# The text format the corpus used to be written in, header line and all, for
+# reading a corpus by eye or diffing two of them.
+def export_corpus(conf):
+    corpus = read_corpus(corpus_path(conf))
+    if corpus is None:
+        return []
+    lines = ["#\t" + json.dumps(corpus.meta)]
+    for kind, tag, when, url, title in corpus.rows():
+        lines.append(
+            "%s\t%s\t%.0f\t%s\t%s" % (kind, tag, when, flatten(url), flatten(title))
+        )
+    return lines
+
+
+# Where the previous query's prefilter survivors are kept: the corpus
+# generation they were found in, the terms, and the row ids.
+def narrowing_path(conf):
+    return corpus_path(conf) + ".narrow"
+
+
+# Typing "kube" then "kuber" can only lose rows, so the second keystroke looks
+# only at what the first one found instead of scanning the corpus again.
+# Backspacing, or editing a term in the middle, makes a query the previous one
+# does not narrow, and that scans in full. The survivors are taken before any
+# #tag filter, so adding or dropping one never invalidates them.
+def prefilter(conf, corpus, ranker):
+    found = corpus.matching(ranker, narrowed(conf, corpus, ranker))
+    save_narrowed(conf, corpus, ranker, found)
+    return found
+
+
+# The previous query's survivors when this query narrows it, else None.
+def narrowed(conf, corpus, ranker):
+    try:
+        with open(narrowing_path(conf), "rb") as handle:
+            saved_generation, terms, saved = marshal.load(handle)
+        if saved_generation == corpus.meta.get("generation") and ranker.narrows(terms):
+            return array("I", saved)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    return None
+
+
+def save_narrowed(conf, corpus, ranker, found):
+    path = narrowing_path(conf)
+    scratch = "%s.%d" % (path, os.getpid())
+    try:
+        with open(scratch, "wb") as handle:
+            marshal.dump(
+                (corpus.meta.get("generation"), ranker.terms, array("I", found).tobytes()),
+                handle,
+            )
+        os.replace(scratch, path)
+    except OSError as err:
+        print("link candidates: %s: %s" % (path, err), file=sys.stderr)
+
+
+# The row ranges a search over the corpus is split into, one per worker, or
+# None for a corpus under the shard_rows threshold.
+def shard_ranges(conf, corpus):
+    threshold = int(setting("LINK_SHARD_ROWS", "shard_rows", DEFAULT_SHARD_ROWS, conf))
+    workers = int(setting("LINK_SHARD_WORKERS", "shard_workers", str(os.cpu_count() or 1), conf))
+    rows = len(corpus)
+    if threshold <= 0 or rows < threshold or workers < 2:
+        return None
+    size = -(-rows // workers)
+    return [(first, min(first + size, rows)) for first in range(0, rows, size)]
+
+
+_pools = {}
+
+
+# Worker processes, started on the first sharded search and kept, so the
+# server forks them once rather than per keystroke. Forked rather than
+# spawned, so a worker starts with this module imported and its memo of the
+# corpus already mapped. Processes, not threads: matching and scoring are
+# Python, and threads would take turns on the one interpreter lock.
+def shard_pool(workers):
+    if workers not in _pools:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        _pools[workers] = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("fork")
+        )
+    return _pools[workers]
+
+
+# prefilter and the match loop of run_search over every shard at once. Returns
+# the rows that matched, for the narrowing file, and (row, score, key, title
+# key) for each row the search would keep, in corpus order and not yet
+# deduplicated: which rows the dedupe drops depends on every row before them,
+# so that pass stays with the caller. None when a worker found a corpus other
+# than this one on disk, and False when it found a newer query: the first
+# leaves the search to the caller, the second leaves nothing to answer.
+def search_shards(conf, corpus, ranker, now_ms, shards, tags, history_on, generation):
+    import bisect
+
+    within = narrowed(conf, corpus, ranker)
+    jobs = []
+    for first, end in shards:
+        if within is not None:
+            part = within[bisect.bisect_left(within, first) : bisect.bisect_left(within, end)]
+            part = part.tobytes()
+        else:
+            part = None
+        jobs.append(
+            (
+                corpus_path(conf), corpus.meta.get("generation"), ranker.terms, now_ms,
+                tags, history_on, (first, end), part, generation,
+            )
+        )
+    found = array("I")
+    matched = []
+    for result in shard_pool(len(shards)).map(search_shard, jobs):
+        if not result:
+            return result
+        found.frombytes(result[0])
+        matched.extend(result[1])
+    save_narrowed(conf, corpus, ranker, found)
+    return found, matched
+
+
+# One shard, in a worker. A row's score depends on that row alone, so it is
+# taken here, in parallel with the other shards.
+def search_shard(job):
+    path, corpus_generation, terms, now_ms, tags, history_on, rows, within, generation = job
+    corpus = parsed(path, lambda: read_corpus(path))
+    if corpus is None or corpus.meta.get("generation") != corpus_generation:
+        return None
+    superseded = superseded_by(generation)
+    ranker = vimium.Ranker(terms, now_ms)
+    found = corpus.matching(ranker, None if within is None else array("I", within), rows)
+    kept = []
+    texts = []
+    titles = []
+    whens = []
+    for count, index in enumerate(found):
+        if count % GENERATION_ROWS == 0 and count and superseded():
+            return False
+        hit = corpus_hit(corpus, index, history_on)
+        if hit is None:
+            continue
+        _, title, _, when, row_tags, text, key, title_key = hit
+        if tags and not row_tags & tags or not ranker.matches(text, title):
+            continue
+        kept.append((index, key, title_key))
+        texts.append(text)
+        titles.append(title)
+        whens.append(when * 1000)
+    scores = ranker.score_batch(texts, titles, whens)
+    return (
+        array("I", found).tobytes(),
+        [(index, score, key, title_key) for (index, key, title_key), score in zip(kept, scores)],
+    )
 
 
 # A leading # is a filter on the source rather than a search term, which is how
@@ -563,11 +1538,89 @@ def parse_query(query):
     return terms, tags
 
 
+# Where stored() keeps parsed files: beside the corpus.
+def store_path(conf):
+    return corpus_path(conf) + ".parsed"
+
+
+# Where the rendered default list is cached: beside the corpus.
+def default_path(conf):
+    return corpus_path(conf) + ".default"
+
+
+# Opening the picker, and every backspace back to an empty query, used to copy
+# and query every profile database. The list is cached instead, under two
+# fingerprints. Anything on the live side (this script, the pins file, the
+# snippet file, the settings the list is built from, which databases there are)
+# moving is a rebuild at once, so a ctrl-f pin still shows up on the next
+# keystroke. The history side, the databases and their logs, moves every few
+# seconds while a browser runs, so it is only looked at once the cache is older
+# than the corpus ttl, the same floor the search corpus rebuilds under.
 def default_lines(conf, profiles, tags=()):
     history_on = setting("LINK_HISTORY", "history", "on", conf).lower() not in OFF_VALUES
     limit = int(setting("LINK_HISTORY_LIMIT", "limit", "500", conf))
     per_host_limit = int(setting("LINK_HISTORY_PER_HOST", "per_host", "30", conf))
+    ttl = float(setting("LINK_CORPUS_TTL", "corpus_ttl", DEFAULT_CORPUS_TTL, conf))
+    sources = history_dbs(profiles)
+    live = (
+        stat_key(os.path.abspath(__file__)),
+        stat_key(pins_path(conf)),
+        stat_key(SNIPPET_FILE),
+        (history_on, limit, per_host_limit),
+        tuple(sources),
+    )
+    history = ()
+    if history_on:
+        # The watcher's generation moves whenever a database does, and reading
+        # it is one file rather than a stat per database.
+        watched = watched_generation(corpus_path(conf))
+        history = (watched,) if watched is not None else tuple(
+            stat_key(candidate) for _, source in sources for candidate in (source, source + "-wal")
+        )
+
+    path = default_path(conf)
+    cached = parsed(path, lambda: read_default_cache(path))
+    if cached and cached[0] == live and (
+        time.time() - cached[2] < ttl or cached[1] == history
+    ):
+        rows = cached[3]
+        lap("default_cache")
+    else:
+        lap("default_cache")
+        rows = build_default_rows(conf, profiles, history_on, limit, per_host_limit)
+        save_default_cache(path, (live, history, time.time(), rows))
+        lap("default_build")
 
+    if tags:
+        rows = [row for row in rows if row[0] in tags]
+    return [line for _, line in rows]
+
+
+# (live, history, written, rows), or None for a missing or unreadable cache.
+def read_default_cache(path):
+    try:
+        with open(path, "rb") as handle:
+            cached = marshal.load(handle)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return cached if isinstance(cached, tuple) and len(cached) == 4 else None
+
+
+def save_default_cache(path, cached):
+    scratch = "%s.%d" % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(scratch, "wb") as handle:
+            marshal.dump(cached, handle)
+        os.replace(scratch, path)
+    except OSError as err:
+        print("link candidates: %s: %s" % (path, err), file=sys.stderr)
+        return
+    remember(path, cached)
+
+
+# The whole default list, as (source tag, rendered line) in display order.
+def build_default_rows(conf, profiles, history_on, limit, per_host_limit):
     # Pins are resolved first and sit at the very top, above even the newest
     # history: a pin is the one row whose position you chose by hand.
     seen = set()
@@ -587,7 +1640,7 @@ def default_lines(conf, profiles, tags=()):
     # Two snippets can point at one url under different descriptions, which is
     # two ways to recall the same page, and both are worth keeping searchable.
     snippets = []
-    for title, command, url in load_snippets():
+    for title, command, url in load_snippets(conf):
         key = pin_key(url, command)
         seen.add(key)
         if key in pinned:
@@ -598,102 +1651,546 @@ def default_lines(conf, profiles, tags=()):
     # from earlier today. The bookmarks are the long tail you search for by
     # name, so they sit underneath.
     if history_on:
-        for title, url, tag in load_history(seen, profiles, limit, per_host_limit):
+        history = load_history(seen, profiles, limit, per_host_limit, readers_path(conf))
+        for title, url, tag in history:
             command = "xdg-open " + shlex.quote(url)
             rows.append((tag, render(title, url, "#" + tag, command)))
     rows.extend(snippets)
+    return rows
 
-    if tags:
-        rows = [row for row in rows if row[0] in tags]
-    return [line for _, line in rows]
+
+# A corpus row as the search keeps it, (tag, title, url, when, row tags, text,
+# key, title key), or None for a row no search shows.
+def corpus_hit(corpus, index, history_on):
+    kind, tag, when, url, _ = corpus.row(index)
+    flags, text, title, host, key, fold = corpus.features(index)
+    if kind == "h" and flags & ROW_NOISE:
+        return None
+    if kind == "b":
+        return "#mark", title, url, 0, {"mark", tag}, text, key, (host, fold)
+    if not history_on:
+        return None
+    row_tags = {tag, "mark"} if flags & ROW_MARK else {tag}
+    return "#" + tag, title, url, when, row_tags, text, key, (host, fold)
 
 
 # The search path. fzf does no matching of its own here, so what comes back and
 # in what order is entirely this function and __lib_vimium_rank.
-def run_search(conf, profiles, query):
+def run_search(conf, profiles, query, generation=None):
     terms, tags = parse_query(query)
     if not terms:
         return default_lines(conf, profiles, tags)
+    superseded = superseded_by(generation)
 
     limit = int(setting("LINK_SEARCH_LIMIT", "results", "200", conf))
     history_on = setting("LINK_HISTORY", "history", "on", conf).lower() not in OFF_VALUES
-    ranker = vimium.Ranker(terms, time.time() * 1000)
+    key = result_key(conf, profiles, terms, tags, (limit, history_on))
+    lines = load_result(conf, key)
+    lap("cached")
+    if lines is not None:
+        trace_note("cached", True)
+        return lines
+    now_ms = time.time() * 1000
+    ranker = vimium.Ranker(terms, now_ms)
     seen = set()
     hits = []
+    texts = []
+    titles = []
+    whens = []
+    groups = []
 
     # Rows enter the dedupe only once they are kept, unlike the default list.
     # There a snippet is always shown, so shadowing its history twin is right;
     # here a snippet the query missed would otherwise hide a row that matched.
-    def keep(group, tag, title, url, command, when, row_tags):
+    # text is the url shortened the way the vomnibar ranks it: the scheme is on
+    # every row, so it can only dilute the score.
+    def keep(group, tag, title, url, command, when, row_tags, text, key, title_key):
         if tags and not row_tags & tags:
             return
-        # Ranked against the shortened url the way the vomnibar does. The
-        # scheme is on every row, so it can only dilute the score.
-        text = vimium.shorten_url(url)
         if not ranker.matches(text, title):
             return
-        key = pin_key(url, command)
-        title_key = (urlsplit(url).netloc.lower(), title.casefold()) if url else None
         if key in seen or (title_key and title_key in seen):
             return
         seen.add(key)
         if title_key:
             seen.add(title_key)
-        if when:
-            score = ranker.relevancy(text, title, when * 1000)
-        else:
-            score = ranker.word_relevancy(text, title)
-        hits.append((group, -score, len(hits), tag, title, url, command))
+        hits.append((title, url, tag, command))
+        texts.append(text)
+        titles.append(title)
+        whens.append(when * 1000)
+        groups.append(group)
+
+    # Pins and snippets are a few dozen rows outside the corpus, so what the
+    # build derives for a corpus row is derived for them here.
+    def keep_curated(group, tag, title, url, command):
+        title_key = (urlsplit(url).netloc.lower(), title.casefold()) if url else None
+        text = vimium.shorten_url(url)
+        key = pin_key(url, command)
+        keep(group, tag, title, url, command, 0, {tag[1:]}, text, key, title_key)
 
     # Group 0 is the pins, so a pin that matches at all stays above the ranking
     # rather than competing with it. Everything else is ranked against
     # everything else, bookmarks on word relevancy and history with its visit
     # time folded in, which is the split the extension makes.
     for url, title, command in load_pins(pins_path(conf)):
-        keep(0, "#pin", title, url, command, 0, {"pin"})
-    for title, command, url in load_snippets():
-        keep(1, "#link", title, url, command, 0, {"link"})
+        keep_curated(0, "#pin", title, url, command)
+    for title, command, url in load_snippets(conf):
+        keep_curated(1, "#link", title, url, command)
+    lap("curated")
     # A tag filter naming neither the bookmarks nor a profile leaves nothing in
     # the corpus worth reading, and reading it is the expensive part.
     corpus_tags = {"mark"} | {tag for tag, _ in history_dbs(profiles)}
-    corpus = load_corpus(conf, profiles) if not tags or tags & corpus_tags else []
-    for kind, tag, when, url, title in corpus:
-        # Everything below this gate runs on a handful of rows. Splitting urls
-        # and cleaning titles across all seventy thousand costs several times
-        # what the ranking itself does, so nothing touches a row until its
-        # terms are known to be in it.
-        if not ranker.matches_in(url + "\n" + title):
-            continue
-        command = "xdg-open " + shlex.quote(url)
-        if kind == "b":
-            keep(1, "#mark", clean_title(title), url, command, 0, {"mark", tag})
-            continue
-        if not history_on or urlsplit(url).netloc.lower() in NOISE_HOSTS:
-            continue
-        title = clean_title(title)
-        if not title or title == url:
-            continue
-        keep(1, "#" + tag, title, url, command, when, {tag})
+    corpus = load_corpus(conf, profiles) if not tags or tags & corpus_tags else None
+    if superseded():
+        return []
+    # A corpus past shard_rows is matched and scored in worker processes, a
+    # shard each; a worker that finds the corpus on disk moved on leaves the
+    # search to this process, one that finds a newer query ends it.
+    shards = shard_ranges(conf, corpus) if corpus else None
+    sharded = None
+    if shards:
+        sharded = search_shards(conf, corpus, ranker, now_ms, shards, tags, history_on, generation)
+        tally("shards", len(shards))
+        if sharded is False or superseded():
+            return []
+    if sharded is not None:
+        found, matched = sharded
+    else:
+        found = prefilter(conf, corpus, ranker) if corpus else ()
+        matched = None
+    lap("prefilter")
+    tally("corpus", len(corpus) if corpus else 0)
+    tally("prefilter", len(found))
+    # Everything below this gate runs on a handful of rows, and even those
+    # only read what the build already derived: nothing touches a row until
+    # its terms are known to be in it, and a row that fails is never even
+    # sliced out of the blob.
+    for count, index in enumerate(found if matched is None else ()):
+        if count % GENERATION_ROWS == 0 and count and superseded():
+            return []
+        hit = corpus_hit(corpus, index, history_on)
+        if hit is not None:
+            tag, title, url, when, row_tags, text, key, title_key = hit
+            command = "xdg-open " + shlex.quote(url)
+            keep(1, tag, title, url, command, when, row_tags, text, key, title_key)
+    # The shards come back in corpus order, so the dedupe over them keeps
+    # exactly the rows the loop above would have. A shard row enters hits as
+    # its row id and is only read out of the corpus if it makes the cut.
+    scores = None
+    if matched is not None:
+        scores = ranker.score_batch(texts, titles, whens)
+        for index, score, key, title_key in matched:
+            if key in seen or title_key in seen:
+                continue
+            seen.add(key)
+            seen.add(title_key)
+            hits.append(index)
+            scores.append(score)
+            groups.append(1)
+    lap("match")
+    tally("matches", len(hits))
+
+    # Ranked together once every hit is in. A one letter query can keep
+    # thousands, and only the limit best are ever shown, so the ranker scores
+    # the likeliest first and stops once nothing left could make the cut. A row
+    # with no visit time, pins, snippets and bookmarks, scores its word
+    # relevancy alone. Sharded hits are scored already, and take the same
+    # order top() gives: group, then score, then the earlier row.
+    if scores is None:
+        ranked = ranker.top(texts, titles, whens, groups, limit, stop=superseded)
+    else:
+        import heapq
+
+        best = heapq.nsmallest(
+            limit, range(len(hits)), key=lambda row: (groups[row], -scores[row], row)
+        )
+        ranked = [(row, scores[row]) for row in best]
+    lap("score")
+    if superseded():
+        return []
+    for row, _ in ranked:
+        if not isinstance(hits[row], tuple):
+            tag, title, url = corpus_hit(corpus, hits[row], history_on)[:3]
+            hits[row] = (title, url, tag, "xdg-open " + shlex.quote(url))
+    lines = [render(*hits[row], pinned=groups[row] == 0) for row, _ in ranked]
+    lap("render")
+    # Taken again, since the corpus searched may be one this very search built.
+    save_result(conf, result_key(conf, profiles, terms, tags, (limit, history_on)), lines)
+    return lines
+
+
+# Where searches already answered are kept: a directory beside the corpus,
+# one marshal file per query, named for a hash of its key.
+def results_path(conf):
+    return corpus_path(conf) + ".results"
+
+
+# The same handful of queries come back all day, and a query whose inputs have
+# not moved gets the same answer, so the answer is kept under every input: the
+# terms as typed (smart case tells "Ops" from "ops"), the tag filters, the
+# settings run_search reads, the profiles and the bookmarks setting the corpus
+# is read under, the corpus it would search, the stats of the pins, the
+# snippets, this script and the two libraries the search runs on, and which
+# RESULT_BUCKET of time it is, since the ranking depends on now. The corpus is
+# named by the watcher's generation or by its own stat, and a corpus about to
+# be rebuilt names nothing: None, which is no caching. So is a cap of 0.
+def result_key(conf, profiles, terms, tags, settings):
+    if int(setting("LINK_RESULT_CACHE", "result_cache", DEFAULT_RESULT_CACHE, conf)) <= 0:
+        return None
+    path, sources, ttl, bookmarks_on = corpus_settings(conf, profiles)
+    corpus = watched_generation(path)
+    if corpus is None:
+        if corpus_stale(path, sources, ttl):
+            return None
+        corpus = stat_key(path)
+    return (
+        tuple(terms),
+        tuple(sorted(tags)),
+        settings,
+        tuple(sources),
+        bookmarks_on,
+        corpus,
+        stat_key(pins_path(conf)),
+        stat_key(SNIPPET_FILE),
+        stat_key(os.path.abspath(__file__)),
+        stat_key(os.path.abspath(vimium.__file__)),
+        stat_key(os.path.abspath(linkcorpus.__file__)),
+        int(time.time() // RESULT_BUCKET),
+    )
 
-    hits.sort()
-    return [
-        render(title, url, tag, command, pinned=group == 0)
-        for group, _, _, tag, title, url, command in hits[:limit]
-    ]
 
+def result_file(conf, key):
+    data = marshal.dumps(key)
+    return os.path.join(results_path(conf), "%08x%08x" % (zlib.crc32(data), zlib.adler32(data)))
 
-def main():
+
+# A hit touches its file, so the file times are the recency order the
+# eviction in save_result goes by.
+def load_result(conf, key):
+    if key is None:
+        return None
+    path = result_file(conf, key)
+    try:
+        with open(path, "rb") as handle:
+            saved_key, lines = marshal.load(handle)
+        os.utime(path)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return lines if saved_key == key else None
+
+
+# Least recently used first out, once the directory holds more than the cap.
+def save_result(conf, key, lines):
+    if key is None:
+        return
+    path = result_file(conf, key)
+    scratch = "%s.%d" % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(scratch, "wb") as handle:
+            marshal.dump((key, lines), handle)
+        os.replace(scratch, path)
+        cap = int(setting("LINK_RESULT_CACHE", "result_cache", DEFAULT_RESULT_CACHE, conf))
+        held = []
+        with os.scandir(os.path.dirname(path)) as entries:
+            for entry in entries:
+                try:
+                    held.append((entry.stat().st_mtime_ns, entry.path))
+                except FileNotFoundError:
+                    # Evicted by another process in the meantime.
+                    continue
+        for _, old in sorted(held)[: max(0, len(held) - cap)]:
+            try:
+                os.unlink(old)
+            except FileNotFoundError:
+                continue
+    except OSError as err:
+        print("link candidates: %s: %s" % (path, err), file=sys.stderr)
+
+
+# Where the generation of the newest --query is kept: beside the socket, so the
+# client can find it without reading the conf.
+def generation_path():
+    return os.path.join(os.path.dirname(socket_path()), GENERATION_NAME)
+
+
+def read_generation(path):
+    try:
+        with open(path) as handle:
+            return handle.read()
+    except OSError:
+        return None
+
+
+# fzf reloads on every keystroke, and the server answers one request at a
+# time, so a fast typist queues searches whose answers nobody will read. A
+# --query with terms takes a generation, written by __link_client.py before it
+# sends the request, and a search that finds a newer one in the file stops
+# scanning and answers nothing. Returns the check, which reads the file at most
+# every GENERATION_POLL seconds, and always the first time it is asked.
+#
+# A search without a generation, run directly or by a benchmark, is never
+# superseded and writes nothing: the file belongs to the picker's keystrokes,
+# and a search of its own there would cancel the one the picker is waiting on.
+def superseded_by(generation):
+    if generation is None:
+        return lambda: False
+    path = generation_path()
+    last = [-GENERATION_POLL]
+
+    def superseded():
+        now = time.monotonic()
+        if now - last[0] < GENERATION_POLL:
+            return False
+        last[0] = now
+        newer = read_generation(path) not in (None, generation)
+        if newer:
+            trace_note("superseded", True)
+        return newer
+
+    return superseded
+
+
+# One request, whether it arrived on the command line or over the socket.
+def respond(args, generation=None):
+    started = time.monotonic()
     conf, profiles = load_conf()
+    if args and args[0] == "--trace-summary":
+        return trace_summary(args[1] if len(args) > 1 else trace_path(conf))
+    trace_start(args, conf, started)
+    lines = dispatch(args, conf, profiles, generation)
+    tally("emitted", len(lines))
+    trace_finish()
+    return lines
+
+
+def dispatch(args, conf, profiles, generation=None):
+    if len(args) > 1 and args[0] == "--toggle-pin":
+        toggle_pin(pins_path(conf), args[1])
+        return []
+
+    if args and args[0] == "--query":
+        query = args[1] if len(args) > 1 else ""
+        return run_search(conf, profiles, query, generation or os.environ.get(GENERATION_ENV))
+    if args and args[0] == "--export-corpus":
+        return export_corpus(conf)
+    if args and args[0] == "--rebuild":
+        rebuild(conf, profiles)
+        return []
+    if args and args[0] == "--prewarm":
+        prewarm(conf, profiles)
+        return []
+    return default_lines(conf, profiles)
+
+
+# A request's trace, while LINK_PICKER_TRACE names a file to append it to: the
+# seconds each phase took on the monotonic clock, the rows each stage left and
+# whether the corpus was rebuilt, one json line per request. A phase is the
+# time since the lap before it, so a lap only has to come after the work it
+# names, wherever that sits. Untraced, a lap is one global lookup.
+_trace = None
+
+
+def trace_path(conf):
+    return os.path.expanduser(setting("LINK_PICKER_TRACE", "trace", "", conf))
+
 
-    if len(sys.argv) > 2 and sys.argv[1] == "--toggle-pin":
-        toggle_pin(pins_path(conf), sys.argv[2])
+def trace_start(args, conf, started):
+    global _trace
+    path = trace_path(conf)
+    if not path:
         return
+    _trace = {
+        "path": path,
+        "started": started,
+        "mark": started,
+        "record": {
+            "time": time.time(),
+            "command": args[0] if args else "",
+            "rebuilt": False,
+            "phases": {},
+            "rows": {},
+        },
+    }
+    lap("conf")
+
+
+def lap(phase):
+    if _trace is None:
+        return
+    now = time.monotonic()
+    phases = _trace["record"]["phases"]
+    phases[phase] = phases.get(phase, 0) + now - _trace["mark"]
+    _trace["mark"] = now
 
-    if len(sys.argv) > 1 and sys.argv[1] == "--query":
-        lines = run_search(conf, profiles, sys.argv[2] if len(sys.argv) > 2 else "")
-    else:
-        lines = default_lines(conf, profiles)
 
+def tally(stage, rows):
+    if _trace is not None:
+        _trace["record"]["rows"][stage] = rows
+
+
+def trace_note(key, value):
+    if _trace is not None:
+        _trace["record"][key] = value
+
+
+def trace_finish():
+    global _trace
+    if _trace is None:
+        return
+    trace, _trace = _trace, None
+    record = trace["record"]
+    record["phases"]["total"] = time.monotonic() - trace["started"]
+    try:
+        with open(trace["path"], "a") as handle:
+            handle.write(json.dumps(record) + "\n")
+    except OSError as err:
+        print("link candidates: %s: %s" % (trace["path"], err), file=sys.stderr)
+
+
+# p50, p95 and p99 of every phase a trace file recorded, in milliseconds, the
+# slowest phase at p95 first. Nearest rank, so each is a time some request took.
+def trace_summary(path):
+    timings = {}
+    try:
+        with open(path) as handle:
+            for line in handle:
+                try:
+                    phases = json.loads(line)["phases"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                for phase, seconds in phases.items():
+                    timings.setdefault(phase, []).append(seconds * 1000)
+    except OSError as err:
+        print("link candidates: %s: %s" % (path, err), file=sys.stderr)
+        return []
+
+    def percentile(values, share):
+        return values[max(0, -(-len(values) * share // 100) - 1)]
+
+    summary = []
+    for phase, values in timings.items():
+        values.sort()
+        summary.append((phase, len(values), *(percentile(values, p) for p in (50, 95, 99))))
+    summary.sort(key=lambda row: (row[0] != "total", -row[3]))
+    lines = ["%-16s %7s %9s %9s %9s" % ("phase", "count", "p50 ms", "p95 ms", "p99 ms")]
+    lines += ["%-16s %7d %9.2f %9.2f %9.2f" % row for row in summary]
+    return lines
+
+
+def socket_path():
+    override = os.environ.get("LINK_PICKER_SOCKET")
+    if override:
+        return os.path.expanduser(override)
+    corpus = os.environ.get("LINK_CORPUS_FILE")
+    state = os.path.dirname(os.path.expanduser(corpus)) if corpus else DEFAULT_STATE_DIR
+    return os.path.join(os.path.expanduser(state), SOCKET_NAME)
+
+
+# What a request has to agree with the server on. A client run from a terminal
+# with LINK_HISTORY=0 must not be answered out of a server started without it.
+def picker_environment():
+    return {
+        name: value
+        for name, value in os.environ.items()
+        if name.startswith("LINK_") or name == "PET_SNIPPET_FILE"
+    }
+
+
+# A request is the argument count, the arguments, then the client's picker
+# environment, all NUL separated, and the client half-closes once it is
+# written. The reply is one status byte and then exactly what stdout would have
+# carried: "0" for an answer, "1" for anything the client should run itself.
+def answer(conn, environment):
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    fields = [os.fsdecode(field) for field in b"".join(chunks).split(b"\0")]
+    try:
+        count = int(fields[0])
+    except ValueError:
+        conn.sendall(b"1")
+        return
+    args = fields[1 : count + 1]
+    sent = dict(field.partition("=")[::2] for field in fields[count + 1 :] if field)
+    # The one variable that differs per request rather than per picker.
+    generation = sent.pop(GENERATION_ENV, None)
+    if sent != environment:
+        conn.sendall(b"1")
+        return
+    try:
+        lines = respond(args, generation)
+    except Exception as err:  # noqa: BLE001 - the client falls back, the server stays up
+        print("link candidates: %s: %s" % (args, err), file=sys.stderr)
+        conn.sendall(b"1")
+        return
+    conn.sendall(b"0" + ("\n".join(lines) + "\n" if lines else "").encode())
+
+
+def serve():
+    import socket
+
+    # Inherited from the client that started this server, and stale from its
+    # next keystroke on: every request carries its own.
+    os.environ.pop(GENERATION_ENV, None)
+    conf, _ = load_conf()
+    idle = float(setting("LINK_SERVER_IDLE", "server_idle", DEFAULT_SERVER_IDLE, conf))
+    path = socket_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Two clients can both find nothing listening and both start a server. The
+    # lock makes the second one leave quietly instead of unlinking the socket
+    # out from under the first.
+    lock = open(path + ".lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return
+    # A client that gives up mid-reply must cost it that reply, not the server.
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(16)
+    server.settimeout(idle)
+    environment = picker_environment()
+    # An update to this file should take effect on the next keystroke, not on
+    # the next idle exit, so the server leaves once it notices one.
+    started = stat_key(os.path.abspath(__file__))
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            with conn:
+                conn.settimeout(None)
+                try:
+                    answer(conn, environment)
+                except OSError as err:
+                    print("link candidates: %s" % err, file=sys.stderr)
+            if stat_key(os.path.abspath(__file__)) != started:
+                break
+    finally:
+        server.close()
+        os.unlink(path)
+        lock.close()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        serve()
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "--watch":
+        watch()
+        return
+
+    lines = respond(sys.argv[1:])
     if lines:
         sys.stdout.write("\n".join(lines) + "\n")
 
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Hand a link picker request to the resident server, or run it here.
+
+__link_pane_runner.sh calls this on every keystroke in place of
+__link_candidates.py, with the same arguments. When `__link_candidates.py
+--serve` is listening, the request goes over its unix socket and the reply is
+copied to stdout, so a keystroke costs a socket round trip instead of
+interpreter startup plus a corpus parse. When nothing is listening, a server is
+started in the background and this request is answered by exec'ing the script
+directly, so the first keystroke costs what it always did and no more.
+
+A --query with something typed first writes its generation beside the
+socket, so a search the server is still scanning, or has not started yet,
+sees a newer one and gives up rather than make this one wait behind it.
+
+Deliberately imports nothing beyond os, socket, sys and time: whatever this
+file loads is paid on every keystroke.
+"""
+
+import os
+import signal
+import socket
+import sys
+import time
+
+CANDIDATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__link_candidates.py")
+
+# Kept in step with socket_path() in __link_candidates.py. Reading the conf to
+# find the corpus directory would cost the startup this file exists to avoid.
+DEFAULT_STATE_DIR = "~/.local/state/link-picker"
+SOCKET_NAME = "server.sock"
+GENERATION_NAME = "query.generation"
+GENERATION_ENV = "LINK_QUERY_GENERATION"
+
+
+def socket_path():
+    override = os.environ.get("LINK_PICKER_SOCKET")
+    if override:
+        return os.path.expanduser(override)
+    corpus = os.environ.get("LINK_CORPUS_FILE")
+    state = os.path.dirname(os.path.expanduser(corpus)) if corpus else DEFAULT_STATE_DIR
+    return os.path.join(os.path.expanduser(state), SOCKET_NAME)
+
+
+# Kept in step with superseded_by() in __link_candidates.py. The generation
+# rides in the environment, so both the request and an exec'd fallback carry
+# it; a generation that cannot be written is simply not sent.
+def register_query():
+    path = os.path.join(os.path.dirname(socket_path()), GENERATION_NAME)
+    generation = str(time.time_ns())
+    scratch = "%s.%d" % (path, os.getpid())
+    try:
+        with open(scratch, "w") as handle:
+            handle.write(generation)
+        os.replace(scratch, path)
+    except OSError:
+        return
+    os.environ[GENERATION_ENV] = generation
+
+
+# Argument count first, because an empty argument is a real one: --query ""
+# is the default list.
+def request(args):
+    fields = [str(len(args)).encode()] + [os.fsencode(arg) for arg in args]
+    fields += [
+        os.fsencode("%s=%s" % (name, value))
+        for name, value in os.environ.items()
+        if name.startswith("LINK_") or name == "PET_SNIPPET_FILE"
+    ]
+    return b"\0".join(fields)
+
+
+# Returns the reply, or None when the server declined and this process should
+# answer itself. Raises OSError when there is no server to ask.
+def ask(args):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path())
+        conn.sendall(request(args))
+        conn.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        conn.close()
+    reply = b"".join(chunks)
+    if not reply.startswith(b"0"):
+        return None
+    return reply[1:]
+
+
+def spawn_server():
+    import subprocess
+
+    subprocess.Popen(
+        [sys.executable, CANDIDATES, "--serve"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def main():
+    args = sys.argv[1:]
+    # The empty query is the default list, which no search need give way to.
+    if args[:1] == ["--query"] and args[1:2] and args[1].strip():
+        register_query()
+    try:
+        reply = ask(args)
+    except OSError:
+        # Nothing listening, or a socket left behind by a server that was
+        # killed. Starting one either way is safe: a second server finds the
+        # first holding the lock and leaves.
+        spawn_server()
+        reply = None
+    if reply is not None:
+        sys.stdout.buffer.write(reply)
+        return
+    os.execv(sys.executable, [sys.executable, CANDIDATES, *args])
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    main()
@@ -15,13 +15,20 @@ set -eo pipefail
 # __lib_vimium_rank.py decides the order. fzf's own fuzzy match scores a
 # scattered subsequence, so "triage" hit rows carrying neither the word nor
 # anything like it, and the row that did carry it lost to the noise.
-# The sleep debounces: a fast typist skips the reloads in between.
+# The sleep debounces: a fast typist skips the reloads in between, and a
+# search that starts anyway gives up as soon as a newer one has begun.
+#
+# Every call goes through __link_client.py, which hands it to a resident
+# `__link_candidates.py --serve` holding the corpus in memory, and starts one
+# when none is running. python3 -S skips site initialisation, the largest part
+# of what the client itself would cost per keystroke.
 
-CANDIDATES=/home/decoder/dev/dotfiles/scripts/__link_candidates.py
+CLIENT="python3 -S /home/decoder/dev/dotfiles/scripts/__link_client.py"
+PICKER="/home/decoder/dev/dotfiles/scripts/__link_candidates.py"
 TEMP_FILE=$(mktemp)
 
 handle_link_selection() {
-    "$CANDIDATES" | /usr/local/bin/fzf \
+    $CLIENT | /usr/local/bin/fzf \
         --delimiter=$'\t' \
         --with-nth=1 \
         --disabled \
@@ -31,14 +38,21 @@ handle_link_selection() {
         --border=sharp \
         --header='ctrl-f: pin/unpin *   type #pin #link #mark #work #home to filter (Ctrl+C to exit)' \
         --prompt='🔍 Search: ' \
-        --bind "change:reload:sleep 0.1; ${CANDIDATES} --query {q} || true" \
-        --bind "ctrl-f:execute-silent(${CANDIDATES} --toggle-pin {})+reload(${CANDIDATES} --query {q})" \
+        --bind "change:reload:sleep 0.1; ${CLIENT} --query {q} || true" \
+        --bind "ctrl-f:execute-silent(${CLIENT} --toggle-pin {})+reload(${CLIENT} --query {q})" \
         --color='fg:#f8f8f2,bg:#282a36,hl:#bd93f9,fg+:#f8f8f2,bg+:#44475a,hl+:#bd93f9,info:#ffb86c,prompt:#50fa7b,pointer:#ff79c6,marker:#ff79c6,spinner:#ffb86c,header:#6272a4' \
         | cut -f2 > "$TEMP_FILE"
 }
 
 export -f handle_link_selection
-export CANDIDATES TEMP_FILE
+export CLIENT TEMP_FILE
+
+# Rebuild a stale corpus and cache the opening list while the terminal and fzf
+# start, so the first keystroke finds them ready rather than paying for them.
+# Run directly and detached, never through the client: the server answers one
+# request at a time, and the opening list and first keystrokes would queue
+# behind the rebuild. Here they search the corpus already there meanwhile.
+setsid python3 "$PICKER" --prewarm </dev/null >/dev/null 2>&1 &
 
 # Open Alacritty with the link selection (centered on screen)
 # Calculate center position based on screen resolution
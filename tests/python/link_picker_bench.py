@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""Benchmark the link picker over synthetic browser profiles of a given size.
+
+test_link_candidates.py builds fixture databases of a handful of rows, which
+says whether the picker is right but nothing about whether it is fast, and the
+real profiles it is slow on cannot be checked in. This generates the same
+shape at 10k, 100k and 1M rows: two Firefox profiles and a Chrome one with its
+Bookmarks json, hosts drawn with the skew real history has (github and linear
+on most rows, a long tail of hosts seen once), titles of realistic length and
+a few percent of non-ascii ones, which the corpus keeps as loose rows.
+
+Every measurement is a fresh process, run the way the runner runs it:
+
+  cold_rebuild   --rebuild with no corpus or sidecar files beside it
+  query_1..3     a warm --query of one, two and three terms
+  default        the empty query, the list the picker opens on
+  toggle_pin     --toggle-pin, pinning a row and unpinning it again
+  rank           in process: matching and ranker.top for one term queries,
+                 without the interpreter startup around them
+
+with p50/p95/p99 milliseconds and the peak RSS of the largest run. Results
+go to a json file so two runs, before and after a change, can be compared:
+
+  python3 tests/python/link_picker_bench.py --rows 10000 100000 --out before.json
+  python3 tests/python/link_picker_bench.py --rows 10000 100000 --compare before.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+sys.path.insert(0, str(Path(__file__).parents[2] / "scripts"))
+
+import __lib_link_corpus as linkcorpus  # noqa: E402
+import __lib_vimium_rank as vimium  # noqa: E402
+from test_link_candidates import CHROME_EPOCH_OFFSET, SCRIPT, script_env  # noqa: E402
+
+SIZES = (10_000, 100_000, 1_000_000)
+
+# The head of the host distribution, in rank order; the tail is generated.
+HOSTS = (
+    "github.com", "linear.app", "www.notion.so", "www.youtube.com", "app.spacelift.io",
+    "docs.google.com", "mail.google.com", "zkillboard.com", "www.amazon.com",
+    "kubernetes.io", "stackoverflow.com", "en.wikipedia.org", "news.ycombinator.com",
+)
+TAIL_HOSTS = 3000
+# Zipf exponent of the host ranks: the top host is on about a fifth of rows.
+HOST_SKEW = 1.1
+WORDS = 6000
+NON_ASCII = 0.03
+DAY = 86400
+
+
+def vocabulary(rng):
+    syllables = [c + v for c in "bcdfghklmnprstvz" for v in "aeiou"]
+    words = set()
+    while len(words) < WORDS:
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+
+def host_weights():
+    names = list(HOSTS) + ["host%d.example.com" % n for n in range(TAIL_HOSTS)]
+    return names, [1 / (rank + 1) ** HOST_SKEW for rank in range(len(names))]
+
+
+# (url, title, unix seconds), newest visits the most common, as history is.
+def history_rows(rng, count, words, now):
+    names, weights = host_weights()
+    hosts = rng.choices(names, weights, k=count)
+    rows = []
+    for index, host in enumerate(hosts):
+        length = max(1, min(20, int(rng.lognormvariate(1.6, 0.5))))
+        title = " ".join(rng.choice(words) for _ in range(length)).capitalize()
+        if rng.random() < NON_ASCII:
+            title += " — Grüße"
+        path = "/".join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+        url = "https://%s/%s/%d" % (host, path, index)
+        rows.append((url, title, now - rng.expovariate(1 / (14 * DAY))))
+    return rows
+
+
+def write_firefox(path, rows, marks):
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "create table moz_places "
+        "(id integer primary key, url text, title text, last_visit_date integer)"
+    )
+    conn.execute(
+        "create table moz_bookmarks (fk integer, type integer, title text, lastModified integer)"
+    )
+    conn.executemany(
+        "insert into moz_places (url, title, last_visit_date) values (?, ?, ?)",
+        [(url, title, int(when * 1000000)) for url, title, when in rows],
+    )
+    # Bookmarks point at rows already visited, with a title of their own.
+    conn.executemany(
+        "insert into moz_bookmarks values (?, 1, ?, ?)",
+        [(index + 1, "Saved: " + rows[index][1], int(rows[index][2] * 1000000)) for index in marks],
+    )
+    conn.commit()
+    conn.close()
+
+
+def write_chrome(path, rows, marks):
+    conn = sqlite3.connect(path)
+    conn.execute("create table urls (url text, title text, last_visit_time integer)")
+    conn.executemany(
+        "insert into urls values (?, ?, ?)",
+        [(url, title, int((when + CHROME_EPOCH_OFFSET) * 1000000)) for url, title, when in rows],
+    )
+    conn.commit()
+    conn.close()
+    children = [
+        {"type": "url", "url": rows[index][0], "name": "Saved: " + rows[index][1]}
+        for index in marks
+    ]
+    bookmarks = {"roots": {"bookmark_bar": {"type": "folder", "children": children}}}
+    Path(path).with_name("Bookmarks").write_text(json.dumps(bookmarks))
+
+
+# Half the rows in a work Firefox profile, a quarter each in a home Firefox
+# and a Chrome one, and one row in a hundred bookmarked. Returns the conf
+# text naming them, and the words the titles were drawn from.
+def generate(workdir, count, seed):
+    rng = random.Random(seed)
+    words = vocabulary(rng)
+    rows = history_rows(rng, count, words, time.time())
+    split = (count // 2, count // 2 + count // 4)
+    parts = (rows[: split[0]], rows[split[0] : split[1]], rows[split[1] :])
+    profiles = []
+    for name, writer, tag, part in (
+        ("work", write_firefox, "work", parts[0]),
+        ("home", write_firefox, "home", parts[1]),
+        ("chrome", write_chrome, "home", parts[2]),
+    ):
+        directory = Path(workdir) / name
+        directory.mkdir()
+        path = directory / ("places.sqlite" if writer is write_firefox else "History")
+        writer(path, part, rng.sample(range(len(part)), len(part) // 100))
+        profiles.append("profile = %s:%s\n" % (tag, path))
+    return "".join(profiles), words
+
+
+def percentiles(seconds):
+    values = sorted(value * 1000 for value in seconds)
+
+    def rank(share):
+        return values[max(0, -(-len(values) * share // 100) - 1)]
+
+    return {"runs": len(values), "p50": rank(50), "p95": rank(95), "p99": rank(99)}
+
+
+# Wall seconds and peak RSS in kilobytes of one run of the script. wait4 rather
+# than getrusage, which only knows the largest child there has ever been.
+# stderr goes to a file, since nothing reads a pipe while wait4 waits.
+def run_once(args, env):
+    with tempfile.TemporaryFile() as errors:
+        started = time.perf_counter()
+        child = subprocess.Popen(
+            [sys.executable, str(SCRIPT), *args], env=env,
+            stdout=subprocess.DEVNULL, stderr=errors,
+        )
+        _, status, usage = os.wait4(child.pid, 0)
+        elapsed = time.perf_counter() - started
+        child.returncode = os.waitstatus_to_exitcode(status)
+        if child.returncode:
+            errors.seek(0)
+            raise SystemExit("%s failed: %s" % (args, errors.read().decode()[-500:]))
+    return elapsed, usage.ru_maxrss
+
+
+def measure(runs, args_for, env, before=None):
+    seconds = []
+    peak = 0
+    for run in range(runs):
+        if before:
+            before()
+        elapsed, rss = run_once(args_for(run), env)
+        seconds.append(elapsed)
+        peak = max(peak, rss)
+    return dict(percentiles(seconds), peak_rss_mb=round(peak / 1024, 1))
+
+
+def rank_in_process(corpus_file, queries, runs):
+    corpus = linkcorpus.open_corpus(corpus_file)
+    seconds = []
+    for run in range(runs):
+        started = time.perf_counter()
+        ranker = vimium.Ranker(queries[run % len(queries)].split(), time.time() * 1000)
+        found = corpus.matching(ranker)
+        texts, titles, whens = [], [], []
+        for index in found:
+            _, _, when, url, _ = corpus.row(index)
+            fields = corpus.features(index)
+            texts.append(fields[1])
+            titles.append(fields[2])
+            whens.append(when * 1000)
+        ranker.top(texts, titles, whens, [1] * len(found), 200)
+        seconds.append(time.perf_counter() - started)
+    return percentiles(seconds)
+
+
+def bench(count, runs, seed, keep):
+    if keep:
+        os.makedirs(keep, exist_ok=True)
+        return bench_in(keep, count, runs, seed)
+    with tempfile.TemporaryDirectory(prefix="link-bench-") as workdir:
+        return bench_in(workdir, count, runs, seed)
+
+
+def bench_in(workdir, count, runs, seed):
+    print("generating %d rows in %s" % (count, workdir), file=sys.stderr)
+    conf, words = generate(tempfile.mkdtemp(dir=workdir), count, seed)
+    env = script_env(workdir, conf_text=conf, LINK_CORPUS_TTL="3600")
+    env["LINK_CORPUS_REFRESH"] = "inline"
+    # Queries repeat across runs, and a repeat answered from the result cache
+    # would time a file read rather than the search.
+    env["LINK_RESULT_CACHE"] = "0"
+    corpus = Path(env["LINK_CORPUS_FILE"])
+    rng = random.Random(seed)
+    queries = {
+        terms: [" ".join(rng.choice(words)[:4] for _ in range(terms)) for _ in range(runs)]
+        for terms in (1, 2, 3)
+    }
+
+    def cold():
+        for leftover in corpus.parent.glob(corpus.name + "*"):
+            if leftover.is_dir():
+                shutil.rmtree(leftover)
+            else:
+                leftover.unlink()
+
+    results = {"rows": count}
+    # A rebuild of a million rows takes a while, and its spread is small.
+    results["cold_rebuild"] = measure(min(runs, 3), lambda _: ["--rebuild"], env, cold)
+    for terms, texts in queries.items():
+        results["query_%d" % terms] = measure(runs, lambda run: ["--query", texts[run]], env)
+    results["default"] = measure(runs, lambda _: ["--query", ""], env)
+    line = "\t".join(("x", "xdg-open https://github.com/", "bench pin", "https://github.com/"))
+    results["toggle_pin"] = measure(runs, lambda _: ["--toggle-pin", line], env)
+    results["rank"] = rank_in_process(corpus, queries[1], runs)
+    return results
+
+
+def compare(results, baseline):
+    print("\n%-8s %-13s %10s %10s %7s" % ("rows", "measure", "before", "after", "ratio"))
+    for size, measures in results["sizes"].items():
+        before = baseline.get("sizes", {}).get(size, {})
+        for name, after in measures.items():
+            if not isinstance(after, dict) or name not in before:
+                continue
+            old, new = before[name]["p50"], after["p50"]
+            print("%-8s %-13s %10.2f %10.2f %6.2fx" % (size, name, old, new, new / old if old else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--runs", type=int, default=20, help="runs per measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="results json (default link-bench-<time>.json)")
+    parser.add_argument("--compare", help="an earlier results json to compare p50 against")
+    parser.add_argument("--keep", help="generate into this directory and leave it there")
+    args = parser.parse_args()
+
+    results = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "commit": subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip(),
+        "runs": args.runs,
+        "seed": args.seed,
+        "sizes": {},
+    }
+    for count in args.rows:
+        keep = os.path.join(args.keep, str(count)) if args.keep else None
+        results["sizes"][str(count)] = measured = bench(count, args.runs, args.seed, keep)
+        print("\n%d rows" % count)
+        for name, stats in measured.items():
+            if isinstance(stats, dict):
+                print(
+                    "  %-13s p50 %9.2f  p95 %9.2f  p99 %9.2f ms%s" % (
+                        name, stats["p50"], stats["p95"], stats["p99"],
+                        "  rss %.1f MB" % stats["peak_rss_mb"] if "peak_rss_mb" in stats else "",
+                    )
+                )
+
+    out = args.out or "link-bench-%s.json" % time.strftime("%Y%m%d-%H%M%S")
+    with open(out, "w") as handle:
+        json.dump(results, handle, indent=1)
+    print("\nwrote %s" % out)
+    if args.compare:
+        with open(args.compare) as handle:
+            compare(results, json.load(handle))
+
+
+if __name__ == "__main__":
+    main()
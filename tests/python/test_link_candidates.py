@@ -1,12 +1,23 @@
+import fcntl
+import json
+import marshal
 import os
+import socket
 import sqlite3
 import subprocess
+import sys
 import tempfile
+import time
 import unittest
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).parents[2] / "scripts"))
+
+import __lib_link_corpus as linkcorpus  # noqa: E402
+import __link_candidates as picker  # noqa: E402
 
 SCRIPT = Path(__file__).parents[2] / "scripts" / "__link_candidates.py"
+CLIENT = Path(__file__).parents[2] / "scripts" / "__link_client.py"
 
 SNIPPETS = """
 [[Snippets]]
@@ -53,14 +64,17 @@ def firefox_db(path, rows):
 def bookmark_table(path, rows):
     conn = sqlite3.connect(path)
     conn.execute(
-        "create table if not exists moz_bookmarks (fk integer, type integer, title text)"
+        "create table if not exists moz_bookmarks "
+        "(fk integer, type integer, title text, lastModified integer)"
     )
     for url, title in rows:
         found = conn.execute("select id from moz_places where url = ?", (url,)).fetchone()
         if found is None:
             cursor = conn.execute("insert into moz_places (url, title) values (?, '')", (url,))
             found = (cursor.lastrowid,)
-        conn.execute("insert into moz_bookmarks values (?, 1, ?)", (found[0], title))
+        conn.execute(
+            "insert into moz_bookmarks values (?, 1, ?, ?)", (found[0], title, time.time_ns() // 1000)
+        )
     conn.commit()
     conn.close()
 
@@ -84,9 +98,11 @@ def pins_file(workdir):
     return Path(workdir) / "pins"
 
 
-def run_script(workdir, dbs=(), conf_text=None, args=(), **env_overrides):
+def script_env(workdir, dbs=(), conf_text=None, **env_overrides):
     snippet_file = Path(workdir) / "pet-links.toml"
-    snippet_file.write_text(SNIPPETS)
+    # Rewritten only when missing, so a run keeps the stat the one before saw.
+    if not snippet_file.exists():
+        snippet_file.write_text(SNIPPETS)
     conf_file = Path(workdir) / "picker.conf"
     if conf_text is None:
         conf_file.unlink(missing_ok=True)
@@ -111,12 +127,15 @@ def run_script(workdir, dbs=(), conf_text=None, args=(), **env_overrides):
         # profiles on whatever machine this runs on.
         env["LINK_HISTORY_DBS"] = str(Path(workdir) / "no-such-history.sqlite")
     env.update(env_overrides)
+    return env
 
+
+def run_script(workdir, dbs=(), conf_text=None, args=(), script=SCRIPT, **env_overrides):
     result = subprocess.run(
-        ["python3", str(SCRIPT), *args],
+        ["python3", str(script), *args],
         text=True,
         capture_output=True,
-        env=env,
+        env=script_env(workdir, dbs, conf_text, **env_overrides),
         check=True,
     )
     return [tuple(line.split("\t")) for line in result.stdout.splitlines()]
@@ -188,6 +207,32 @@ class LinkCandidatesTest(unittest.TestCase):
         )
         self.assertEqual(self.history(rows), [])
 
+    def test_parsed_snippets_are_kept_until_the_toml_moves(self):
+        self.candidates()
+        store = self.path / "corpus.parsed"
+        script, entries = marshal.loads(store.read_bytes())
+        toml = str(self.path / "pet-links.toml")
+        # Planted under the toml's own stat, so only the store can answer it.
+        planted = ("Planted", "xdg-open https://planted.example.com/", "https://planted.example.com/")
+        entries[toml] = (entries[toml][0], [planted])
+        store.write_bytes(marshal.dumps((script, entries)))
+        # A search, since the default list is cached whole under the same stat.
+        search = lambda: run_script(self.workdir.name, args=["--query", "planted"])
+        self.assertEqual(len(search()), 1)
+        (self.path / "pet-links.toml").write_text(SNIPPETS + "\n")
+        self.assertEqual(search(), [])
+
+    def test_chrome_bookmarks_are_parsed_into_the_store(self):
+        db = self.make_db("History", [("https://a.example.com/", "A", 100)], kind="chrome")
+        bookmarks = self.path / "Bookmarks"
+        bookmarks.write_text(json.dumps({"roots": {"bookmark_bar": {"children": [
+            {"type": "url", "url": "https://kappa.example.com/", "name": "Kappa board"},
+        ]}}}))
+        rows = run_script(self.workdir.name, [db], args=["--query", "kappa"])
+        self.assertEqual([row[3] for row in rows], ["https://kappa.example.com/"])
+        _, entries = marshal.loads((self.path / "corpus.parsed").read_bytes())
+        self.assertEqual(entries[str(bookmarks)][1], [("https://kappa.example.com/", "Kappa board")])
+
     def test_notion_page_dedupes_across_hosts_and_query_strings(self):
         page = "a" * 32
         rows = self.candidates(
@@ -346,6 +391,22 @@ class ConfFileTest(unittest.TestCase):
         tags = [row[0].rsplit("  ", 1)[-1].strip() for row in rows]
         self.assertEqual(tags, ["#home"] * 2 + ["#work"] * 3)
 
+    # Profiles are read side by side; a broken one in the middle must neither
+    # take the others with it nor shuffle their order.
+    def test_a_broken_profile_leaves_the_rest_in_conf_order(self):
+        broken = Path(self.workdir.name) / "broken.sqlite"
+        broken.write_bytes(b"not a database" * 100)
+        conf_text = "profile = work:%s\nprofile = broken:%s\nprofile = home:%s\n" % (
+            self.work_db,
+            broken,
+            self.home_db,
+        )
+        rows = self.history(run_script(self.workdir.name, conf_text=conf_text))
+        tags = [row[0].rsplit("  ", 1)[-1].strip() for row in rows]
+        self.assertEqual(tags, ["#work"] * 3 + ["#home"] * 2)
+        rows = run_script(self.workdir.name, conf_text=conf_text, args=["--query", "repo"])
+        self.assertIn("[home repo]", rows[0][0])
+
     def test_conf_limit_is_applied(self):
         rows = self.history(self.candidates("limit = 2"))
         self.assertEqual(len(rows), 2)
@@ -442,6 +503,23 @@ class PinTest(unittest.TestCase):
         )
         self.assertEqual(self.tag_of(self.candidates()[0]), "#history")
 
+    def test_the_default_list_is_cached_within_the_ttl(self):
+        self.candidates(LINK_CORPUS_TTL="3600")
+        firefox_db(self.db, [("https://newer.example.com/", "newer page", 400)])
+        self.assertIn("[recent page]", self.candidates(LINK_CORPUS_TTL="3600")[0][0])
+        # Past the ttl the moved database is seen.
+        self.assertIn("[newer page]", self.candidates(LINK_CORPUS_TTL="0")[0][0])
+
+    def test_a_pin_shows_through_the_cached_list(self):
+        row = self.candidates(LINK_CORPUS_TTL="3600")[0]
+        run_script(self.workdir.name, dbs=[self.db], args=["--toggle-pin", "\t".join(row)])
+        self.assertEqual(self.tag_of(self.candidates(LINK_CORPUS_TTL="3600")[0]), "#pin")
+
+    def test_a_changed_setting_rebuilds_the_cached_list(self):
+        self.candidates(LINK_CORPUS_TTL="3600")
+        rows = self.candidates(LINK_CORPUS_TTL="3600", LINK_HISTORY_LIMIT="1")
+        self.assertEqual(len([row for row in rows if "#history" in row[0]]), 1)
+
     def test_hidden_columns_carry_the_untruncated_title_and_url(self):
         long_title = "a very long tab title that the display column has to cut short " * 2
         long_url = "https://long.example.com/" + "segment/" * 20
@@ -496,6 +574,18 @@ class SearchTest(unittest.TestCase):
         rows = self.search("needle", dbs=[db], LINK_HISTORY_LIMIT="1")
         self.assertEqual(self.titles(rows), ["the needle"])
 
+    def test_a_superseded_search_answers_nothing(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://needle.example.com/", "the needle", 300)])
+        (self.path / "query.generation").write_text("2")
+        self.assertEqual(self.search("needle", dbs=[db], LINK_QUERY_GENERATION="1"), [])
+        self.assertEqual(len(self.search("needle", dbs=[db], LINK_QUERY_GENERATION="2")), 1)
+        # Run directly, a search is never superseded and leaves the file to
+        # the picker's own searches, as does the list before anything is typed.
+        self.assertEqual(len(self.search("needle", dbs=[db])), 1)
+        self.search("", dbs=[db])
+        self.assertEqual((self.path / "query.generation").read_text(), "2")
+
     def test_browser_bookmarks_join_the_corpus(self):
         db = self.path / "places.sqlite"
         firefox_db(db, [("https://a.example.com/", "unrelated", 300)])
@@ -570,9 +660,134 @@ class SearchTest(unittest.TestCase):
         self.assertTrue(corpus.exists())
         # Rewritten by hand: the next search must answer out of it rather than
         # go back to the database.
-        corpus.write_text("h\thistory\t300\thttps://cached.example.com/\tcached needle\n")
+        corpus.write_bytes(linkcorpus.encode(
+            {},
+            [("h", "history", 300, "https://cached.example.com/", "cached needle")],
+            picker.row_features,
+        ))
         self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["cached needle"])
 
+    def test_a_corpus_in_the_old_text_format_is_rebuilt(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "fresh needle", 300)])
+        self.search("needle", dbs=[db])
+        (self.path / "corpus").write_text(
+            "h\thistory\t300\thttps://cached.example.com/\tcached needle\n"
+        )
+        self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["fresh needle"])
+
+    def test_the_corpus_exports_as_text(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "tab\there", 300)])
+        self.search("needle", dbs=[db])
+        rows = run_script(self.workdir.name, [db], args=["--export-corpus"])
+        self.assertEqual(rows[0][0], "#")
+        self.assertEqual(rows[1], ("h", "history", "300", "https://a.example.com/needle", "tab here"))
+
+    def test_noise_and_untitled_history_never_reach_the_corpus(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [
+            ("https://a.example.com/needle", "a needle", 300),
+            ("https://duckduckgo.com/?q=needle", "needle at DuckDuckGo", 200),
+            ("https://b.example.com/needle", "", 100),
+        ])
+        self.search("needle", dbs=[db])
+        rows = run_script(self.workdir.name, [db], args=["--export-corpus"])
+        self.assertEqual([row[3] for row in rows[1:]], ["https://a.example.com/needle"])
+
+    def test_copies_of_a_page_collapse_into_the_newest(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [
+            ("https://www.notion.so/Plan-" + "a" * 32 + "?v=1", "Plan | Notion", 100),
+            ("https://app.notion.com/Plan-" + "a" * 32, "Plan (renamed) | Notion", 300),
+            ("https://www.notion.so/Plan-" + "a" * 32 + "?pvs=4", "Plan | Notion", 200),
+        ])
+        self.search("plan", dbs=[db])
+        rows = run_script(self.workdir.name, [db], args=["--export-corpus"])
+        self.assertEqual(
+            [row[2:] for row in rows[1:]],
+            [("300", "https://app.notion.com/Plan-" + "a" * 32, "Plan (renamed) | Notion")],
+        )
+
+    # Collapsing stays inside a profile, so each keeps its own tag.
+    def test_a_page_in_two_profiles_stays_in_both(self):
+        work, home = self.path / "work.sqlite", self.path / "home.sqlite"
+        firefox_db(work, [("https://a.example.com/needle", "a needle", 300)])
+        firefox_db(home, [("https://a.example.com/needle", "a needle", 200)])
+        self.search("needle", dbs=[work, home])
+        rows = run_script(self.workdir.name, [work, home], args=["--export-corpus"])
+        self.assertEqual(len(rows[1:]), 2)
+
+    def test_a_visited_bookmark_is_one_row_that_mark_still_finds(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://saved.example.com/doc", "the saved doc", 300)])
+        bookmark_table(db, [("https://saved.example.com/doc", "saved doc")])
+        rows = self.search("saved", dbs=[db])
+        self.assertEqual(self.titles(rows), ["the saved doc"])
+        self.assertEqual(self.tag_of(rows[0]), "#history")
+        self.assertEqual(self.titles(self.search("saved #mark", dbs=[db])), ["the saved doc"])
+        rows = self.search("saved", dbs=[db], LINK_HISTORY="off")
+        self.assertEqual([self.tag_of(row) for row in rows], ["#mark"])
+
+    # The build collapses only copies of one page. Two pages sharing a title on
+    # one host stay apart until a query matches both.
+    def test_pages_sharing_a_title_are_both_searchable(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [
+            ("https://grafana.example.com/d/abc123/latency", "Grafana", 300),
+            ("https://grafana.example.com/d/xyz789/errors", "Grafana", 400),
+        ])
+        rows = self.search("latency", dbs=[db])
+        self.assertEqual(
+            [row[3] for row in rows], ["https://grafana.example.com/d/abc123/latency"]
+        )
+        self.assertEqual(len(self.search("grafana", dbs=[db])), 1)
+
+    # What was typed when the bookmark was saved finds it, even though its page
+    # is in history under another title.
+    def test_a_visited_bookmark_is_found_by_its_own_title(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://www.notion.so/Team-" + "b" * 32, "Team page | Notion", 300)])
+        bookmark_table(db, [("https://www.notion.so/Team-" + "b" * 32, "standup board")])
+        rows = self.search("standup", dbs=[db])
+        self.assertEqual(self.titles(rows), ["standup board"])
+        self.assertEqual(self.tag_of(rows[0]), "#mark")
+        self.assertEqual(self.titles(self.search("team", dbs=[db])), ["Team page"])
+
+    # Sharing a title with a history row does not make a bookmark that page:
+    # it keeps its own url, with history on and off.
+    def test_a_bookmark_sharing_only_a_title_keeps_its_url(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://wiki.example.com/a", "Runbook", 300)])
+        bookmark_table(db, [("https://wiki.example.com/b", "Runbook")])
+        rows = self.search("runbook #mark", dbs=[db])
+        self.assertEqual([row[3] for row in rows], ["https://wiki.example.com/b"])
+        rows = self.search("runbook", dbs=[db], LINK_HISTORY="off")
+        self.assertEqual([row[3] for row in rows], ["https://wiki.example.com/b"])
+        self.assertEqual(self.tag_of(rows[0]), "#mark")
+
+    # The rows dropped at build time still count towards the profile, or every
+    # refresh would take the mismatch for deletions and read it whole.
+    def test_a_refresh_past_dropped_rows_stays_incremental(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [
+            ("https://a.example.com/needle", "first needle", 300),
+            ("https://duckduckgo.com/?q=needle", "needle at DuckDuckGo", 200),
+        ])
+        self.search("needle", dbs=[db])
+        self.edit_corpus("first needle", "cached needle")
+        conn = sqlite3.connect(db)
+        conn.execute(
+            "insert into moz_places (url, title, last_visit_date) values (?, ?, ?)",
+            ("https://b.example.com/needle", "newer needle", 400 * 1000000),
+        )
+        conn.commit()
+        conn.close()
+        self.assertEqual(
+            sorted(self.titles(self.search("needle", dbs=[db]))),
+            ["cached needle", "newer needle"],
+        )
+
     def test_a_moved_database_rebuilds_the_cache(self):
         db = self.path / "places.sqlite"
         firefox_db(db, [("https://a.example.com/needle", "first needle", 300)])
@@ -580,6 +795,700 @@ class SearchTest(unittest.TestCase):
         firefox_db(db, [("https://b.example.com/needle", "second needle", 300)])
         self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["second needle"])
 
+    # Deleting one page and visiting another between two refreshes leaves the
+    # count where it was; the deleted page must still go.
+    def test_a_deleted_page_is_dropped_while_another_is_added(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [
+            ("https://a.example.com/needle", "kept needle", 300),
+            ("https://b.example.com/needle", "forgotten needle", 200),
+        ])
+        self.search("needle", dbs=[db])
+        conn = sqlite3.connect(db)
+        conn.execute("delete from moz_places where url = 'https://b.example.com/needle'")
+        conn.execute(
+            "insert into moz_places (url, title, last_visit_date) values (?, ?, ?)",
+            ("https://c.example.com/needle", "new needle", 400 * 1000000),
+        )
+        conn.commit()
+        conn.close()
+        self.assertEqual(
+            sorted(self.titles(self.search("needle", dbs=[db]))),
+            ["kept needle", "new needle"],
+        )
+
+    # A search engine visited again is sifted out again; it is no reason to
+    # read the whole profile.
+    def test_a_revisited_noise_url_is_merged_not_reread(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [
+            ("https://a.example.com/needle", "first needle", 300),
+            ("https://duckduckgo.com/?q=needle", "needle at DuckDuckGo", 200),
+        ])
+        self.search("needle", dbs=[db])
+        self.edit_corpus("first needle", "cached needle")
+        conn = sqlite3.connect(db)
+        conn.execute(
+            "update moz_places set last_visit_date = ? where url like 'https://duckduckgo%'",
+            (500 * 1000000,),
+        )
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["cached needle"])
+
+    def test_a_longer_query_ranks_only_what_the_shorter_one_found(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "needle in here", 300)])
+        self.assertEqual(self.titles(self.search("nee", dbs=[db])), ["needle in here"])
+        # Emptied by hand under the same generation: a search that narrows
+        # must trust it and find nothing, one that does not must scan.
+        narrow = self.path / "corpus.narrow"
+        generation, terms, _ = marshal.loads(narrow.read_bytes())
+        narrow.write_bytes(marshal.dumps((generation, terms, b"")))
+        self.assertEqual(self.search("needle", dbs=[db]), [])
+        self.assertEqual(self.titles(self.search("ne", dbs=[db])), ["needle in here"])
+
+    def test_a_capital_still_narrows_a_lowercase_term(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "Needle in here", 300)])
+        self.search("nee", dbs=[db])
+        self.assertEqual(self.titles(self.search("Needle", dbs=[db])), ["Needle in here"])
+        self.assertEqual(self.search("NEEDLE", dbs=[db]), [])
+
+    # The reader recorded per path, without when it was.
+    def readers(self):
+        memo = json.loads((self.path / "corpus.readers").read_text())
+        return {path: name for path, (name, _) in memo.items()}
+
+    def test_an_unlocked_database_is_read_in_place(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "a needle", 300)])
+        self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["a needle"])
+        self.assertEqual(self.readers(), {str(db): "uri"})
+
+    # What a running browser does to its history: write ahead logging, and an
+    # exclusive lock held for as long as it runs. The newest visit is only in
+    # the log, so whatever reads the database has to see the log too.
+    def test_a_locked_database_falls_back_to_a_copy(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "old needle", 300)])
+        browser = sqlite3.connect(db)
+        self.addCleanup(browser.close)
+        browser.execute("pragma journal_mode = wal")
+        browser.execute("pragma locking_mode = exclusive")
+        browser.execute(
+            "insert into moz_places (url, title, last_visit_date) values (?, ?, ?)",
+            ("https://b.example.com/needle", "logged needle", 400 * 1000000),
+        )
+        browser.commit()
+        self.assertEqual(
+            sorted(self.titles(self.search("needle", dbs=[db]))),
+            ["logged needle", "old needle"],
+        )
+        self.assertEqual(self.readers(), {str(db): "copy"})
+
+    # A browser without write ahead logging keeps a rollback journal beside the
+    # file while it runs, and writes the file itself: reading it as immutable
+    # could catch a write halfway, so the lock it holds has to be respected.
+    def test_a_journaled_database_is_not_read_as_immutable(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "old needle", 300)])
+        browser = sqlite3.connect(db)
+        self.addCleanup(browser.close)
+        browser.execute("pragma locking_mode = exclusive")
+        browser.execute(
+            "insert into moz_places (url, title, last_visit_date) values (?, ?, ?)",
+            ("https://b.example.com/needle", "new needle", 400 * 1000000),
+        )
+        browser.commit()
+        self.assertTrue((self.path / "places.sqlite-journal").exists())
+        self.assertEqual(
+            sorted(self.titles(self.search("needle", dbs=[db]))),
+            ["new needle", "old needle"],
+        )
+        self.assertEqual(self.readers(), {str(db): "copy"})
+
+    def test_the_next_run_starts_at_the_recorded_reader(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "a needle", 300)])
+        (self.path / "corpus.readers").write_text(
+            json.dumps({str(db): ["backup", time.time()]})
+        )
+        self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["a needle"])
+        self.assertEqual(self.readers(), {str(db): "backup"})
+
+    # A lock that made one run copy the database may long be gone by the next.
+    def test_an_old_recorded_reader_is_tried_in_place_again(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "a needle", 300)])
+        since = time.time() - picker.READER_RETRY - 1
+        (self.path / "corpus.readers").write_text(json.dumps({str(db): ["copy", since]}))
+        self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["a needle"])
+        self.assertEqual(self.readers(), {str(db): "uri"})
+
+    def edit_corpus(self, old, new):
+        path = self.path / "corpus"
+        corpus = linkcorpus.Corpus(path.read_bytes())
+        rows = [
+            (kind, tag, when, url, title.replace(old, new))
+            for kind, tag, when, url, title in corpus.rows()
+        ]
+        path.write_bytes(linkcorpus.encode(corpus.meta, rows, picker.row_features))
+
+    def test_a_rebuild_under_way_elsewhere_is_not_waited_for(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "first needle", 300)])
+        self.search("needle", dbs=[db])
+        firefox_db(db, [("https://b.example.com/needle", "second needle", 400)])
+        with open(self.path / "corpus.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["first needle"])
+        self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["second needle"])
+
+    def test_a_background_refresh_answers_from_the_old_corpus(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "first needle", 300)])
+        self.search("needle", dbs=[db])
+        firefox_db(db, [("https://b.example.com/needle", "second needle", 400)])
+        rows = self.search("needle", dbs=[db], LINK_CORPUS_REFRESH="background")
+        self.assertEqual(self.titles(rows), ["first needle"])
+        # The detached rebuild swaps the new corpus in shortly after.
+        for _ in range(100):
+            rows = self.search("needle", dbs=[db], LINK_CORPUS_TTL="3600")
+            if self.titles(rows) == ["second needle"]:
+                return
+            time.sleep(0.05)
+        self.fail("the background rebuild never landed")
+
+    def test_a_refresh_reads_only_visits_past_the_mark(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "first needle", 300)])
+        self.search("needle", dbs=[db])
+        # Edited behind the picker's back: a refresh that went back to the
+        # database for this row would put the original title back.
+        self.edit_corpus("first needle", "cached needle")
+        conn = sqlite3.connect(db)
+        conn.execute(
+            "insert into moz_places (url, title, last_visit_date) values (?, ?, ?)",
+            ("https://b.example.com/needle", "newer needle", 400 * 1000000),
+        )
+        conn.commit()
+        conn.close()
+        self.assertEqual(
+            sorted(self.titles(self.search("needle", dbs=[db]))),
+            ["cached needle", "newer needle"],
+        )
+
+    # A rename moves neither the largest rowid nor the count, only the
+    # bookmark's lastModified, and the bookmarks are reread on that alone.
+    def test_a_renamed_bookmark_is_read_again(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "first needle", 300)])
+        bookmark_table(db, [("https://saved.example.com/doc", "oldname")])
+        self.assertEqual(self.titles(self.search("oldname", dbs=[db])), ["oldname"])
+        conn = sqlite3.connect(db)
+        conn.execute(
+            "update moz_bookmarks set title = 'newname', lastModified = lastModified + 1"
+        )
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.titles(self.search("newname", dbs=[db])), ["newname"])
+        self.assertEqual(self.search("oldname", dbs=[db]), [])
+
+    def test_a_revisited_url_is_updated_in_place(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [
+            ("https://a.example.com/needle", "first needle", 300),
+            ("https://b.example.com/", "bystander", 200),
+        ])
+        self.search("needle", dbs=[db])
+        self.edit_corpus("bystander", "cached bystander")
+        conn = sqlite3.connect(db)
+        conn.execute(
+            "update moz_places set title = 'revisited needle', last_visit_date = ?"
+            " where url = 'https://a.example.com/needle'",
+            (500 * 1000000,),
+        )
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["revisited needle"])
+        self.assertEqual(
+            self.titles(self.search("bystander", dbs=[db])), ["cached bystander"]
+        )
+
+    def test_a_schema_change_reads_the_profile_whole(self):
+        db = self.path / "places.sqlite"
+        firefox_db(db, [("https://a.example.com/needle", "first needle", 300)])
+        self.search("needle", dbs=[db])
+        self.edit_corpus("first needle", "cached needle")
+        conn = sqlite3.connect(db)
+        conn.execute("pragma user_version = 80")
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.titles(self.search("needle", dbs=[db])), ["first needle"])
+
+
+class PrewarmTest(unittest.TestCase):
+    """--prewarm, fired as the popup opens, leaves nothing for the first
+    keystroke to build."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.path = Path(self.workdir.name) / "state"
+        self.db = Path(self.workdir.name) / "places.sqlite"
+        firefox_db(self.db, [("https://a.example.com/needle", "first needle", 300)])
+
+    def picker(self, *args, **env):
+        return run_script(
+            self.workdir.name, [self.db], args=args,
+            LINK_CORPUS_FILE=str(self.path / "corpus"), LINK_CORPUS_TTL="3600", **env
+        )
+
+    def test_it_builds_the_corpus_and_the_caches_into_a_new_directory(self):
+        self.assertEqual(self.picker("--prewarm"), [])
+        for name in ("corpus", "corpus.parsed", "corpus.default"):
+            self.assertTrue((self.path / name).exists(), name)
+        self.assertEqual(len(self.picker("--query", "needle")), 1)
+
+    def test_a_fresh_corpus_is_left_alone(self):
+        self.picker("--prewarm")
+        built = (self.path / "corpus").stat().st_mtime_ns
+        self.picker("--prewarm")
+        self.assertEqual((self.path / "corpus").stat().st_mtime_ns, built)
+
+
+class WatchTest(unittest.TestCase):
+    """--watch keeps the corpus fresh from inotify, and a keystroke that finds
+    it running trusts its generation instead of looking at the profiles."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.path = Path(self.workdir.name)
+        self.db = self.path / "places.sqlite"
+        firefox_db(self.db, [("https://a.example.com/needle", "first needle", 300)])
+
+    def search(self, query, **env):
+        return run_script(self.workdir.name, [self.db], args=["--query", query], **env)
+
+    def test_a_keystroke_trusts_a_running_watcher(self):
+        self.search("needle")
+        corpus = linkcorpus.open_corpus(self.path / "corpus")
+        with open(self.path / "corpus.watch", "w") as beacon:
+            fcntl.flock(beacon, fcntl.LOCK_EX)
+            beacon.write(str(corpus.meta["generation"]))
+            beacon.flush()
+            firefox_db(self.db, [("https://b.example.com/needle", "second needle", 400)])
+            # A ttl of zero would have rebuilt; the watcher says nothing moved.
+            self.assertIn("[first needle]", self.search("needle")[0][0])
+        self.assertIn("[second needle]", self.search("needle")[0][0])
+
+    def test_the_watcher_picks_up_a_visit(self):
+        watcher = subprocess.Popen(
+            ["python3", str(SCRIPT), "--watch"],
+            env=script_env(self.workdir.name, [self.db], LINK_WATCH_QUIET="0.1"),
+        )
+        self.addCleanup(watcher.wait)
+        self.addCleanup(watcher.terminate)
+        env = {"LINK_CORPUS_TTL": "3600"}
+        self.wait_for(lambda: (self.path / "corpus.watch").read_text(), "never published")
+        self.assertIn("[first needle]", self.search("needle", **env)[0][0])
+        firefox_db(self.db, [("https://b.example.com/needle", "second needle", 400)])
+        self.wait_for(
+            lambda: "[second needle]" in self.search("needle", **env)[0][0], "never rebuilt"
+        )
+
+    def wait_for(self, check, message):
+        for _ in range(100):
+            try:
+                if check():
+                    return
+            except OSError:
+                pass
+            time.sleep(0.05)
+        self.fail(message)
+
+
+class ResultCacheTest(unittest.TestCase):
+    """A repeated query is answered out of corpus.results, without the
+    corpus, for as long as nothing it was answered from has moved."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.path = Path(self.workdir.name)
+        self.results = self.path / "corpus.results"
+        self.db = self.path / "places.sqlite"
+        firefox_db(self.db, [
+            ("https://a.example.com/needle", "first needle", 300),
+            ("https://b.example.com/haystack", "haystack", 200),
+        ])
+
+    def search(self, query, **env):
+        return run_script(self.workdir.name, [self.db], args=["--query", query], **env)
+
+    def test_a_repeat_is_answered_from_the_cache(self):
+        first = self.search("needle")
+        (saved,) = self.results.iterdir()
+        key, lines = marshal.loads(saved.read_bytes())
+        saved.write_bytes(marshal.dumps((key, ["planted\tx\ty\tz"])))
+        self.assertEqual(self.search("needle"), [("planted", "x", "y", "z")])
+        # Another spelling of the same query is the same key.
+        self.assertEqual(self.search("  needle "), [("planted", "x", "y", "z")])
+        self.assertNotEqual(self.search("Needle"), first)
+
+    def test_a_moved_input_is_searched_again(self):
+        self.search("needle")
+        firefox_db(self.db, [("https://c.example.com/needle", "third needle", 400)])
+        self.assertIn("[third needle]", self.search("needle")[0][0])
+        row = self.search("needle")[0]
+        run_script(self.workdir.name, [self.db], args=["--toggle-pin", "\t".join(row)])
+        self.assertTrue(self.search("needle")[0][0].startswith("* "))
+
+    # The ranking moves with the ranker, the corpus code, what the corpus is
+    # read from and the clock, so each of them is part of the key.
+    def test_the_key_names_the_libraries_the_sources_and_the_time(self):
+        self.search("needle")
+        (saved,) = self.results.iterdir()
+        key = marshal.loads(saved.read_bytes())[0]
+        for library in (picker.vimium, picker.linkcorpus):
+            self.assertIn(picker.stat_key(os.path.abspath(library.__file__)), key)
+        bucket = int(time.time() // picker.RESULT_BUCKET)
+        self.assertIn(key[-1], (bucket - 1, bucket))
+        saved.write_bytes(marshal.dumps((key, ["planted\tx\ty\tz"])))
+        planted = [("planted", "x", "y", "z")]
+        self.assertEqual(self.search("needle"), planted)
+        self.assertNotEqual(self.search("needle", LINK_BOOKMARKS="0"), planted)
+        other = self.path / "other.sqlite"
+        firefox_db(other, [])
+        self.assertNotEqual(
+            run_script(self.workdir.name, [self.db, other], args=["--query", "needle"]), planted
+        )
+
+    def test_the_least_recently_used_is_evicted_past_the_cap(self):
+        for query in ("needle", "haystack", "needle", "example"):
+            self.search(query, LINK_RESULT_CACHE="2")
+        kept = [marshal.loads(path.read_bytes())[0][0] for path in self.results.iterdir()]
+        self.assertEqual(sorted(kept), [("example",), ("needle",)])
+
+    def test_a_cap_of_zero_keeps_nothing(self):
+        self.search("needle", LINK_RESULT_CACHE="0")
+        self.assertFalse(self.results.exists())
+
+
+class ShardTest(unittest.TestCase):
+    """A corpus past shard_rows is searched in worker processes, and has to
+    answer exactly what one process would."""
+
+    QUERIES = ["page", "example", "dup", "e", "Page 1", "page #history", "page #mark"]
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.path = Path(self.workdir.name)
+        self.db = self.path / "places.sqlite"
+        # Duplicates by url and by host and title, far enough apart to land
+        # in different shards, so the dedupe has to hold across them.
+        rows = [
+            ("https://h%d.example.com/p/%d" % (n % 5, n), "Page %d" % (n % 17), 1000 - n)
+            for n in range(60)
+        ]
+        rows += [
+            ("https://dup.example.com/same", "dup first", 50),
+            ("https://dup.example.com/same?", "dup again", 40),
+            ("https://dup.example.com/other", "Page 3", 30),
+            ("https://h1.example.com/late", "Page 1", 20),
+        ]
+        firefox_db(self.db, rows)
+        bookmark_table(self.db, [("https://h2.example.com/p/7", "Page mark")])
+        # A second profile that saw much of the same, which only the search
+        # dedupes.
+        self.other = self.path / "other.sqlite"
+        firefox_db(self.other, rows[::2])
+
+    def search(self, query, **env):
+        return run_script(
+            self.workdir.name, [self.db, self.other], args=["--query", query],
+            LINK_CORPUS_TTL="3600", LINK_RESULT_CACHE="0", **env
+        )
+
+    def test_sharded_answers_equal_a_single_process(self):
+        for query in self.QUERIES:
+            whole = self.search(query, LINK_SHARD_ROWS="0")
+            with self.subTest(query=query):
+                self.assertTrue(whole)
+                self.assertFalse([row for row in whole if row[3].endswith("/late")])
+                for workers in ("2", "3", "7"):
+                    self.assertEqual(
+                        self.search(query, LINK_SHARD_ROWS="1", LINK_SHARD_WORKERS=workers),
+                        whole,
+                    )
+
+    # A shard that finds a newer query answers False, which ends the search,
+    # rather than None, which would have the caller search every row again.
+    def test_a_superseded_shard_says_so(self):
+        rows = [
+            ("https://e.example.com/%d" % n, "page %d" % n, 100)
+            for n in range(picker.GENERATION_ROWS + 1)
+        ]
+        firefox_db(self.db, rows)
+        run_script(self.workdir.name, [self.db], args=["--rebuild"])
+        path = str(self.path / "corpus")
+        corpus = picker.read_corpus(path)
+        (self.path / "query.generation").write_text("2")
+        # In process, so the generation file is found through this process's
+        # environment; cleanups run last first, so any old value is put back.
+        if "LINK_PICKER_SOCKET" in os.environ:
+            self.addCleanup(
+                os.environ.__setitem__, "LINK_PICKER_SOCKET", os.environ["LINK_PICKER_SOCKET"]
+            )
+        self.addCleanup(os.environ.pop, "LINK_PICKER_SOCKET", None)
+        os.environ["LINK_PICKER_SOCKET"] = str(self.path / "server.sock")
+        job = (
+            path, corpus.meta["generation"], ["page"], 0, set(), True, (0, len(corpus)), None,
+        )
+        self.assertIs(picker.search_shard(job + ("1",)), False)
+        self.assertTrue(picker.search_shard(job + ("2",)))
+
+    def test_a_pin_stays_first_in_a_sharded_search(self):
+        row = self.search("dup")[0]
+        run_script(
+            self.workdir.name, [self.db, self.other], args=["--toggle-pin", "\t".join(row)]
+        )
+        sharded = self.search("dup", LINK_SHARD_ROWS="1", LINK_SHARD_WORKERS="3")
+        self.assertTrue(sharded[0][0].startswith("* "))
+        self.assertEqual(sharded, self.search("dup", LINK_SHARD_ROWS="0"))
+
+    def test_the_trace_counts_the_shards(self):
+        trace = str(self.path / "trace")
+        self.search("page")
+        self.search("page", LINK_SHARD_ROWS="1", LINK_SHARD_WORKERS="3", LINK_PICKER_TRACE=trace)
+        self.search("page", LINK_SHARD_ROWS="0", LINK_PICKER_TRACE=trace)
+        sharded, single = [
+            json.loads(line)["rows"] for line in Path(trace).read_text().splitlines()
+        ]
+        self.assertEqual(sharded.pop("shards"), 3)
+        self.assertEqual(sharded, single)
+
+
+class ServerTest(unittest.TestCase):
+    """--serve answers over a socket what a fresh process would print, and the
+    client falls back to a fresh process whenever the server cannot."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.path = Path(self.workdir.name)
+        self.socket = self.path / "server.sock"
+        self.db = self.path / "places.sqlite"
+        firefox_db(self.db, [
+            ("https://a.example.com/needle", "first needle", 300),
+            ("https://b.example.com/", "other page", 200),
+        ])
+
+    def start_server(self, **env):
+        server = subprocess.Popen(
+            ["python3", str(SCRIPT), "--serve"],
+            env=script_env(self.workdir.name, [self.db], **env),
+        )
+        self.addCleanup(server.wait)
+        self.addCleanup(server.terminate)
+        self.wait_for_socket()
+        return server
+
+    def wait_for_socket(self):
+        for _ in range(100):
+            if self.socket.exists():
+                return
+            time.sleep(0.05)
+        self.fail("server never listened")
+
+    def client(self, *args, **env):
+        return run_script(self.workdir.name, [self.db], args=args, script=CLIENT, **env)
+
+    def direct(self, *args, **env):
+        return run_script(self.workdir.name, [self.db], args=args, **env)
+
+    # Straight at the socket, so the client's fallback to a fresh process
+    # cannot pass for an answer from the server.
+    def served(self, *args, **env_overrides):
+        env = script_env(self.workdir.name, [self.db], **env_overrides)
+        fields = [str(len(args))] + list(args) + [
+            "%s=%s" % item for item in env.items()
+            if item[0].startswith("LINK_") or item[0] == "PET_SNIPPET_FILE"
+        ]
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(str(self.socket))
+            conn.sendall("\0".join(fields).encode())
+            conn.shutdown(socket.SHUT_WR)
+            reply = b"".join(iter(lambda: conn.recv(65536), b""))
+        return reply
+
+    def test_the_server_answers_what_the_script_prints(self):
+        self.start_server()
+        reply = self.served("--query", "needle")
+        self.assertEqual(reply[:1], b"0")
+        self.assertEqual(
+            [tuple(line.split("\t")) for line in reply[1:].decode().splitlines()],
+            self.direct("--query", "needle"),
+        )
+        self.assertEqual(self.client("--query", "needle"), self.direct("--query", "needle"))
+        self.assertEqual(self.client("--query", ""), self.direct())
+        self.assertEqual(self.client(), self.direct())
+
+    def test_a_pin_made_through_the_server_shows_on_the_next_keystroke(self):
+        self.start_server()
+        row = self.client("--query", "needle")[0]
+        self.client("--toggle-pin", "\t".join(row))
+        self.assertTrue(self.client("--query", "needle")[0][0].startswith("* "))
+        self.assertTrue(self.direct("--query", "needle")[0][0].startswith("* "))
+
+    def test_a_search_a_newer_one_superseded_answers_nothing(self):
+        self.start_server()
+        generation = self.path / "query.generation"
+        generation.write_text("2")
+        self.assertEqual(self.served("--query", "needle", LINK_QUERY_GENERATION="1"), b"0")
+        reply = self.served("--query", "needle", LINK_QUERY_GENERATION="2")
+        self.assertIn(b"first needle", reply)
+
+    def test_the_client_registers_each_search_before_asking(self):
+        self.start_server()
+        generation = self.path / "query.generation"
+        generation.write_text("1")
+        self.assertEqual(len(self.client("--query", "needle")), 1)
+        self.assertGreater(int(generation.read_text()), 1)
+
+    def test_a_different_environment_is_answered_directly(self):
+        self.start_server()
+        self.assertEqual(self.client(LINK_HISTORY="0"), self.direct(LINK_HISTORY="0"))
+
+    def test_the_first_request_starts_a_server_and_still_answers(self):
+        rows = self.client("--query", "needle", LINK_SERVER_IDLE="2")
+        self.assertEqual(rows, self.direct("--query", "needle"))
+        self.wait_for_socket()
+        self.assertEqual(self.client("--query", "needle", LINK_SERVER_IDLE="2"), rows)
+        # Idle exit takes the socket with it.
+        for _ in range(100):
+            if not self.socket.exists():
+                return
+            time.sleep(0.05)
+        self.fail("server never went idle")
+
+
+class TraceTest(unittest.TestCase):
+    """LINK_PICKER_TRACE appends a json line of phase timings per request,
+    and --trace-summary reads them back as percentiles."""
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.path = Path(self.workdir.name)
+        self.db = self.path / "places.sqlite"
+        self.trace = self.path / "trace"
+        firefox_db(self.db, [
+            ("https://a.example.com/needle", "first needle", 300),
+            ("https://b.example.com/", "other page", 200),
+        ])
+
+    def run_traced(self, *args, **env):
+        return run_script(
+            self.workdir.name, [self.db], args=args, LINK_PICKER_TRACE=str(self.trace), **env
+        )
+
+    def records(self):
+        return [json.loads(line) for line in self.trace.read_text().splitlines()]
+
+    def test_a_search_records_every_phase_and_its_rows(self):
+        self.run_traced("--query", "needle")
+        self.run_traced("--query", "needle", LINK_CORPUS_TTL="3600", LINK_RESULT_CACHE="0")
+        self.run_traced("--query", "needle", LINK_CORPUS_TTL="3600")
+        first, second, third = self.records()
+        self.assertTrue(third["cached"])
+        self.assertNotIn("match", third["phases"])
+        self.assertTrue(first["rebuilt"])
+        self.assertIn("build_read", first["phases"])
+        self.assertFalse(second["rebuilt"])
+        self.assertNotIn("build_read", second["phases"])
+        for phase in ("conf", "curated", "stale", "prefilter", "match", "score", "render", "total"):
+            self.assertIn(phase, second["phases"])
+        self.assertEqual(second["rows"], {"corpus": 2, "prefilter": 1, "matches": 1, "emitted": 1})
+        self.assertEqual(second["command"], "--query")
+
+    def test_the_default_list_records_whether_it_was_cached(self):
+        self.run_traced(LINK_CORPUS_TTL="3600")
+        self.run_traced(LINK_CORPUS_TTL="3600")
+        first, second = self.records()
+        self.assertIn("default_build", first["phases"])
+        self.assertNotIn("default_build", second["phases"])
+        self.assertEqual(first["rows"]["emitted"], second["rows"]["emitted"])
+
+    def test_nothing_is_written_untraced(self):
+        run_script(self.workdir.name, [self.db], args=["--query", "needle"])
+        self.assertFalse(self.trace.exists())
+
+    def test_the_summary_gives_percentiles_per_phase(self):
+        self.trace.write_text("".join(
+            json.dumps({"phases": {"total": n / 1000, "score": n / 2000}}) + "\n"
+            for n in range(1, 101)
+        ) + "not json\n")
+        rows = [line[0].split() for line in self.run_traced("--trace-summary")]
+        self.assertEqual(rows[0], ["phase", "count", "p50", "ms", "p95", "ms", "p99", "ms"])
+        self.assertEqual(rows[1], ["total", "100", "50.00", "95.00", "99.00"])
+        self.assertEqual(rows[2], ["score", "100", "25.00", "47.50", "49.50"])
+
+
+class ImportTest(unittest.TestCase):
+    """A keystroke answered out of a warm cache pays for nothing it does not
+    use: no sqlite, no toml parser, no thread pool, no socket."""
+
+    # Microseconds of import on top of a bare interpreter, for the warm
+    # --query. About a third of this on a laptop; the rest is room for a
+    # loaded machine, not for new imports.
+    BUDGET = 30000
+    HEAVY = ("sqlite3", "tomllib", "concurrent.futures", "tempfile", "shutil", "socket")
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.db = Path(self.workdir.name) / "places.sqlite"
+        firefox_db(self.db, [("https://a.example.com/needle", "first needle", 300)])
+
+    # {module: cumulative microseconds} for the imports at the top level of
+    # the run, nested ones being counted inside them.
+    def imports(self, *args, **env):
+        result = subprocess.run(
+            ["python3", "-X", "importtime", *args],
+            text=True,
+            capture_output=True,
+            env=script_env(self.workdir.name, [self.db], LINK_CORPUS_TTL="3600", **env),
+            check=True,
+        )
+        found = {}
+        for line in result.stderr.splitlines():
+            fields = line.split("|")
+            if not line.startswith("import time:") or not fields[1].strip().isdigit():
+                continue
+            name = fields[2][1:]
+            if not name.startswith(" "):
+                found.setdefault(name, int(fields[1]))
+        return found
+
+    def warm(self, *args):
+        run_script(self.workdir.name, [self.db], args=args, LINK_CORPUS_TTL="3600")
+        return self.imports(str(SCRIPT), *args)
+
+    def test_a_warm_search_stays_within_its_import_budget(self):
+        imported = self.warm("--query", "needle")
+        baseline = self.imports("-c", "pass")
+        cost = sum(spent for name, spent in imported.items() if name not in baseline)
+        self.assertLess(cost, self.BUDGET)
+
+    def test_the_warm_paths_leave_the_heavy_modules_alone(self):
+        for args in (("--query", "needle"), ("--query", ""), ("--toggle-pin", "x")):
+            with self.subTest(args=args):
+                self.assertFalse(set(self.HEAVY) & set(self.warm(*args)))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,199 @@
+"""The mmap corpus format in __lib_link_corpus.py, without a picker around it.
+
+test_link_candidates.py covers the corpus as the picker builds and searches it;
+these are the layout, the trigram index and the blob scan on their own.
+"""
+
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[2] / "scripts"))
+
+import __lib_link_corpus as linkcorpus  # noqa: E402
+import __lib_vimium_rank as vimium  # noqa: E402
+
+ROWS = [
+    ("h", "work", 300.5, "https://linear.app/team/DEVOPS/triage", "Dev Ops › Triage"),
+    ("b", "home", 0, "https://zeta.example.com/docs", "Zeta docs"),
+    ("h", "work", 100.0, "https://ünïcode.example.com/ß", "Grüße aus Köln"),
+    ("h", "home", 50.0, "https://a.example.com/", "triage triage triage"),
+]
+
+
+# Stands in for the picker's row_features: something per field that shows
+# which row it came from.
+def derive(row):
+    return len(row[4]) % 256, (row[3].upper(), row[4][::-1])
+
+
+def encode(meta, rows):
+    return linkcorpus.encode(meta, rows, derive)
+
+
+def matching(corpus, query):
+    return corpus.matching(vimium.Ranker(query.split(), 0))
+
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.corpus = linkcorpus.Corpus(encode({"bookmarks": True}, ROWS))
+
+    def test_rows_come_back_as_written(self):
+        self.assertEqual(list(self.corpus.rows()), ROWS)
+        self.assertEqual(len(self.corpus), len(ROWS))
+
+    def test_features_come_back_per_row(self):
+        for index, row in enumerate(ROWS):
+            flags, fields = derive(row)
+            self.assertEqual(self.corpus.features(index), (flags, *fields))
+
+    def test_meta_carries_the_tag_table(self):
+        self.assertEqual(self.corpus.meta["tags"], ["work", "home"])
+        self.assertTrue(self.corpus.meta["bookmarks"])
+
+    # Offsets are kept in bytes and in characters, so a multibyte row must
+    # shift the next by neither.
+    def test_a_row_after_multibyte_text_is_intact(self):
+        self.assertEqual(self.corpus.row(3)[3:], ROWS[3][3:])
+        self.assertEqual(matching(self.corpus, "https://a.example"), [3])
+        self.assertEqual(matching(self.corpus, "tr"), [0, 3])
+
+    # A search the index answers reads its candidates and nothing else, so the
+    # blob is never decoded as a whole.
+    def test_an_indexed_search_decodes_only_its_candidates(self):
+        self.assertEqual(matching(self.corpus, "triage"), [0, 3])
+        self.corpus.row(1)
+        self.assertIsNone(self.corpus._whole)
+
+    def test_a_newline_in_a_field_is_flattened(self):
+        corpus = linkcorpus.Corpus(encode({}, [("h", "t", 1, "https://x/", "a\nb")]))
+        self.assertEqual(corpus.row(0)[4], "a b")
+
+    def test_an_empty_corpus_is_valid(self):
+        corpus = linkcorpus.Corpus(encode({}, []))
+        self.assertEqual(len(corpus), 0)
+        self.assertEqual(matching(corpus, "anything"), [])
+
+    def test_it_reads_through_mmap(self):
+        with tempfile.NamedTemporaryFile() as handle:
+            handle.write(encode({}, ROWS))
+            handle.flush()
+            self.assertEqual(list(linkcorpus.open_corpus(handle.name).rows()), ROWS)
+
+
+class MatchingTest(unittest.TestCase):
+    def setUp(self):
+        self.corpus = linkcorpus.Corpus(encode({}, ROWS))
+
+    def test_every_term_has_to_land_in_the_row(self):
+        self.assertEqual(matching(self.corpus, "linear triage"), [0])
+        self.assertEqual(matching(self.corpus, "triage"), [0, 3])
+
+    def test_smart_case_holds_across_the_blob(self):
+        self.assertEqual(matching(self.corpus, "devops"), [0])
+        self.assertEqual(matching(self.corpus, "DEVOPS"), [0])
+        self.assertEqual(matching(self.corpus, "Devops"), [])
+
+    def test_multibyte_rows_are_found(self):
+        self.assertEqual(matching(self.corpus, "köln"), [2])
+
+    # The separator between rows is whitespace, which no term can carry, so a
+    # term cannot match across two rows.
+    def test_a_term_does_not_span_rows(self):
+        self.assertEqual(matching(self.corpus, "docshttps"), [])
+
+    def test_no_terms_matches_every_row(self):
+        self.assertEqual(matching(self.corpus, ""), [0, 1, 2, 3])
+
+    # Row 2 carries an umlaut, so it is in no posting list, and an indexed
+    # term still has to reach it.
+    def test_an_indexed_term_reaches_a_loose_row(self):
+        self.assertEqual(matching(self.corpus, "aus"), [2])
+
+    def test_a_trigram_nothing_holds_matches_nothing(self):
+        self.assertEqual(matching(self.corpus, "qqqq"), [])
+
+
+class IndexTest(unittest.TestCase):
+    """The index may only narrow: for any query it has to agree with checking
+    every row by hand."""
+
+    QUERIES = [
+        "tri", "triage", "triage linear", "ops", "Ops", "zeta docs", "ex",
+        "e", "example.com", "docs zeta", "ß", "grü", "/te", "ge aus",
+        "app/team", "devops", "DEVOPS", "123", "http",
+    ]
+
+    def test_every_query_agrees_with_a_full_scan(self):
+        rows = ROWS + [
+            ("h", "work", 1.0, "https://h%d.example.com/p/%d" % (n % 7, n),
+             "Page %d about Triage and ops" % n)
+            for n in range(200)
+        ]
+        corpus = linkcorpus.Corpus(encode({}, rows))
+        for query in self.QUERIES:
+            ranker = vimium.Ranker(query.split(), 0)
+            expected = [
+                index for index, row in enumerate(rows)
+                if ranker.matches_in(row[3] + "\n" + row[4])
+            ]
+            with self.subTest(query=query):
+                self.assertEqual(corpus.matching(ranker), expected)
+
+    # Shards of any size, taken in order, have to add up to the whole search,
+    # on the index, the blob scan and a narrowed search alike.
+    def test_shards_add_up_to_the_whole(self):
+        rows = ROWS + [
+            ("h", "work", 1.0, "https://h%d.example.com/p/%d" % (n % 7, n), "Page %d ops" % n)
+            for n in range(50)
+        ]
+        corpus = linkcorpus.Corpus(encode({}, rows))
+        for query in self.QUERIES:
+            ranker = vimium.Ranker(query.split(), 0)
+            whole = corpus.matching(ranker)
+            for size in (1, 7, 100):
+                bounds = [
+                    (first, min(first + size, len(rows))) for first in range(0, len(rows), size)
+                ]
+                with self.subTest(query=query, size=size):
+                    self.assertEqual(
+                        [
+                            index for shard in bounds
+                            for index in corpus.matching(ranker, rows=shard)
+                        ],
+                        whole,
+                    )
+                    self.assertEqual(
+                        [
+                            index for shard in bounds
+                            for index in corpus.matching(ranker, whole, rows=shard)
+                        ],
+                        whole,
+                    )
+
+
+class RejectTest(unittest.TestCase):
+    def test_another_version_is_refused(self):
+        data = bytearray(encode({}, ROWS))
+        data[4] = linkcorpus.VERSION + 1
+        with self.assertRaises(linkcorpus.CorpusError):
+            linkcorpus.Corpus(bytes(data))
+
+    def test_text_is_refused(self):
+        with self.assertRaises(linkcorpus.CorpusError):
+            linkcorpus.Corpus(b"h\thistory\t300\thttps://a/\ta title\n")
+
+    def test_a_truncated_file_is_refused(self):
+        with self.assertRaises(linkcorpus.CorpusError):
+            linkcorpus.Corpus(encode({}, ROWS)[:-3])
+
+    def test_an_empty_file_is_refused(self):
+        with tempfile.NamedTemporaryFile() as handle:
+            with self.assertRaises(linkcorpus.CorpusError):
+                linkcorpus.open_corpus(handle.name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,19 +4,25 @@ Unit tests for __append_to_playlist.py
 """
 import os
 import pathlib
+import re
+import subprocess
 import tempfile
 import unittest
 import sys
+from unittest import mock
 
 # Add scripts directory to path to import the module
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'scripts'))
 # organize_with_claude was dropped in fee9f8f7 (split into tag_entry_with_claude
 # and organize_playlist). Nothing here ever used it, but the dead name in this
 # import raised ImportError at module load, which failed every test in the file.
+import __append_to_playlist as playlist
 from __append_to_playlist import (
     normalize_url,
     append_to_playlist,
     atomic_write,
+    parse_batch_response,
+    tag_entries_with_claude,
 )
 
 class TestNormalizeURL(unittest.TestCase):
@@ -235,5 +241,171 @@ class TestAtomicWrite(unittest.TestCase):
         temp_files = list(pathlib.Path(self.test_dir.name).glob("*.tmp"))
         self.assertEqual(len(temp_files), 0, f"Temp files remain: {temp_files}")
 
+class TestBatchTagging(unittest.TestCase):
+    """Test tagging untagged entries with one Claude prompt per batch."""
+    
+    def setUp(self):
+        """Pretend the Claude CLI is installed and healthy."""
+        for patcher in (
+            mock.patch.object(playlist, 'check_claude_cli', return_value=(True, "ok")),
+            mock.patch.dict(playlist._claude_state, health=None, tripped=None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    def claude_reply(self, replies):
+        """Patch subprocess.run to answer each Claude prompt from a function of the prompt."""
+        def run(cmd, **_):
+            return subprocess.CompletedProcess(cmd, 0, stdout=replies(cmd[-1]), stderr="")
+        return mock.patch.object(playlist.subprocess, 'run', side_effect=run)
+    
+    def test_parse_batch_response_validates_each_line(self):
+        """Test that only numbered lines with a listed category are accepted."""
+        titles = ["Dark drones", "Nocturne", "Not a category", "Missing the hash", "Coding"]
+        response = "\n".join([
+            "1 | # AMBIENT/DARK: Dark drones",
+            "2 | # CLASSICAL/PIANO [CHOPIN]: Nocturne",
+            "3 | # POLKA/HAPPY: Not a category",
+            "4 | AMBIENT/CALM: Missing the hash",
+            "Here are your tags:",
+            "9 | # LOFI/CHILL: Out of range",
+            "1 | # LOFI/JAZZ: Dark drones",
+            "5 | # FOCUS/CODING:   ",
+        ])
+        self.assertEqual(parse_batch_response(response, titles), {
+            0: "# AMBIENT/DARK: Dark drones",
+            1: "# CLASSICAL/PIANO [CHOPIN]: Nocturne",
+        })
+    
+    def test_parse_batch_response_rejects_a_misnumbered_title(self):
+        """Test that a line is only accepted for the entry whose title it carries."""
+        titles = ["Rain sounds", "Chopin Nocturne", "⭐ Coding beats"]
+        response = "\n".join([
+            "1 | # CLASSICAL/PIANO [CHOPIN]: Chopin Nocturne",
+            "2 | # AMBIENT/NATURE: Rain sounds",
+            "3 | # FOCUS/CODING:  ⭐ coding  beats",
+        ])
+        self.assertEqual(parse_batch_response(response, titles), {
+            2: "# FOCUS/CODING:  ⭐ coding  beats",
+        })
+    
+    def test_misnumbered_entries_are_retried_individually(self):
+        """Test that entries a batch answer swapped are tagged on their own."""
+        entries = [("Rain sounds", "https://a"), ("Chopin Nocturne", "https://b")]
+        swapped = "1 | # CLASSICAL/PIANO: Chopin Nocturne\n2 | # AMBIENT/NATURE: Rain sounds"
+        with self.claude_reply(lambda _: swapped):
+            with mock.patch.object(playlist, 'tag_entry_with_claude', side_effect=lambda title, _: f"# SINGLE/TAG: {title}") as single:
+                tagged = tag_entries_with_claude(entries, batch_size=10)
+        
+        self.assertEqual(single.call_count, 2)
+        self.assertEqual(tagged, ["# SINGLE/TAG: Rain sounds", "# SINGLE/TAG: Chopin Nocturne"])
+    
+    def test_entries_are_tagged_one_prompt_per_batch(self):
+        """Test that titles are split into batches of the configured size."""
+        entries = [(f"Track {n}", f"https://youtube.com/watch?v={n}") for n in range(5)]
+        
+        def replies(prompt):
+            titles = re.findall(r"^\d+\. (Track \d+)$", prompt, re.MULTILINE)
+            return "\n".join(f"{n} | # LOFI/CHILL: {title}" for n, title in enumerate(titles, 1))
+        
+        with self.claude_reply(replies) as run:
+            tagged = tag_entries_with_claude(entries, batch_size=2, parallel=2)
+        
+        self.assertEqual(run.call_count, 3)
+        self.assertEqual(tagged, [f"# LOFI/CHILL: Track {n}" for n in range(5)])
+    
+    def test_unparseable_entries_are_retried_individually(self):
+        """Test that a title the batch answer got wrong is tagged on its own."""
+        entries = [("Rain sounds", "https://a"), ("Chopin Nocturne", "https://b")]
+        with self.claude_reply(lambda _: "1 | # AMBIENT/NATURE: Rain sounds\n2 | # POLKA/HAPPY: Chopin Nocturne"):
+            with mock.patch.object(playlist, 'tag_entry_with_claude', return_value="# CLASSICAL/PIANO: Chopin Nocturne") as single:
+                tagged = tag_entries_with_claude(entries, batch_size=10)
+        
+        single.assert_called_once_with("Chopin Nocturne", "https://b")
+        self.assertEqual(tagged, ["# AMBIENT/NATURE: Rain sounds", "# CLASSICAL/PIANO: Chopin Nocturne"])
+    
+    def test_unavailable_claude_falls_back_to_auto_tagging(self):
+        """Test that no prompt is sent when the Claude CLI is not working."""
+        with mock.patch.object(playlist, 'check_claude_cli', return_value=(False, "missing")):
+            with self.claude_reply(lambda _: "") as run:
+                tagged = tag_entries_with_claude([("Deep focus coding", "https://a")])
+        
+        run.assert_not_called()
+        self.assertEqual(tagged, [playlist.auto_tag_entry("Deep focus coding", "https://a")])
+
+class TestClaudeHealth(unittest.TestCase):
+    """Test the once-per-process Claude CLI check and its circuit breaker."""
+    
+    def setUp(self):
+        """Point the CLI and its health cache at a temporary directory, with fresh process state."""
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.test_dir.cleanup)
+        self.claude_bin = pathlib.Path(self.test_dir.name) / "claude"
+        self.claude_bin.write_text("")
+        self.cache = pathlib.Path(self.test_dir.name) / "cache" / "claude_health.json"
+        for patcher in (
+            mock.patch.object(playlist, 'CLAUDE_BIN', str(self.claude_bin)),
+            mock.patch.object(playlist, 'CLAUDE_HEALTH_CACHE', self.cache),
+            mock.patch.object(playlist, 'CLAUDE_HEALTH_TTL', 300),
+            mock.patch.dict(playlist._claude_state, health=None, tripped=None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    def claude_run(self, side_effect):
+        """Patch subprocess.run; side_effect gets the command and returns stdout or raises."""
+        def run(cmd, **_):
+            return subprocess.CompletedProcess(cmd, 0, stdout=side_effect(cmd), stderr="")
+        return mock.patch.object(playlist.subprocess, 'run', side_effect=run)
+    
+    def new_process(self):
+        """Forget what this process knows, as the next run of the script would."""
+        playlist._claude_state.update(health=None, tripped=None)
+    
+    def test_check_runs_once_per_process(self):
+        """Test that `claude --version` is spawned for the first check only."""
+        with self.claude_run(lambda _: "1.0.0") as run:
+            for _ in range(3):
+                self.assertTrue(playlist.check_claude_cli()[0])
+        self.assertEqual(run.call_count, 1)
+    
+    def test_healthy_check_is_reused_across_runs_within_ttl(self):
+        """Test that a later run reads the disk cache instead of spawning."""
+        with self.claude_run(lambda _: "1.0.0") as run:
+            playlist.check_claude_cli()
+            self.new_process()
+            self.assertEqual(playlist.check_claude_cli(), (True, "Claude CLI 1.0.0 is ready"))
+        self.assertEqual(run.call_count, 1)
+        
+        with mock.patch.object(playlist, 'CLAUDE_HEALTH_TTL', 0), self.claude_run(lambda _: "1.0.0") as run:
+            self.new_process()
+            playlist.check_claude_cli()
+        self.assertEqual(run.call_count, 1)
+    
+    def test_a_changed_binary_is_checked_again(self):
+        """Test that replacing the CLI invalidates the cached check."""
+        with self.claude_run(lambda _: "1.0.0") as run:
+            playlist.check_claude_cli()
+            self.claude_bin.write_text("a newer claude")
+            self.new_process()
+            playlist.check_claude_cli()
+        self.assertEqual(run.call_count, 2)
+    
+    def test_first_timeout_sends_the_rest_to_auto_tagging(self):
+        """Test that after one timeout no further entry waits on Claude."""
+        def claude(cmd):
+            if cmd[1] == "--version":
+                return "1.0.0"
+            raise subprocess.TimeoutExpired(cmd, 30)
+        
+        titles = ["Rain sounds", "Chopin piano", "Deep focus coding"]
+        with self.claude_run(claude) as run:
+            tagged = [playlist.tag_entry_with_claude(title, "https://a") for title in titles]
+        
+        prompts = [call.args[0] for call in run.call_args_list if call.args[0][1] == "-p"]
+        self.assertEqual(len(prompts), 1)
+        self.assertEqual(tagged, [playlist.auto_tag_entry(title, "https://a") for title in titles])
+        self.assertFalse(playlist.check_claude_cli()[0])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -7,6 +7,8 @@ does. A wider differential run over 400 rows of real history and a dozen
 queries agreed on every value; these are the cases worth keeping.
 """
 
+import random
+import re
 import sys
 import unittest
 from pathlib import Path
@@ -76,6 +78,24 @@ class MatchTest(unittest.TestCase):
         self.assertFalse(ranker("linear absent").matches_in(TRIAGE_URL + "\n" + TRIAGE_TITLE))
 
 
+class NarrowsTest(unittest.TestCase):
+    def test_extending_a_term_narrows(self):
+        self.assertTrue(ranker("kuber").narrows(["kube"]))
+        self.assertTrue(ranker("kube ctl").narrows(["kube"]))
+
+    def test_backspacing_does_not(self):
+        self.assertFalse(ranker("kub").narrows(["kube"]))
+
+    def test_editing_a_middle_term_does_not(self):
+        self.assertFalse(ranker("kube nodes ctl").narrows(["kube", "pods", "ctl"]))
+
+    # "kube" matched insensitively, so "Kuber" in a row is "kube" in it too;
+    # "Kube" matched sensitively, and "kuber" says nothing about it.
+    def test_smart_case_decides_which_way_a_capital_narrows(self):
+        self.assertTrue(ranker("Kuber").narrows(["kube"]))
+        self.assertFalse(ranker("kuber").narrows(["Kube"]))
+
+
 class WordRelevancyTest(unittest.TestCase):
     def assertScore(self, got, want):
         self.assertAlmostEqual(got, want, places=12)
@@ -144,5 +164,182 @@ class RelevancyTest(unittest.TestCase):
         self.assertAlmostEqual(r.relevancy(text, TRIAGE_TITLE, stale), 0.3, places=12)
 
 
+# The scorer as it was written before _term_stats became one pass: a split and
+# two boundary regexes per term per string, the extension's own structure. Kept
+# here only to hold the fused version to it.
+def reference_word_relevancy(terms, text, title):
+    def stats(term, string):
+        smart_case = term != term.upper() and term.lower() == term
+        flags = re.IGNORECASE if smart_case else 0
+        escaped = re.escape(term)
+        occurrences = len(re.split(escaped, string, flags=flags)) - 1
+        boost = 1
+        if re.search(r"\b" + escaped, string, flags):
+            boost = 2
+            if re.search(r"\b" + escaped + r"\b", string, flags):
+                boost = 3
+        return boost, occurrences * len(term)
+
+    max_boost = vimium.MAX_TERM_BOOST * len(terms) or vimium.EMPTY_QUERY_BOOST
+    url_boost = url_chars = title_boost = title_chars = 0
+    for term in terms:
+        boost, chars = stats(term, text)
+        url_boost += boost
+        url_chars += chars
+        if title:
+            boost, chars = stats(term, title)
+            title_boost += boost
+            title_chars += chars
+    url_score = url_boost / max_boost * vimium.coverage(url_chars, len(text))
+    if title_chars == 0:
+        return url_score / 2 if title else url_score
+    title_score = title_boost / max_boost * vimium.coverage(title_chars, len(title))
+    if url_score < title_score:
+        return title_score
+    return (url_score + title_score) / 2
+
+
+class FusedScorerTest(unittest.TestCase):
+    """The one pass scorer against the regexes it replaced, on random strings.
+
+    The alphabet is small so terms repeat and overlap ("aaa" in "aaaa"), and it
+    carries the characters where lowercasing and a case insensitive regex part
+    ways: the Kelvin sign, dotted and dotless I, a long s, the three sigmas.
+    """
+
+    ALPHABET = "aAbBiIkKsS_ -./1éÉß›KİıſΣσς"
+
+    def random_string(self, rng, longest):
+        return "".join(rng.choice(self.ALPHABET) for _ in range(rng.randint(0, longest)))
+
+    def test_scores_are_bit_identical(self):
+        rng = random.Random(20240611)
+        for _ in range(3000):
+            text = self.random_string(rng, 16)
+            title = self.random_string(rng, 16)
+            terms = []
+            for _ in range(rng.randint(1, 3)):
+                source = rng.choice([text, title]) or "a"
+                start = rng.randrange(len(source))
+                term = source[start : start + rng.randint(1, 4)].strip() or "a"
+                if rng.random() < 0.3:
+                    term = term.lower()
+                terms.append(term)
+            want = reference_word_relevancy(terms, text, title)
+            got = vimium.Ranker(terms, NOW_MS).word_relevancy(text, title)
+            self.assertEqual(got, want, (terms, text, title))
+
+    def test_overlapping_occurrences_count_as_split_does(self):
+        r = ranker("aa")
+        self.assertEqual(r.word_relevancy("aaaaa", ""), reference_word_relevancy(["aa"], "aaaaa", ""))
+
+    # "the" inside "other" is not on a boundary, the later one is: the pass has
+    # to keep looking after the first occurrence.
+    def test_a_later_occurrence_can_earn_the_boost(self):
+        r = ranker("the")
+        self.assertEqual(
+            r.word_relevancy("other the", ""),
+            reference_word_relevancy(["the"], "other the", ""),
+        )
+
+
+class ScoreBatchTest(unittest.TestCase):
+    """score_batch() against relevancy() row by row, through both paths."""
+
+    def rows(self, count):
+        rng = random.Random(7)
+        words = ["triage", "linear", "Ops", "dev", "", "e2e", "x_y", "Grüße"]
+        texts, titles, whens = [], [], []
+        for _ in range(count):
+            texts.append("/".join(rng.choice(words) for _ in range(rng.randint(0, 4))))
+            titles.append(" ".join(rng.choice(words) for _ in range(rng.randint(0, 4))))
+            # Bookmarks, fresh visits, old ones, and visits from the future.
+            whens.append(rng.choice([
+                0,
+                NOW_MS - rng.random() * vimium.RECENCY_WINDOW_MS,
+                NOW_MS - vimium.RECENCY_WINDOW_MS * rng.uniform(1, 1.001),
+                NOW_MS + rng.random() * 1000,
+            ]))
+        return texts, titles, whens
+
+    def check(self, count):
+        texts, titles, whens = self.rows(count)
+        for query in ["triage", "dev ops", "e", "Grüße x_y"]:
+            r = ranker(query)
+            want = [r.relevancy(*row) for row in zip(texts, titles, whens)]
+            with self.subTest(query=query):
+                self.assertEqual(r.score_batch(texts, titles, whens), want)
+
+    def test_a_small_batch_scores_row_by_row(self):
+        self.check(vimium.BATCH_MIN - 1)
+
+    @unittest.skipIf(vimium._numpy() is None, "numpy is not installed")
+    def test_the_numpy_columns_score_identically(self):
+        self.check(vimium.BATCH_MIN * 4)
+
+    def test_without_numpy_a_large_batch_still_scores(self):
+        saved = vimium._np[:]
+        vimium._np[:] = [None]
+        try:
+            self.check(vimium.BATCH_MIN * 2)
+        finally:
+            vimium._np[:] = saved
+
+    def test_a_bookmark_scores_its_word_relevancy(self):
+        r = ranker("triage")
+        text = vimium.shorten_url(TRIAGE_URL)
+        self.assertEqual(r.score_batch([text], [TRIAGE_TITLE], [0]), [
+            r.word_relevancy(text, TRIAGE_TITLE)
+        ])
+
+    def test_an_empty_batch(self):
+        self.assertEqual(ranker("x").score_batch([], [], []), [])
+
+
+class TopTest(unittest.TestCase):
+    """top() has to give exactly what sorting every scored row would."""
+
+    def rows(self, count):
+        rows = ScoreBatchTest().rows(count)
+        # Every row twice, so ties have to fall to the earlier one.
+        return [column + column for column in rows]
+
+    def sorted_rows(self, r, texts, titles, whens, groups, limit):
+        scores = r.score_batch(texts, titles, whens)
+        ranked = sorted(range(len(texts)), key=lambda row: (groups[row], -scores[row], row))
+        return [(row, scores[row]) for row in ranked[:limit]]
+
+    def test_agrees_with_a_full_sort(self):
+        texts, titles, whens = self.rows(700)
+        groups = [1 if row % 97 else 0 for row in range(len(texts))]
+        for query in ["triage", "dev ops", "e", "Grüße"]:
+            r = ranker(query)
+            for limit in [0, 1, 5, 200, 5000]:
+                with self.subTest(query=query, limit=limit):
+                    self.assertEqual(
+                        r.top(texts, titles, whens, groups, limit),
+                        self.sorted_rows(r, texts, titles, whens, groups, limit),
+                    )
+
+    def test_stop_gives_up_on_the_ranking(self):
+        texts, titles, whens = self.rows(700)
+        groups = [1] * len(texts)
+        r = ranker("e")
+        self.assertEqual(r.top(texts, titles, whens, groups, 50, stop=lambda: True), [])
+        self.assertEqual(
+            r.top(texts, titles, whens, groups, 50, stop=lambda: False),
+            r.top(texts, titles, whens, groups, 50),
+        )
+
+    def test_bounds_are_never_below_the_score(self):
+        texts, titles, whens = self.rows(300)
+        for query in ["triage", "dev ops", "e", "Grüße x_y"]:
+            r = ranker(query)
+            scores = r.score_batch(texts, titles, whens)
+            bounds = r.bound_batch(texts, titles, whens)
+            with self.subTest(query=query):
+                self.assertTrue(all(b >= s for b, s in zip(bounds, scores)))
+
+
 if __name__ == "__main__":
     unittest.main()